@@ -0,0 +1,268 @@
+"""
+HTTP load test of the API, fully offline.
+
+Starts the app under waitress on a fresh SQLite database, seeds it with synthetic layers of the
+given sizes, then replays a mix of map-click, layer-list, raster, create and update traffic from
+concurrent clients, and reports throughput and latency percentiles per endpoint as json.
+
+Usage, from the backend directory:
+    python -m benchmarks.load_test --layers 1k 10k 50k --clients 8 --duration 30 --output load.json
+"""
+import argparse
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+
+import numpy as np
+
+from data_manipulation.synthetic import synthetic_points
+from benchmarks.render_benchmarks import parse_size, environment
+
+# Default traffic mix, as relative weights of each operation
+DEFAULT_MIX = {"click": 60, "layers": 15, "raster": 15, "create": 5, "update": 5}
+
+# Points in the layers created during the test
+CREATE_POINTS = 2000
+
+
+def parse_mix(mix: str) -> dict:
+    """Parse a traffic mix such as click=60,layers=20,create=5"""
+    weights = {}
+    for item in mix.split(","):
+        name, weight = item.split("=")
+        if name not in DEFAULT_MIX:
+            raise ValueError(f"Unknown operation {name!r}, expected one of {list(DEFAULT_MIX)}")
+        weights[name] = float(weight)
+    return weights
+
+
+def free_port() -> int:
+    """A free local TCP port"""
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def multipart(fields: dict, files: dict) -> tuple[bytes, str]:
+    """
+    Encode a multipart/form-data body.
+        Returns:
+                The body, and its content type
+    """
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    for name, (filename, content) in files.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                     f'Content-Type: text/csv\r\n\r\n'.encode() + content + b"\r\n")
+    parts.append(f"--{boundary}--\r\n".encode())
+    return b"".join(parts), f"multipart/form-data; boundary={boundary}"
+
+
+class Client:
+    """HTTP client of the app, recording the latency of every request by endpoint"""
+
+    def __init__(self, base_url: str, results: list, rng: random.Random):
+        self.base_url = base_url
+        self.results = results
+        self.rng = rng
+
+    def request(self, endpoint: str, path: str, method="GET", data=None, content_type=None):
+        """Send a request and record it under endpoint. Returns the status and body"""
+        request = urllib.request.Request(self.base_url + path, data=data, method=method)
+        if content_type is not None:
+            request.add_header("Content-Type", content_type)
+        start = time.perf_counter()
+        try:
+            with urllib.request.urlopen(request, timeout=600) as response:
+                status, body = response.status, response.read()
+        except urllib.error.HTTPError as e:
+            status, body = e.code, e.read()
+        except OSError as e:
+            status, body = 0, str(e).encode()
+        self.results.append((endpoint, time.perf_counter() - start, status))
+        return status, body
+
+    def create_layer(self, points: int, title: str, seed: int):
+        """Create a layer from a synthetic point set"""
+        csv = synthetic_points(points, "clustered", seed).to_csv(index=False).encode()
+        body, content_type = multipart({"title": title, "colWeights": json.dumps({"value": [1.0, "IDW"]}),
+                                        "geom": "lon,lat"}, {"file": (f"{title}.csv", csv)})
+        return self.request("/create_layer", "/create_layer", "POST", body, content_type)
+
+    def update_layer(self, layer: dict):
+        """Re-render a layer with a different weight"""
+        weight = round(self.rng.uniform(0.5, 2.0), 2)
+        body, content_type = multipart({"title": layer["title"], "colWeights": json.dumps({"value": [weight, "IDW"]}),
+                                        "geom": f"{layer['geomX']},{layer['geomY']}"}, {})
+        return self.request("/update_layer", f"/update_layer/{layer['id']}", "PATCH", body, content_type)
+
+
+def wait_for_server(base_url: str, process, timeout: float = 120) -> float:
+    """
+    Wait until the app answers, or raise if it exits or does not start in time.
+        Returns:
+                The seconds from now until the first answer
+    """
+    start = time.monotonic()
+    deadline = start + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited with code {process.returncode}")
+        try:
+            with urllib.request.urlopen(base_url + "/layers", timeout=5):
+                return time.monotonic() - start
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError("Server did not start in time")
+
+
+def seed_layers(client: Client, sizes: list[int]) -> list[dict]:
+    """Create one layer per size, waiting for any background full render to finish"""
+    for i, size in enumerate(sizes):
+        status, body = client.create_layer(size, f"seed-{i}-{size}", seed=i)
+        if status != 201:
+            raise RuntimeError(f"Seeding a {size} point layer failed with {status}: {body[:200]}")
+    while True:
+        _, body = client.request("/layers", "/layers")
+        layers = json.loads(body)["layers"]
+        if all(layer.get("status", "ready") != "preview" for layer in layers):
+            return layers
+        time.sleep(0.5)
+
+
+def layer_sizes(client: Client, layers: list[dict]) -> dict:
+    """Pixel dimensions of each layer, by layer id, for map clicks"""
+    sizes = {}
+    for layer in layers:
+        _, body = client.request("/get_json", f"/get_json/{layer['id']}/None")
+        bounds = json.loads(body)["jsonFile"]
+        sizes[layer["id"]] = (bounds["sizex"], bounds["sizey"])
+    return sizes
+
+
+def run_client(base_url, results, seed, mix, deadline, layers, sizes):
+    """Replay random operations from the mix until the deadline"""
+    rng = random.Random(seed)
+    client = Client(base_url, results, rng)
+    operations, weights = list(mix), list(mix.values())
+    created = 0
+    while time.monotonic() < deadline:
+        operation = rng.choices(operations, weights)[0]
+        layer = rng.choice(layers)
+        if operation == "click":
+            sizex, sizey = sizes[layer["id"]]
+            client.request("/get_json", f"/get_json/{layer['id']}/{rng.randrange(sizex)},{rng.randrange(sizey)}")
+        elif operation == "layers":
+            client.request("/layers", "/layers")
+        elif operation == "raster":
+            client.request("/get_raster", f"/get_raster/{layer['id']}")
+        elif operation == "create":
+            created += 1
+            client.create_layer(CREATE_POINTS, f"load-{seed}-{created}", seed=seed * 1000 + created)
+        elif operation == "update":
+            client.update_layer(layer)
+
+
+def summarize(results: list, duration: float) -> dict:
+    """Throughput, error count and latency percentiles, in milliseconds, per endpoint"""
+    summary = {}
+    for endpoint in sorted({endpoint for endpoint, _, _ in results}):
+        latencies = np.array([latency for e, latency, _ in results if e == endpoint]) * 1000
+        errors = sum(1 for e, _, status in results if e == endpoint and not 200 <= status < 300)
+        summary[endpoint] = {
+            "requests": len(latencies),
+            "errors": errors,
+            "throughput": len(latencies) / duration,
+            "meanMs": float(latencies.mean()),
+            **{f"p{p}Ms": float(np.percentile(latencies, p)) for p in (50, 90, 95, 99)},
+            "maxMs": float(latencies.max())
+        }
+    return summary
+
+
+def serve(port: int, threads: int):
+    """Run the app under waitress on a fresh database (the database comes from DATABASE_URL)"""
+    from waitress import serve as waitress_serve
+    from main import app, db, create_spatial_index
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        create_spatial_index()
+    waitress_serve(app, host="127.0.0.1", port=port, threads=threads)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser("Load tests the API on a seeded SQLite database, offline")
+    parser.add_argument("--layers", help="Point counts of the seeded layers, eg. 1k 10k 50k", nargs="+",
+                        default=["1k", "10k", "50k"])
+    parser.add_argument("--clients", help="Concurrent clients", type=int, default=4)
+    parser.add_argument("--duration", help="Seconds of traffic", type=float, default=30)
+    parser.add_argument("--mix", help="Relative weights of operations, eg. click=60,layers=15,raster=15,create=5,"
+                                      "update=5", type=parse_mix, default=DEFAULT_MIX)
+    parser.add_argument("--threads", help="Waitress worker threads", type=int, default=4)
+    parser.add_argument("--seed", help="Random seed of the clients", type=int, default=0)
+    parser.add_argument("--output", help="File to write the results to (stdout if not given)", type=str, default=None)
+    parser.add_argument("--serve", help=argparse.SUPPRESS, type=int, default=None)
+    args = parser.parse_args(argv)
+
+    if args.serve is not None:
+        serve(args.serve, args.threads)
+        return
+
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ, DATABASE_URL=f"sqlite:///{os.path.join(tmp, 'load_test.db')}")
+        backend = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        launched = time.monotonic()
+        process = subprocess.Popen([sys.executable, "-m", "benchmarks.load_test", "--serve", str(port),
+                                    "--threads", str(args.threads)], cwd=backend, env=env,
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_for_server(base_url, process)
+            startup = time.monotonic() - launched
+            print("Seeding layers", file=sys.stderr)
+            seed_client = Client(base_url, [], random.Random(args.seed))
+            layers = seed_layers(seed_client, [parse_size(size) for size in args.layers])
+            sizes = layer_sizes(seed_client, layers)
+
+            print(f"Replaying traffic from {args.clients} clients for {args.duration}s", file=sys.stderr)
+            results = []
+            start = time.monotonic()
+            clients = [threading.Thread(target=run_client,
+                                        args=(base_url, results, args.seed + i, args.mix, start + args.duration,
+                                              layers, sizes))
+                       for i in range(args.clients)]
+            for client in clients:
+                client.start()
+            for client in clients:
+                client.join()
+            duration = time.monotonic() - start
+        finally:
+            process.terminate()
+            process.wait()
+
+    report = json.dumps({"environment": environment(), "startupSeconds": startup, "clients": args.clients, "durationSeconds": duration,
+                         "mix": args.mix, "layers": args.layers, "endpoints": summarize(results, duration)},
+                        indent=2)
+    if args.output is None:
+        print(report)
+    else:
+        with open(args.output, "w") as f:
+            f.write(report)
+
+
+if __name__ == "__main__":
+    main()
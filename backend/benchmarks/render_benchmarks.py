@@ -0,0 +1,240 @@
+"""
+Render benchmarks on synthetic point sets.
+
+Each (distribution, size) case runs in a fresh process, which generates its points and times
+generate_raster_file, interpolate for each method, write_pix_json, convert_to_alpha and
+provide_columns on them. Results are written as json, so runs can be compared.
+
+Usage, from the backend directory:
+    python -m benchmarks.render_benchmarks --sizes 10k 100k --output results.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+from queue import Empty
+
+import numpy as np
+
+from data_manipulation.synthetic import synthetic_points, DISTRIBUTIONS
+from data_manipulation.generate_raster_file import (generate_raster_file, interpolate, load_points, grid_spec,
+                                                    grid_axes)
+from data_manipulation.getImage import write_pix_json, convert_to_alpha
+from data_manipulation.provide_columns import provide_columns
+
+METHODS = ("IDW", "Density", "Linear", "Nearest")
+
+BENCHMARKS = ("generate_raster_file", "interpolate", "write_pix_json", "convert_to_alpha", "provide_columns")
+
+# Sample budget of the sampled provide_columns benchmark, the app's default
+SAMPLE_BYTES = 1024 * 1024
+
+# Seconds between checks that a case's process is still alive while waiting for its results
+POLL_SECONDS = 1
+
+
+def parse_size(size: str) -> int:
+    """Parse a point count such as 10k or 1M"""
+    multipliers = {"k": 1000, "m": 1000 ** 2}
+    suffix = size[-1].lower()
+    if suffix in multipliers:
+        return int(float(size[:-1]) * multipliers[suffix])
+    return int(size)
+
+
+def reset_peak_rss() -> bool:
+    """Reset the process's peak resident set size, where the kernel allows it (Linux)"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss() -> int:
+    """Peak resident set size of the process in bytes, since start or the last reset_peak_rss"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+def measure(func, repeat: int):
+    """
+    Call func repeat times, with stdout silenced.
+        Returns:
+                The last return value, the best wall time in seconds, and the peak RSS over the calls
+    """
+    reset_peak_rss()
+    best = float("inf")
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(repeat):
+            start = time.perf_counter()
+            result = func()
+            best = min(best, time.perf_counter() - start)
+    return result, best, peak_rss()
+
+
+def run_case(distribution: str, points: int, benchmarks, repeat: int) -> list[dict]:
+    """Run the selected benchmarks on one synthetic point set"""
+    data = synthetic_points(points, distribution)
+    col_weight = {"value": [1.0, "IDW"]}
+    geom = ["lat", "lon"]
+    results = []
+
+    def record(benchmark, wall, rss, cells=None, **extra):
+        result = {"benchmark": benchmark, "distribution": distribution, "points": points,
+                  "wallSeconds": wall, "pointsPerSecond": points / wall, "peakRss": rss}
+        if cells is not None:
+            result.update({"cells": cells, "cellsPerSecond": cells / wall})
+        result.update(extra)
+        results.append(result)
+
+    raster = io.BytesIO()
+    rendered, wall, rss = measure(lambda: generate_raster_file(data, raster, col_weight, geom), repeat)
+    if isinstance(rendered, Exception):
+        raise rendered
+    if "generate_raster_file" in benchmarks:
+        record("generate_raster_file", wall, rss, int(rendered["grid"].size))
+
+    if "interpolate" in benchmarks:
+        coords, cols_weights = load_points(data, col_weight, geom)
+        xs, ys = grid_axes(*grid_spec(coords))
+        grid_x, grid_y = np.meshgrid(xs, ys, indexing="ij")
+        for method in METHODS:
+            result, wall, rss = measure(lambda: interpolate(coords, cols_weights["value"], grid_x, grid_y, method),
+                                        repeat)
+            if result is None:
+                raise RuntimeError(f"interpolate failed for {method}")
+            record("interpolate", wall, rss, int(grid_x.size), method=method)
+
+    tiff = raster.getvalue()
+    if "write_pix_json" in benchmarks:
+        _, wall, rss = measure(lambda: write_pix_json(io.BytesIO(tiff), io.StringIO()), repeat)
+        record("write_pix_json", wall, rss, int(rendered["grid"].size))
+    if "convert_to_alpha" in benchmarks:
+        _, wall, rss = measure(lambda: convert_to_alpha(io.BytesIO(tiff), out_fp=io.BytesIO()), repeat)
+        record("convert_to_alpha", wall, rss, int(rendered["grid"].size))
+
+    if "provide_columns" in benchmarks:
+        csv = data.to_csv(index=False).encode()
+        for sample_bytes in (None, SAMPLE_BYTES):
+            _, wall, rss = measure(lambda: provide_columns(io.BytesIO(csv), sample_bytes), repeat)
+            record("provide_columns", wall, rss, bytes=len(csv), bytesPerSecond=len(csv) / wall,
+                   sampleBytes=sample_bytes)
+    return results
+
+
+def _run_case(queue, *args):
+    """Process entry point of run_case, returning its results or error through queue"""
+    try:
+        queue.put(("ok", run_case(*args)))
+    except Exception as e:
+        queue.put(("error", repr(e)))
+
+
+def run_isolated(distribution: str, points: int, benchmarks, repeat: int) -> list[dict]:
+    """
+    Run a case in a fresh process, so peak RSS and heap state are not shared between cases.
+        Returns:
+                The case's results, or if its process died (eg. killed for memory) an error result per
+                benchmark with the process's exit code
+    """
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    process = context.Process(target=_run_case, args=(queue, distribution, points, benchmarks, repeat))
+    process.start()
+    while True:
+        try:
+            status, payload = queue.get(timeout=POLL_SECONDS)
+            break
+        except Empty:
+            if not process.is_alive():
+                # Its results may have been queued just before it exited
+                try:
+                    status, payload = queue.get(timeout=POLL_SECONDS)
+                    break
+                except Empty:
+                    process.join()
+                    error = f"Benchmark process died with exit code {process.exitcode}"
+                    return [{"benchmark": benchmark, "distribution": distribution, "points": points,
+                             "error": error} for benchmark in benchmarks]
+    process.join()
+    if status == "error":
+        raise RuntimeError(payload)
+    return payload
+
+
+# Times, in a fresh interpreter, the import of the app and then of its lazily imported rendering stack
+STARTUP_SCRIPT = """
+import time
+start = time.perf_counter()
+import main
+ready = time.perf_counter()
+import lazy
+lazy.prewarm()
+print(ready - start, time.perf_counter() - ready)
+"""
+
+
+def measure_startup() -> dict:
+    """Cold start time of the app, and of its rendering stack once pre-warmed, in seconds"""
+    backend = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, DATABASE_URL="sqlite://")
+    output = subprocess.run([sys.executable, "-c", STARTUP_SCRIPT], cwd=backend, env=env, check=True,
+                            capture_output=True, text=True).stdout
+    import_seconds, prewarm_seconds = (float(value) for value in output.split()[-2:])
+    return {"importSeconds": import_seconds, "prewarmSeconds": prewarm_seconds}
+
+
+def environment() -> dict:
+    """Description of the machine and libraries, to compare runs on"""
+    return {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpus": os.cpu_count()
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser("Benchmarks rendering on synthetic point sets, as json")
+    parser.add_argument("--sizes", help="Point counts, eg. 10k 100k 1M 10M", nargs="+", default=["10k", "100k"])
+    parser.add_argument("--distributions", nargs="+", choices=DISTRIBUTIONS, default=list(DISTRIBUTIONS))
+    parser.add_argument("--benchmarks", nargs="+", choices=BENCHMARKS, default=list(BENCHMARKS))
+    parser.add_argument("--repeat", help="Calls per benchmark; the best wall time is reported", type=int, default=1)
+    parser.add_argument("--output", help="File to write the results to (stdout if not given)", type=str, default=None)
+    args = parser.parse_args(argv)
+
+    results = []
+    for size in args.sizes:
+        for distribution in args.distributions:
+            print(f"Benchmarking {distribution} {size}", file=sys.stderr)
+            results.extend(run_isolated(distribution, parse_size(size), args.benchmarks, args.repeat))
+
+    report = json.dumps({"environment": environment(), "startup": measure_startup(), "results": results}, indent=2)
+    if args.output is None:
+        print(report)
+    else:
+        with open(args.output, "w") as f:
+            f.write(report)
+
+
+if __name__ == "__main__":
+    main()
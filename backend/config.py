@@ -1,8 +1,11 @@
 import os
+import sqlite3
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
 from flask_migrate import Migrate
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
 import logging
 
 # Initialize Flask app
@@ -22,5 +25,100 @@ else:
 
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 
+# Engine options. Postgres gets a sized, pre-pinged pool and a statement timeout (in ms, 0 for none);
+# SQLite is tuned per connection by the pragmas below
+if app.config["SQLALCHEMY_DATABASE_URI"].startswith("postgres"):
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+        "pool_size": int(os.environ.get("DB_POOL_SIZE", 5)),
+        "max_overflow": int(os.environ.get("DB_MAX_OVERFLOW", 10)),
+        "pool_pre_ping": os.environ.get("DB_POOL_PRE_PING", "true").lower() == "true",
+        "pool_recycle": int(os.environ.get("DB_POOL_RECYCLE", 1800)),
+        "connect_args": {"options": f"-c statement_timeout={int(os.environ.get('DB_STATEMENT_TIMEOUT', 30000))}"}
+    }
+
+# SQLite pragmas: write-ahead logging so readers are not blocked by a writer, NORMAL syncing (safe with WAL),
+# and the bytes of the database file memory-mapped for reads
+app.config["SQLITE_WAL"] = os.environ.get("SQLITE_WAL", "true").lower() == "true"
+app.config["SQLITE_SYNCHRONOUS"] = os.environ.get("SQLITE_SYNCHRONOUS", "NORMAL").upper()
+if app.config["SQLITE_SYNCHRONOUS"] not in ("OFF", "NORMAL", "FULL", "EXTRA"):
+    raise ValueError(f"Invalid SQLITE_SYNCHRONOUS {app.config['SQLITE_SYNCHRONOUS']}")
+app.config["SQLITE_MMAP_SIZE"] = int(os.environ.get("SQLITE_MMAP_SIZE", 256 * 1024 ** 2))
+
+
+@event.listens_for(Engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """Applies the SQLite pragmas to every new SQLite connection"""
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    if app.config["SQLITE_WAL"]:
+        cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute(f"PRAGMA synchronous={app.config['SQLITE_SYNCHRONOUS']}")
+    cursor.execute(f"PRAGMA mmap_size={int(app.config['SQLITE_MMAP_SIZE'])}")
+    cursor.close()
+
+# Largest uploaded file accepted, in bytes (0 for no limit), enforced as it is spooled to disk, and the directory
+# uploads are spooled to (the system's temporary directory if unset)
+app.config["MAX_UPLOAD_BYTES"] = int(os.environ.get("MAX_UPLOAD_BYTES", 1024 ** 3)) or None
+app.config["UPLOAD_DIR"] = os.environ.get("UPLOAD_DIR")
+
+# Byte budget for inferring the numerical columns of an upload from a sample, rather than a full parse, and how
+# many background validations of uploads are kept for /upload/validation/<id>
+app.config["COLUMN_SAMPLE_BYTES"] = int(os.environ.get("COLUMN_SAMPLE_BYTES", 1024 * 1024))
+app.config["VALIDATION_HISTORY"] = int(os.environ.get("VALIDATION_HISTORY", 100))
+
+# Maximum influence distance of a point in metres; grid cells further from any point are nodata
+if os.environ.get('MAX_INFLUENCE_DISTANCE') is None:
+    app.config["MAX_INFLUENCE_DISTANCE"] = None
+else:
+    app.config["MAX_INFLUENCE_DISTANCE"] = float(os.environ.get('MAX_INFLUENCE_DISTANCE'))
+    if not app.config["MAX_INFLUENCE_DISTANCE"] > 0:
+        raise ValueError(f"Invalid MAX_INFLUENCE_DISTANCE {app.config['MAX_INFLUENCE_DISTANCE']}, must be positive")
+
+# Pre-aggregate points onto cells this many times finer than the output resolution before interpolating
+if os.environ.get('THINNING') is None:
+    app.config["THINNING"] = None
+else:
+    app.config["THINNING"] = int(os.environ.get('THINNING'))
+    if app.config["THINNING"] <= 0:
+        raise ValueError(f"Invalid THINNING {app.config['THINNING']}, must be positive")
+
+# Floating point type of rendered grids ("float64" or "float32", which halves render memory)
+app.config["RENDER_PRECISION"] = os.environ.get("RENDER_PRECISION", "float64")
+
+# Directory to memory-map rendered grids in, for rasters too large to hold in memory (in memory if unset)
+app.config["MEMMAP_DIR"] = os.environ.get("MEMMAP_DIR")
+
+# Memory, in bytes, that concurrent renders may use together, and how renders over it are queued
+app.config["RENDER_MEMORY_BUDGET"] = int(os.environ.get("RENDER_MEMORY_BUDGET", 2 * 1024 ** 3))
+app.config["RENDER_QUEUE_LIMIT"] = int(os.environ.get("RENDER_QUEUE_LIMIT", 4))
+app.config["RENDER_QUEUE_TIMEOUT"] = float(os.environ.get("RENDER_QUEUE_TIMEOUT", 30))
+app.config["RENDER_RETRY_AFTER"] = int(os.environ.get("RENDER_RETRY_AFTER", 60))
+
+# Layers with more points than this get a coarse preview first, and are fully rendered in the background.
+# 0 always renders in full before responding
+app.config["PREVIEW_POINTS"] = int(os.environ.get("PREVIEW_POINTS", 20000))
+app.config["PREVIEW_SCALE"] = int(os.environ.get("PREVIEW_SCALE", 8))
+app.config["RENDER_WORKERS"] = int(os.environ.get("RENDER_WORKERS", 2))
+
+# Allow requests to ask for a cProfile/tracemalloc profile (X-Profile header or ?profile=true), and how many
+# reports are kept for /profiles/<id>
+app.config["PROFILING"] = os.environ.get("PROFILING", "false").lower() == "true"
+app.config["PROFILE_HISTORY"] = int(os.environ.get("PROFILE_HISTORY", 20))
+
+# Smallest response body, in bytes, compressed for clients accepting gzip/brotli/zstd, and the memory kept for
+# compressed variants of layer payloads
+app.config["COMPRESSION_THRESHOLD"] = int(os.environ.get("COMPRESSION_THRESHOLD", 1024))
+app.config["COMPRESSION_CACHE_BYTES"] = int(os.environ.get("COMPRESSION_CACHE_BYTES", 64 * 1024 ** 2))
+
+# Memory kept for styled layer images, keyed by layer version and style
+app.config["STYLE_CACHE_BYTES"] = int(os.environ.get("STYLE_CACHE_BYTES", 64 * 1024 ** 2))
+
+# Memory kept for decoded layer grids, reused when compositing layers
+app.config["GRID_CACHE_BYTES"] = int(os.environ.get("GRID_CACHE_BYTES", 256 * 1024 ** 2))
+
+# Import the rendering stack in the background once the server is listening, rather than on the first render
+app.config["PREWARM"] = os.environ.get("PREWARM", "false").lower() == "true"
+
 db = SQLAlchemy(app)
 migrate = Migrate(app, db)
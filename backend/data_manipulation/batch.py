@@ -0,0 +1,256 @@
+"""
+Batch rendering from a manifest.
+
+A manifest is a JSON or YAML list of jobs, or an object with "defaults" applied to every job and the "jobs":
+
+    {"defaults": {"geom": ["lat", "lon"], "thinning": 4},
+     "jobs": [{"in_fp": "trees.csv", "out_fp": "out/heights.tif", "col_weight": {"height": [1, "IDW"]}},
+              {"in_fp": "trees.csv", "out_fp": "out/density.tif", "col_weight": {"Count": [1, "Density"]}}]}
+
+Jobs of the same input file run together in one worker of a process pool, so the file is parsed once; jobs that
+also share their geometry columns and render options render through generate_raster_files, which projects and
+indexes the points once for all of them. Finished jobs are recorded in a journal next to the manifest, so
+running it again after a partial failure only renders the jobs that failed or never ran, and those whose input
+file has changed since.
+
+Usage, from the backend directory:
+    python -m data_manipulation.batch manifest.json --workers 4
+"""
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+try:
+    import yaml
+except ImportError:
+    yaml = None
+try:
+    from .generate_raster_file import generate_raster_files, read_csv_data
+except ImportError:  # Run as a script
+    from generate_raster_file import generate_raster_files, read_csv_data
+
+REQUIRED_FIELDS = ("in_fp", "out_fp", "col_weight", "geom")
+
+# Render options of a job and their defaults, see generate_raster_file
+OPTIONS = {"max_distance": None, "thinning": None, "precision": "float64", "memmap_dir": None, "res_scale": 1,
+           "bands": False}
+
+
+def load_manifest(path: str) -> list[dict]:
+    """
+    Read a manifest, filling in each job's defaults and resolving its paths against the manifest's directory.
+
+    Args:
+        path: JSON, or YAML (.yaml or .yml) manifest file
+
+    Returns:
+        The complete jobs, each named by its "name" or output file
+
+    Raises:
+        ValueError: if the manifest or one of its jobs is invalid
+    """
+    with open(path) as f:
+        if path.endswith((".yaml", ".yml")):
+            if yaml is None:
+                raise ValueError("YAML manifests need PyYAML installed, or use a JSON manifest")
+            manifest = yaml.safe_load(f)
+        else:
+            manifest = json.load(f)
+
+    defaults = {}
+    if isinstance(manifest, dict):
+        defaults = manifest.get("defaults", {})
+        manifest = manifest.get("jobs")
+    if not isinstance(manifest, list) or not isinstance(defaults, dict):
+        raise ValueError("A manifest must be a list of jobs, or an object of defaults and jobs")
+
+    base = os.path.dirname(os.path.abspath(path))
+    jobs = []
+    for i, job in enumerate(manifest):
+        if not isinstance(job, dict):
+            raise ValueError(f"Job {i} must be an object")
+        job = {**OPTIONS, **defaults, **job}
+        missing = [field for field in REQUIRED_FIELDS if field not in job]
+        unknown = set(job) - set(REQUIRED_FIELDS) - set(OPTIONS) - {"name"}
+        if missing or unknown:
+            raise ValueError(f"Job {i} is missing {missing} or has unknown fields {sorted(unknown)}")
+        if not isinstance(job["geom"], list) or len(job["geom"]) != 2:
+            raise ValueError(f"Job {i} geom must be the latitude and longitude column names")
+        for field in ("in_fp", "out_fp", "memmap_dir"):
+            if job[field] is not None:
+                job[field] = os.path.join(base, job[field])
+        job.setdefault("name", os.path.relpath(job["out_fp"], base))
+        jobs.append(job)
+    return jobs
+
+
+def job_key(job: dict) -> str:
+    """Key of a job and the current version of its input file, under which it is journaled"""
+    stat = os.stat(job["in_fp"]) if os.path.exists(job["in_fp"]) else None
+    version = None if stat is None else [stat.st_mtime_ns, stat.st_size]
+    canonical = json.dumps([job, version], sort_keys=True, separators=(",", ":"))
+    return hashlib.sha1(canonical.encode()).hexdigest()
+
+
+def read_journal(path: str) -> dict:
+    """The last journaled result of each job key, see run_batch"""
+    journal = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    journal[entry["key"]] = entry
+    return journal
+
+
+def render_jobs(in_fp: str, jobs: list[dict]) -> list[dict]:
+    """
+    Render the jobs of one input file, parsing it once. Runs in a worker process.
+
+    Args:
+        in_fp: The input csv file
+        jobs: The jobs reading it, each with its "key" (see job_key)
+
+    Returns:
+        Per job, its key, name, status ("ok" or "failed"), render seconds, point count and error, and the
+        seconds of the work it shared with the other jobs of the file ("sharedSeconds")
+    """
+    started = time.perf_counter()
+    results = []
+    try:
+        data = read_csv_data(in_fp)
+    except Exception as e:
+        return [{"key": job["key"], "name": job["name"], "status": "failed", "seconds": 0.0, "points": None,
+                 "error": f"Reading {in_fp}: {e}", "sharedSeconds": time.perf_counter() - started} for job in jobs]
+    parse_seconds = time.perf_counter() - started
+
+    # Jobs with the same geometry and options share their projected points, neighbour index and grid
+    groups = {}
+    for job in jobs:
+        options = json.dumps([job["geom"]] + [job[option] for option in OPTIONS])
+        groups.setdefault(options, []).append(job)
+
+    for group in groups.values():
+        for job in group:
+            os.makedirs(os.path.dirname(job["out_fp"]) or ".", exist_ok=True)
+        first = group[0]
+        group_started = time.perf_counter()
+        rendered = generate_raster_files(data, [(job["out_fp"], job["col_weight"]) for job in group], first["geom"],
+                                         **{option: first[option] for option in OPTIONS})
+        group_seconds = time.perf_counter() - group_started
+        if isinstance(rendered, Exception):
+            rendered = [rendered] * len(group)
+
+        render_seconds = sum(result["seconds"] for result in rendered if not isinstance(result, Exception))
+        shared_seconds = parse_seconds / len(groups) + max(group_seconds - render_seconds, 0.0)
+        for job, result in zip(group, rendered):
+            failed = isinstance(result, Exception)
+            results.append({"key": job["key"], "name": job["name"], "status": "failed" if failed else "ok",
+                            "seconds": 0.0 if failed else result["seconds"],
+                            "points": None if failed else result["points"], "error": str(result) if failed else None,
+                            "sharedSeconds": shared_seconds})
+    return results
+
+
+def run_batch(manifest_path: str, workers: int = None, journal_path: str = None, force: bool = False,
+              log=print) -> list[dict]:
+    """
+    Render the jobs of a manifest across a process pool, skipping the jobs journaled as done.
+
+    Args:
+        manifest_path: Manifest file, see load_manifest
+        workers: Worker processes (the number of CPUs if not given); 1 renders in this process
+        journal_path: Journal of finished jobs (the manifest path with ".journal" appended if not given)
+        force: Render every job, even those journaled as done
+        log: Called with a line as each input file finishes
+
+    Returns:
+        Per job, in manifest order, its result (see render_jobs); jobs skipped as done have the "skipped" status
+    """
+    jobs = load_manifest(manifest_path)
+    journal_path = journal_path or manifest_path + ".journal"
+    journal = {} if force else read_journal(journal_path)
+
+    results = {}
+    pending = {}
+    for job in jobs:
+        job["key"] = job_key(job)
+        done = journal.get(job["key"])
+        if done is not None and done["status"] == "ok" and os.path.exists(job["out_fp"]):
+            results[job["key"]] = {**done, "name": job["name"], "status": "skipped"}
+        else:
+            pending.setdefault(job["in_fp"], []).append(job)
+
+    with open(journal_path, "a") as journal_file:
+        def record(in_fp, file_results):
+            for result in file_results:
+                results[result["key"]] = result
+                journal_file.write(json.dumps(result) + "\n")
+            # Flushed per input file, so a killed batch resumes from the files it finished
+            journal_file.flush()
+            log(f"Finished {in_fp}: {sum(result['status'] == 'ok' for result in file_results)} of "
+                f"{len(file_results)} jobs ok")
+
+        if workers == 1:
+            for in_fp, file_jobs in pending.items():
+                record(in_fp, render_jobs(in_fp, file_jobs))
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = {executor.submit(render_jobs, in_fp, file_jobs): in_fp
+                           for in_fp, file_jobs in pending.items()}
+                for future in as_completed(futures):
+                    in_fp = futures[future]
+                    try:
+                        record(in_fp, future.result())
+                    except Exception as e:
+                        # The worker itself died, eg. killed for memory
+                        record(in_fp, [{"key": job["key"], "name": job["name"], "status": "failed", "seconds": 0.0,
+                                 "points": None, "error": f"Worker failed: {e!r}", "sharedSeconds": 0.0}
+                                for job in pending[in_fp]])
+
+    return [results[job["key"]] for job in jobs]
+
+
+def format_summary(results: list[dict], seconds: float) -> str:
+    """A table of each job's status and timings, with totals"""
+    width = max([len(result["name"]) for result in results] + [3])
+    lines = [f"{'job':<{width}}  {'status':<7}  {'render s':>8}  {'shared s':>8}  {'points':>9}  error"]
+    for result in results:
+        points = "" if result.get("points") is None else result["points"]
+        lines.append(f"{result['name']:<{width}}  {result['status']:<7}  {result['seconds']:>8.2f}  "
+                     f"{result['sharedSeconds']:>8.2f}  {points:>9}  {result.get('error') or ''}")
+    counts = {status: sum(result["status"] == status for result in results) for status in ("ok", "failed", "skipped")}
+    lines.append(f"{len(results)} jobs in {seconds:.1f}s: {counts['ok']} ok, {counts['failed']} failed, "
+                 f"{counts['skipped']} skipped")
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser("Renders the jobs of a JSON or YAML manifest across a process pool")
+    parser.add_argument("manifest", help="The manifest file, a list of jobs or an object of defaults and jobs",
+                        type=str)
+    parser.add_argument("--workers", help="Worker processes (defaults to the number of CPUs)", type=int,
+                        default=None)
+    parser.add_argument("--journal", help="Journal of finished jobs, to resume from (defaults to "
+                                          "<manifest>.journal)", type=str, default=None)
+    parser.add_argument("--force", help="Render every job, even those the journal records as done",
+                        action="store_true")
+    parser.add_argument("--output", help="File to write the per-job results to as json", type=str, default=None)
+    args = parser.parse_args(argv)
+
+    started = time.perf_counter()
+    results = run_batch(args.manifest, args.workers, args.journal, args.force,
+                        log=lambda line: print(line, file=sys.stderr))
+    print(format_summary(results, time.perf_counter() - started))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    return 1 if any(result["status"] == "failed" for result in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
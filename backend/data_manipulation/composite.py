@@ -0,0 +1,185 @@
+import tempfile
+import threading
+from collections import OrderedDict
+
+import numpy as np
+try:
+    from .generate_raster_file import (TILE_SIZE, grid_axes, write_raster, stream_raster, estimate_render_memory,
+                                       main_logger)
+    from .instrumentation import stage
+except ImportError:  # Run as a script
+    from generate_raster_file import (TILE_SIZE, grid_axes, write_raster, stream_raster, estimate_render_memory,
+                                      main_logger)
+    from instrumentation import stage
+
+
+class GridCache:
+    """Least recently used cache of decoded layer grids, bounded by their total size"""
+
+    def __init__(self, max_bytes: int):
+        """
+        Args:
+            max_bytes: Total size of the cached grids
+        """
+        self.max_bytes = max_bytes
+        self._size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _nbytes(rendered):
+        return rendered["grid"].nbytes + (0 if rendered.get("bands") is None else rendered["bands"].nbytes)
+
+    def get(self, key):
+        """The cached grid under key, or None"""
+        with self._lock:
+            rendered = self._entries.get(key)
+            if rendered is not None:
+                self._entries.move_to_end(key)
+            return rendered
+
+    def evict(self, match):
+        """Drop the cached grids whose key matches, a predicate of the key"""
+        with self._lock:
+            for key in [key for key in self._entries if match(key)]:
+                self._size -= self._nbytes(self._entries.pop(key))
+
+    def put(self, key, rendered):
+        """Cache a grid under key, evicting the least recently used grids over the size bound"""
+        size = self._nbytes(rendered)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._size -= self._nbytes(self._entries.pop(key))
+            self._entries[key] = rendered
+            self._size += size
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= self._nbytes(evicted)
+
+
+def composite_spec(sources):
+    """
+    Common grid of several rendered grids: the union of their extents, at the finest of their resolutions.
+
+    Args:
+        sources: Rendered grids, or their stored metadata (see grid_store.load_grid and grid_info)
+
+    Returns:
+        Tuple of the grid bounds (xmin, ymin, xmax, ymax) and its resolution in metres
+    """
+    bounds = np.array([source["bounds"] for source in sources])
+    return ((bounds[:, 0].min(), bounds[:, 1].min(), bounds[:, 2].max(), bounds[:, 3].max()),
+            min(source["res"] for source in sources))
+
+
+def estimate_composite_memory(sources, memmap=False, chunk_size=4 * TILE_SIZE):
+    """
+    Rough peak memory of composite_grid and its pixel index, for admission control.
+
+    Args:
+        sources: Stored grid metadata (see grid_store.grid_info) of the sources, all decoded and held while
+            compositing
+        memmap: Whether the grid is memory-mapped and streamed to the output
+        chunk_size: Number of columns combined at a time
+
+    Returns:
+        Estimated peak memory in bytes
+    """
+    bounds, res = composite_spec(sources)
+    xs, ys = grid_axes(bounds, res)
+    dtype = np.result_type(*(source["dtype"] for source in sources))
+    # The output grid, its write and pixel index
+    output = estimate_render_memory(0, 0, (len(xs), len(ys)), neighbours=0, precision=dtype.name, memmap=memmap)
+    # Per block, the gathered corners, interpolation temporaries and weighted copy of resample
+    block = min(len(xs), chunk_size) * len(ys) * (8 * dtype.itemsize + 1)
+    return sum(source["nbytes"] for source in sources) + output + block
+
+
+def resample(rendered, xs, ys):
+    """
+    Bilinearly sample a rendered grid at cell coordinates; cells outside its extent, or next to its nodata
+    (NaN) cells, are 0.
+
+    Args:
+        rendered: Rendered grid (see grid_store.load_grid)
+        xs: x coordinates of the cells
+        ys: y coordinates of the cells
+
+    Returns:
+        The sampled values, shaped (len(xs), len(ys))
+    """
+    grid, res = rendered["grid"], rendered["res"]
+    source_xs, source_ys = grid_axes(rendered["bounds"], res)
+    nx, ny = grid.shape
+
+    # Fractional indices of the cells in the source grid, whose axes run east and south
+    fx = (xs - source_xs[0]) / res
+    fy = (source_ys[0] - ys) / res
+    inside_x = (fx >= 0) & (fx <= nx - 1)
+    inside_y = (fy >= 0) & (fy <= ny - 1)
+    x0 = np.clip(np.floor(fx), 0, nx - 1).astype(np.int64)
+    y0 = np.clip(np.floor(fy), 0, ny - 1).astype(np.int64)
+    x1 = np.minimum(x0 + 1, nx - 1)
+    y1 = np.minimum(y0 + 1, ny - 1)
+    tx = np.clip(fx - x0, 0, 1)[:, np.newaxis].astype(grid.dtype, copy=False)
+    ty = np.clip(fy - y0, 0, 1)[np.newaxis, :].astype(grid.dtype, copy=False)
+
+    top = grid[np.ix_(x0, y0)] * (1 - tx) + grid[np.ix_(x1, y0)] * tx
+    bottom = grid[np.ix_(x0, y1)] * (1 - tx) + grid[np.ix_(x1, y1)] * tx
+    values = top * (1 - ty) + bottom * ty
+    np.nan_to_num(values, copy=False)
+    values *= inside_x[:, np.newaxis] & inside_y[np.newaxis, :]
+    return values
+
+
+def composite_grid(sources, weights, out_fp, memmap_dir=None, chunk_size=4 * TILE_SIZE):
+    """
+    Combine rendered grids into a weighted sum on their common grid and write it as a GeoTIFF.
+    Each source is normalized by its maximum first, as it is displayed, so weights compare layers
+    rather than their units, and their nodata cells add nothing. The sum is built in blocks of
+    columns, so only the output grid is held in full besides the sources.
+
+    Args:
+        sources: Rendered grids (see grid_store.load_grid)
+        weights: Weight of each source
+        out_fp: File path or BytesIO to write the GeoTIFF to
+        memmap_dir: If set, the grid is an np.memmap in this directory (see generate_raster_file)
+        chunk_size: Number of columns combined at a time
+
+    Returns:
+        The rendered grid (see grid_store.dump_grid); composites have no points or neighbour radius
+    """
+    bounds, res = composite_spec(sources)
+    xs, ys = grid_axes(bounds, res)
+    dtype = np.result_type(*(source["grid"].dtype for source in sources))
+    main_logger.info(f"Compositing {len(sources)} layers onto a {len(xs)}x{len(ys)} grid")
+
+    # Normalizing is folded into the weights
+    scales = []
+    for source, weight in zip(sources, weights):
+        maximum = np.fmax.reduce(source["grid"], axis=None)
+        scales.append(weight / maximum if maximum and np.isfinite(maximum) else 0.0)
+
+    if memmap_dir is None:
+        grid = np.zeros((len(xs), len(ys)), dtype=dtype)
+    else:
+        # The backing file is unlinked as soon as it is created, and freed with the memmap
+        grid = np.memmap(tempfile.TemporaryFile(dir=memmap_dir), dtype=dtype, mode="w+", shape=(len(xs), len(ys)))
+
+    with stage("composite"):
+        for start in range(0, len(xs), chunk_size):
+            end = min(start + chunk_size, len(xs))
+            for source, scale in zip(sources, scales):
+                if scale:
+                    grid[start:end] += resample(source, xs[start:end], ys) * dtype.type(scale)
+
+    if memmap_dir is None:
+        stats = write_raster(grid, bounds, res, out_fp)
+    else:
+        stats = stream_raster(grid, bounds, res, out_fp, memmap_dir)
+
+    tile_radius = np.zeros((-(-len(xs) // TILE_SIZE), -(-len(ys) // TILE_SIZE)), dtype=dtype)
+    return {"grid": grid, "bounds": bounds, "res": res, "tile_size": TILE_SIZE, "tile_radius": tile_radius,
+            "max_distance": None, "thinning": None, "points_in": 0, "points": 0, "stats": stats}
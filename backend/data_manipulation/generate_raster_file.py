@@ -3,18 +3,36 @@ import pandas as pd
 import scipy.interpolate
 import xarray as xr
 import rioxarray
+import rasterio
 import argparse
+import contextlib
 import json
+import logging
 import math
+import os
+import tempfile
+import time
 import numpy as np
-import gc
 import csv
 from shapely.geometry import Point
+from rasterio.io import MemoryFile
+from rasterio.transform import from_origin
+from rasterio.vrt import WarpedVRT
+from rasterio.windows import Window
 from sklearn.neighbors import KDTree
 from typing import Literal
 from io import BytesIO
-# from config import main_logger
-## Need to figure out how to incorporate logging again
+try:
+    from .instrumentation import stage, timed
+    from .profiling import profiled
+    from .raster_stats import RasterStats
+except ImportError:  # Run as a script
+    from instrumentation import stage, timed
+    from profiling import profiled
+    from raster_stats import RasterStats
+
+# Not the app's logger, so this module can be used without Flask; records reach the app's handlers
+main_logger = logging.getLogger(__name__)
 
 
 def y2lat(y, R):
@@ -66,8 +84,203 @@ def mercator(coord: tuple[float, float] | tuple[float, str], inverse=False) -> t
             elif coord[1] == "y":
                 return y2lat(coord[0], _radius)
 
+# Number of nearest points combined into each IDW / Density cell
+MAX_NEIGHBOURS = 50
+
+# Upper bound on the side length, in bins, of an occupancy grid
+OCCUPANCY_BINS = 1024
+
+
+def build_occupancy(points, max_distance):
+    """
+    Bin points into a coarse occupancy grid, to find cells with no point within max_distance without a
+    neighbour query. Bins are at least max_distance wide, so any point within max_distance of a cell
+    lies in the cell's bin or one of its 8 neighbours; each bin is marked if any of those are occupied.
+
+    Args:
+        points: Array of coordinate points
+        max_distance: Maximum influence distance of a point, positive
+
+    Returns:
+        Tuple of the grid origin, bin size and dilated boolean occupancy grid
+    """
+    if not max_distance > 0:
+        raise ValueError(f"max_distance must be positive, got {max_distance}")
+    extent = np.ptp(points, axis=0).max()
+    size = max(max_distance, extent / OCCUPANCY_BINS)
+    origin = points.min(axis=0) - size
+    bins = ((points - origin) // size).astype(np.int64)
+    counts = np.zeros(tuple(bins.max(axis=0) + 2), dtype=np.int64)
+    np.add.at(counts, (bins[:, 0], bins[:, 1]), 1)
+
+    occupied = counts > 0
+    dilated = occupied.copy()
+    for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+            dilated[max(dx, 0):dilated.shape[0] + min(dx, 0), max(dy, 0):dilated.shape[1] + min(dy, 0)] |= \
+                occupied[max(-dx, 0):occupied.shape[0] + min(-dx, 0), max(-dy, 0):occupied.shape[1] + min(-dy, 0)]
+    return origin, size, dilated
+
+
+def near_data(occupancy, cells):
+    """
+    Test which cells may have a point within the maximum influence distance.
+
+    Args:
+        occupancy: Occupancy grid from build_occupancy
+        cells: (n, 2) array of cell coordinates
+
+    Returns:
+        Boolean mask of the cells that need a neighbour query
+    """
+    origin, size, dilated = occupancy
+    bins = ((cells - origin) // size).astype(np.int64)
+    inside = (bins >= 0).all(axis=1) & (bins < dilated.shape).all(axis=1)
+    mask = np.zeros(len(cells), dtype=bool)
+    mask[inside] = dilated[bins[inside, 0], bins[inside, 1]]
+    return mask
+
+
+def neighbour_scratch(rows, k, dtype=np.float64):
+    """
+    Allocate the scratch buffers reused by neighbour_kernel for every chunk of up to rows cells.
+
+    Args:
+        rows: Maximum number of cells per chunk
+        k: Number of neighbours per cell
+        dtype: Floating point type of the weights and values
+
+    Returns:
+        Tuple of the (rows, k) weight, value and mask buffers and the (rows,) sum and result buffers
+    """
+    return (np.empty((rows, k), dtype=dtype), np.empty((rows, k), dtype=dtype), np.empty((rows, k), dtype=bool),
+            np.empty(rows, dtype=dtype), np.empty(rows, dtype=dtype))
+
+
+def neighbour_kernel(type_, distances, indices, values, power, scratch, out, max_distance=None):
+    """
+    Combine each cell's neighbours into its value with in-place operations on preallocated buffers.
+    IDW takes the mean of the neighbours' values weighted by 1/d^power, Density their sum weighted by 1/d.
+
+    Args:
+        type_: "IDW" or "Density"
+        distances: (n, k) distances from each cell to its neighbours, closest first
+        indices: (n, k) indices of each cell's neighbours
+        values: Values at each point
+        power: Power parameter for IDW
+        scratch: Buffers from neighbour_scratch, with at least n rows
+        out: (n,) array the cell values are written to
+        max_distance: Maximum influence distance of a point; further neighbours get no weight, and cells
+            with no neighbour this close are nodata (NaN)
+    """
+    n = len(distances)
+    weights, gathered, within, sums = (buffer[:n] for buffer in scratch[:4])
+
+    np.maximum(distances, 1e-10, out=weights)  # Small non-zero distance for div by zero
+    if type_ == "IDW" and power == 2:
+        np.multiply(weights, weights, out=weights)
+    elif type_ == "IDW" and power != 1:
+        np.power(weights, power, out=weights)
+    np.reciprocal(weights, out=weights)
+    if max_distance is not None:
+        np.less_equal(distances, max_distance, out=within)
+        np.multiply(weights, within, out=weights)
+
+    np.take(values, indices, out=gathered)
+    np.multiply(gathered, weights, out=gathered)
+    np.sum(gathered, axis=1, out=out)
+
+    if type_ == "IDW":
+        # Cells without any weighted neighbour have a numerator of 0, and stay at 0
+        np.sum(weights, axis=1, out=sums)
+        np.maximum(sums, np.finfo(sums.dtype).tiny, out=sums)
+        np.divide(out, sums, out=out)
+
+        # Cells on a data point take its value, or the mean of the points sharing its coordinates
+        if distances[:, 0].min() == 0:
+            hits = np.flatnonzero(distances[:, 0] == 0)
+            coincident = distances[hits] == 0
+            out[hits] = np.sum(values[indices[hits]] * coincident, axis=1) / np.sum(coincident, axis=1)
+
+    if max_distance is not None:
+        # The closest neighbour is the first
+        out[distances[:, 0] > max_distance] = np.nan
+
+
+def neighbour_interpolate(points, columns, grid_x, grid_y, power=2, max_neighbours=MAX_NEIGHBOURS, chunk_size=10000,
+                          tree=None, radius_out=None, max_distance=None, occupancy=None):
+    """
+    Interpolate several value columns from each cell's k nearest neighbours, querying the
+    neighbours of each cell once for all columns.
+
+    Args:
+        points: Array of coordinate points
+        columns: List of (values, type_) pairs, type_ being "IDW" or "Density"
+        grid_x, grid_y, power, max_neighbours, chunk_size, tree, radius_out, max_distance, occupancy:
+            see interpolate
+
+    Returns:
+        List of the interpolated values of each column, in its floating point type, flattened
+    """
+    if tree is None:
+        with stage("index"):
+            tree = KDTree(points)
+        main_logger.debug("\t\tKDTree Created")
+
+    grid_points = np.column_stack((grid_x.ravel(), grid_y.ravel()))
+    main_logger.debug("\t\tGrid points Created")
+
+    k = min(max_neighbours, len(points))
+
+    if max_distance is not None and occupancy is None:
+        occupancy = build_occupancy(points, max_distance)
+
+    dtypes = [values.dtype if np.issubdtype(values.dtype, np.floating) else np.dtype(np.float64)
+              for values, _ in columns]
+    # Cells skipped as far from any data are nodata
+    fill = 0 if max_distance is None else np.nan
+    interpolated = [np.full(len(grid_points), fill, dtype=dtype) for dtype in dtypes]
+    scratches = {dtype: neighbour_scratch(min(chunk_size, len(grid_points)), k, dtype) for dtype in set(dtypes)}
+    for i in range(0, len(grid_points), chunk_size):
+        end_idx = min(i + chunk_size, len(grid_points))
+        chunk_points = grid_points[i:end_idx]
+
+        # Cells far from any data are skipped without a query
+        near = None
+        if occupancy is not None:
+            near = near_data(occupancy, chunk_points)
+            if radius_out is not None:
+                radius_out.reshape(-1)[i:end_idx][~near] = max_distance
+            chunk_points = chunk_points[near]
+            if len(chunk_points) == 0:
+                continue
+
+        with stage("query"):
+            distances, indices = tree.query(chunk_points, k=k)
+        if radius_out is not None:
+            radius = distances[:, -1] if max_distance is None else np.minimum(distances[:, -1], max_distance)
+            if near is None:
+                radius_out.reshape(-1)[i:end_idx] = radius
+            else:
+                radius_out.reshape(-1)[i:end_idx][near] = radius
+        main_logger.debug(f"\t\tProcessed chunk {i//chunk_size + 1}/{(len(grid_points)-1)//chunk_size + 1}")
+
+        with stage("combine"):
+            for (values, type_), dtype, out in zip(columns, dtypes, interpolated):
+                scratch = scratches[dtype]
+                if near is None:
+                    neighbour_kernel(type_, distances, indices, values, power, scratch, out[i:end_idx],
+                                     max_distance)
+                else:
+                    result = scratch[4][:len(distances)]
+                    neighbour_kernel(type_, distances, indices, values, power, scratch, result, max_distance)
+                    out[i:end_idx][near] = result
+    return interpolated
+
+
 def interpolate(points, values, grid_x, grid_y, type_: Literal["Linear", "IDW", "Nearest", "Density"] ="IDW", power=2,
-                max_neighbours=50, chunk_size=10000):
+                max_neighbours=MAX_NEIGHBOURS, chunk_size=10000, tree=None, radius_out=None, max_distance=None,
+                occupancy=None):
     """
     Perform spatial Interpolation.
 
@@ -80,59 +293,43 @@ def interpolate(points, values, grid_x, grid_y, type_: Literal["Linear", "IDW",
         power: Power parameter for IDW (default=2)
         max_neighbours: Maximum number of neighbours to consider
         chunk_size: Size of chunks for processing large grids
+        tree: Prebuilt KDTree over points, shared between calls (IDW and Density only)
+        radius_out: Optional array shaped like grid_x, filled with the distance to each
+            cell's furthest considered neighbour (IDW and Density only)
+        max_distance: Maximum influence distance of a point; cells with no point this close
+            are nodata, NaN (IDW and Density only)
+        occupancy: Prebuilt occupancy grid for max_distance, see build_occupancy
 
     Returns:
-        Interpolated values on the grid
+        Interpolated values on the grid, in the floating point type of values
     """
 
     try:
         if type_ == "IDW" or type_ == "Density":
-            tree = KDTree(points)
-            # main_logger.info("\t\tKDTree Created")
-
-            grid_points = np.column_stack((grid_x.ravel(), grid_y.ravel()))
-            # main_logger.info("\t\tGrid points Created")
-
-            k = min(max_neighbours, len(points))
-
-            interpolated_values = np.zeros(len(grid_points))
-            for i in range(0, len(grid_points), chunk_size):
-                end_idx = min(i + chunk_size, len(grid_points))
-                chunk_points = grid_points[i:end_idx]
-
-                distances, indices = tree.query(chunk_points, k=k)
-                # main_logger.info(f"\t\tProcessed chunk {i//chunk_size + 1}/{(len(grid_points)-1)//chunk_size + 1}")
-
-                if type_ == "IDW":
-                    distances = np.maximum(distances, 1e-10) # Small non-zero distance for div by zero
-                    weights = 1.0 / (distances ** power)
-                    interpolated_chunk = np.sum(weights * values[indices], axis=1) / np.sum(weights, axis=1)
-                else:
-                    distances = np.maximum(distances, 1e-10)
-                    weights = 1.0 / distances
-                    interpolated_chunk = np.sum(weights * values[indices], axis=1)
-
-                interpolated_values[i:end_idx] = interpolated_chunk
-
-                del distances, indices, chunk_points
-                if i % (5 * chunk_size) == 0:
-                    gc.collect()  # Force garbage collection periodically
+            interpolated_values, = neighbour_interpolate(points, [(values, type_)], grid_x, grid_y, power,
+                                                         max_neighbours, chunk_size, tree, radius_out, max_distance,
+                                                         occupancy)
 
         else:
             type_ = type_.lower()
-            # main_logger.info("\t\tUsing scipy griddata")
+            main_logger.debug("\t\tUsing scipy griddata")
 
-            interpolated_values = scipy.interpolate.griddata(points, values, (grid_x, grid_y), type_, fill_value=0)
+            with stage("griddata"):
+                interpolated_values = scipy.interpolate.griddata(points, values, (grid_x, grid_y), type_,
+                                                                 fill_value=0)
 
             ####### REMOVE BELOW THING IF STILL DOESNT WORK #######
             interpolated_values = interpolated_values.ravel()
+            if np.issubdtype(values.dtype, np.floating):
+                interpolated_values = interpolated_values.astype(values.dtype, copy=False)
 
         return interpolated_values.reshape(grid_x.shape)
     except Exception as e:
-        # main_logger.info(f"Interpolation error: {e}")
+        main_logger.error(f"Interpolation error: {e}")
         return None
 
 
+@timed("sniff")
 def detect_delimiter(file_obj, num_bytes=4096):
     """
     Detect the delimiter used in a CSV file.
@@ -167,136 +364,795 @@ def detect_delimiter(file_obj, num_bytes=4096):
         return max(delimiter_counts, key=delimiter_counts.get)
 
 
-def generate_raster_file(in_fp, out_fp, col_weight, geom):
-    # main_logger.info("generate_raster_file Started")
+def read_csv_data(in_fp):
+    """
+    Read a csv file into a DataFrame, detecting its delimiter and encoding.
+
+    Args:
+        in_fp: File path, or file object in bytes
+
+    Returns:
+        DataFrame of the csv contents
+    """
+    if isinstance(in_fp, str):
+        with open(in_fp, 'rb') as f:
+            return read_csv_data(f)
 
     # Detect delimiter
     delimiter = detect_delimiter(in_fp)
-    # main_logger.info(f"Detected delimiter: {repr(delimiter)}")
+    main_logger.info(f"Detected delimiter: {repr(delimiter)}")
 
     # Load data
     encodings = ['utf-8', 'utf-16', 'utf-16-be', 'utf-16-le', 'latin-1', 'iso-8859-1']
     data = None
 
-    for encoding in encodings:
-        try:
-            in_fp.seek(0)
-            data = pd.read_csv(in_fp, sep=delimiter, encoding=encoding, engine='python')
-            # main_logger.info(f"Successfully read CSV with encoding: {encoding}")
-            break
-        except (UnicodeError, UnicodeDecodeError):
-            continue
-        except Exception as e:
-            # main_logger.debug(f"Failed with encoding {encoding}: {e}")
-            continue
+    with stage("parse"):
+        for encoding in encodings:
+            try:
+                in_fp.seek(0)
+                data = pd.read_csv(in_fp, sep=delimiter, encoding=encoding, engine='python')
+                main_logger.info(f"Successfully read CSV with encoding: {encoding}")
+                break
+            except (UnicodeError, UnicodeDecodeError):
+                continue
+            except Exception as e:
+                main_logger.debug(f"Failed with encoding {encoding}: {e}")
+                continue
 
     if data is None:
         raise ValueError("Unable to read CSV file with any supported encoding")
+    return data
 
-    try:
-        points = []
-
-        # Clean up data
-        df = data[data[geom[0]].notnull()]
-        df = df[df[geom[1]].notnull()]
-        df = df.drop(df[df[geom[1]] == 0.0].index)
-        df = df.drop(df[df[geom[0]] == 0.0].index)
-
-        if "Count" in col_weight.keys():
-            df["Count"] = [1 for _ in range(df[list(df.columns)[0]].size)]
-
-        # Convert geographic coordinates to Mercator points
-        for i, row in df.iterrows():
-            point = Point(mercator((row[geom[1]], row[geom[0]])))
-            points.append(point)
-
-        # Create GeoDataFrame
-        df['geometry'] = points
-        gdf = gpd.GeoDataFrame(df, geometry="geometry", crs="EPSG:4326")
-        # main_logger.info("\tcreated and stored GeoDF")
-        # Extract coordinates and values
-        coords = np.column_stack((gdf.geometry.x, gdf.geometry.y))
-
-        # Compute weighted values
-        cols_weights = {}
-        for key in col_weight:
-
-            keys = list(col_weight.keys())
-            if isinstance(col_weight[key][0], float):
-                val = col_weight[key][0]
-            else:
-                val = float(col_weight[key][0])
-            weighted_values = df[key].values * val
-            cols_weights[key] = weighted_values
 
+# Side length, in cells, of the tiles that appended points can invalidate
+TILE_SIZE = 256
 
-        # Define grid for interpolation
-        xmin, ymin, xmax, ymax = gdf.total_bounds
-
-        # Calculate area and adjust resolution dynamically
-        area = (xmax - xmin) * (ymax - ymin)
-        # Adjust resolution based on area size
-        if area > 1e10:  # Very large area
-            res = 500
-        elif area > 1e9:
-            res = 250
+
+@timed("project")
+def project_points(data, geom):
+    """
+    Clean point rows and project them to Mercator.
+
+    Args:
+        data: DataFrame of the points
+        geom: Names of the latitude and longitude columns
+
+    Returns:
+        Tuple of the cleaned DataFrame and its (n, 2) Mercator coordinates
+    """
+    points = []
+
+    # Clean up data
+    df = data[data[geom[0]].notnull()]
+    df = df[df[geom[1]].notnull()]
+    df = df.drop(df[df[geom[1]] == 0.0].index)
+    df = df.drop(df[df[geom[0]] == 0.0].index)
+
+    # Convert geographic coordinates to Mercator points
+    for i, row in df.iterrows():
+        point = Point(mercator((row[geom[1]], row[geom[0]])))
+        points.append(point)
+
+    # Create GeoDataFrame
+    df['geometry'] = points
+    gdf = gpd.GeoDataFrame(df, geometry="geometry", crs="EPSG:4326")
+    main_logger.info("\tcreated and stored GeoDF")
+    # Extract coordinates
+    coords = np.column_stack((gdf.geometry.x, gdf.geometry.y))
+    return df, coords
+
+
+def weight_columns(df, col_weight, precision="float64"):
+    """
+    Weight the value columns of cleaned point rows.
+
+    Args:
+        df: Cleaned DataFrame of the points, see project_points
+        col_weight: Mapping of column name to [weight, interpolation type]; "Count" weights
+            every point, whether or not the data has such a column
+        precision: Floating point type of the weighted values
+
+    Returns:
+        Mapping of column name to weighted values
+    """
+    cols_weights = {}
+    for key in col_weight:
+        if isinstance(col_weight[key][0], float):
+            val = col_weight[key][0]
         else:
-            res = 100
+            val = float(col_weight[key][0])
+        values = np.ones(len(df)) if key == "Count" else df[key].values
+        weighted_values = values * val
+        cols_weights[key] = weighted_values.astype(precision, copy=False)
+    return cols_weights
+
+
+def load_points(data, col_weight, geom, precision="float64"):
+    """
+    Clean point rows, project them to Mercator and weight their value columns.
+
+    Args:
+        data: DataFrame of the points
+        col_weight: Mapping of column name to [weight, interpolation type]
+        geom: Names of the latitude and longitude columns
+        precision: Floating point type of the weighted values; coordinates are always float64
+
+    Returns:
+        Tuple of the (n, 2) Mercator coordinates and a mapping of column name to weighted values
+    """
+    df, coords = project_points(data, geom)
+    return coords, weight_columns(df, col_weight, precision)
+
+
+@timed("thin")
+def thin_points(coords, cols_weights, col_weight, cell_size, counts=None):
+    """
+    Pre-aggregate points onto a sub-pixel grid, merging every point in a cell (duplicates included)
+    into one point at the cell centre. Density columns are summed, other columns are averaged.
+
+    Args:
+        coords: (n, 2) array of Mercator coordinates
+        cols_weights: Mapping of column name to weighted values
+        col_weight: Mapping of column name to [weight, interpolation type]
+        cell_size: Side length of the aggregation cells in metres
+        counts: Number of points each point already aggregates, so aggregates can be thinned again
+            with new points; 1 each if None
+
+    Returns:
+        Tuple of the aggregated coordinates, weighted values and number of points aggregated into each
+    """
+    # Cells are aligned on the Mercator origin, so the same point always lands in the same cell
+    cells = np.floor(coords / cell_size).astype(np.int64)
+    cells -= cells.min(axis=0)
+    keys = cells[:, 0] * (cells[:, 1].max() + 1) + cells[:, 1]
+    _, first, inverse, thinned_counts = np.unique(keys, return_index=True, return_inverse=True,
+                                                  return_counts=True)
+    if counts is not None:
+        thinned_counts = np.bincount(inverse, weights=counts, minlength=len(first)).astype(np.int64)
+
+    thinned_coords = (np.floor(coords[first] / cell_size) + 0.5) * cell_size
+    thinned_weights = {}
+    for key in col_weight:
+        if col_weight[key][1] == "Density":
+            sums = np.bincount(inverse, weights=cols_weights[key], minlength=len(first))
+        else:
+            # Averages of aggregates are weighted by their point counts
+            values = cols_weights[key] if counts is None else cols_weights[key] * counts
+            sums = np.bincount(inverse, weights=values, minlength=len(first)) / thinned_counts
+        thinned_weights[key] = sums.astype(cols_weights[key].dtype, copy=False)
+    return thinned_coords, thinned_weights, thinned_counts
+
+
+def grid_spec(coords):
+    """
+    Define the interpolation grid around a set of Mercator points.
+
+    Args:
+        coords: (n, 2) array of Mercator coordinates
+
+    Returns:
+        Tuple of the grid bounds (xmin, ymin, xmax, ymax) and its resolution in metres
+    """
+    xmin, ymin = coords.min(axis=0)
+    xmax, ymax = coords.max(axis=0)
+
+    # Calculate area and adjust resolution dynamically
+    area = (xmax - xmin) * (ymax - ymin)
+    # Adjust resolution based on area size
+    if area > 1e10:  # Very large area
+        res = 500
+    elif area > 1e9:
+        res = 250
+    else:
+        res = 100
+
+    return (xmin, ymin, xmax, ymax), res
+
+
+def grid_axes(bounds, res):
+    """Cell coordinates along x (west to east) and y (north to south) of a grid."""
+    xmin, ymin, xmax, ymax = bounds
+    return np.arange(xmin, xmax, res), np.arange(ymax, ymin, -res)
+
+
+def uses_neighbours(col_weight):
+    """Whether every column is interpolated from its k nearest neighbours (IDW or Density)."""
+    return all(col_weight[key][1] in ("IDW", "Density") for key in col_weight)
+
+
+def render_block(coords, cols_weights, col_weight, xs, ys, tree=None, max_distance=None, occupancy=None,
+                 precision="float64", bands_out=None):
+    """
+    Interpolate the weighted sum of all columns over a block of the grid. Columns interpolated
+    from neighbours (IDW and Density) share one neighbour query per cell.
+
+    Args:
+        coords: (n, 2) array of Mercator coordinates
+        cols_weights: Mapping of column name to weighted values
+        col_weight: Mapping of column name to [weight, interpolation type]
+        xs: x coordinates of the block's cells
+        ys: y coordinates of the block's cells
+        tree: Prebuilt KDTree over coords
+        max_distance: Maximum influence distance of a point
+        occupancy: Prebuilt occupancy grid for max_distance
+        precision: Floating point type of the block
+        bands_out: Optional array shaped (len(col_weight), len(xs), len(ys)), filled with each
+            column's interpolated values, in col_weight order
+
+    Returns:
+        Tuple of the interpolated block, shaped (len(xs), len(ys)), and the neighbour radius of each cell
+    """
+    grid_x, grid_y = np.meshgrid(xs, ys, indexing="ij")
+    block = np.zeros(grid_x.shape, dtype=precision)
+    radius = np.zeros(grid_x.shape, dtype=precision)
+
+    neighbour_keys = [key for key in col_weight if col_weight[key][1] in ("IDW", "Density")]
+    interpolated = {}
+    if neighbour_keys:
+        columns = [(cols_weights[key], col_weight[key][1]) for key in neighbour_keys]
+        values = neighbour_interpolate(coords, columns, grid_x, grid_y, tree=tree, radius_out=radius,
+                                       max_distance=max_distance, occupancy=occupancy)
+        interpolated.update(zip(neighbour_keys, (value.reshape(grid_x.shape) for value in values)))
+
+    for i, key in enumerate(col_weight):
+        if key not in interpolated:
+            interpolated[key] = interpolate(coords, cols_weights[key], grid_x, grid_y, col_weight[key][1])
+        block += interpolated[key]
+        if bands_out is not None:
+            bands_out[i] = interpolated[key]
+    return block, radius
+
+
+def tile_maximum(block, tile_size=TILE_SIZE):
+    """Maximum of a block over each tile_size x tile_size tile, padding partial edge tiles."""
+    nx, ny = block.shape
+    tx, ty = -(-nx // tile_size), -(-ny // tile_size)
+    padded = np.zeros((tx * tile_size, ty * tile_size), dtype=block.dtype)
+    padded[:nx, :ny] = block
+    return padded.reshape(tx, tile_size, ty, tile_size).max(axis=(1, 3))
+
+
+# Approximate bytes per output pixel of the pixel json index built after a render, and per band: its text,
+# encoded a window at a time, and the copy of it that is stored
+PIXEL_JSON_BYTES = 85
+BAND_JSON_BYTES = 70
+
+# Approximate peak bytes of parsing a csv and its columnar copy, per byte of the file. The python parser holds
+# the rows as strings before converting them to columns
+PARSE_BYTES_PER_BYTE = 10
+
+
+def estimate_parse_memory(size):
+    """Rough peak memory, in bytes, of parsing a csv file of size bytes with read_csv_data, for admission control"""
+    return size * PARSE_BYTES_PER_BYTE
+
+
+def estimate_grid_shape(data, geom, bounds=None):
+    """
+    Shape of the grid a render of data would interpolate, from its coordinate extent alone.
 
-        # Process in chunks to reduce memory usage
-        chunk_size = 1000  # Adjust based on your system's memory
-        x_chunks = np.array_split(np.arange(xmin, xmax, res), (xmax - xmin) // (res * chunk_size) + 1)
+    Args:
+        data: DataFrame of the points
+        geom: Names of the latitude and longitude columns
+        bounds: Mercator bounds (xmin, ymin, xmax, ymax) of points already rendered, that the
+            grid also covers, as when appending
 
-        interpolated_grid_full = []
+    Returns:
+        Tuple of the number of cells along x and y
+    """
+    lat, lng = data[geom[0]], data[geom[1]]
+    valid = lat.notnull() & lng.notnull() & (lat != 0.0) & (lng != 0.0)
+    lat, lng = lat[valid], lng[valid]
+    corners = [mercator((lng.min(), lat.min())), mercator((lng.max(), lat.max()))]
+    if bounds is not None:
+        corners += [bounds[:2], bounds[2:]]
+    corners = np.array(corners)
+    bounds, res = grid_spec(corners)
+    xs, ys = grid_axes(bounds, res)
+    return len(xs), len(ys)
 
-        for x_chunk in x_chunks:
-            x_start, x_end = x_chunk[0], x_chunk[-1] + res
-            grid_x_chunk, grid_y_chunk = np.mgrid[x_start:x_end:res, ymax:ymin:-res]
 
-            # Perform interpolation on this chunk
-            interpolated_chunk = np.zeros_like(grid_x_chunk)
-            for key in col_weight:
-                interpolated_chunk += interpolate(coords, cols_weights[key], grid_x_chunk, grid_y_chunk,
-                                                  col_weight[key][1])
+def estimate_render_memory(rows, columns, shape, neighbours=MAX_NEIGHBOURS, precision="float64", memmap=False,
+                           layers=1, bands=0):
+    """
+    Rough peak memory of a render and its pixel index, for admission control.
 
-            interpolated_grid_full.append(interpolated_chunk)
+    Args:
+        rows: Number of points
+        columns: Number of columns in the parsed data
+        shape: Grid shape, see estimate_grid_shape
+        neighbours: Number of neighbours per cell
+        precision: Floating point type of the render
+        memmap: Whether the grid is memory-mapped and streamed to the output
+        layers: Number of layers rendered together from the points (see generate_raster_files),
+            whose grids and pixel indexes are all held until they are stored
+        bands: Number of per-column bands rendered alongside each grid
+
+    Returns:
+        Estimated peak memory in bytes
+    """
+    itemsize = np.dtype(precision).itemsize
+    nx, ny = shape
+    cells = nx * ny
 
-        # Combine chunks
-        interpolated_grid = np.hstack(interpolated_grid_full)
+    # Parsed frame, projected coordinates, weighted values and KDTree
+    points = rows * (columns * 8 + 2 * 8 + columns * itemsize + 4 * 8)
+    # Full grid and bands, then per chunk the cell coordinates, block and radius
+    grid = 0 if memmap else cells * itemsize * (1 + bands)
+    block = min(nx, 4 * TILE_SIZE) * ny * (4 * 8 + 2 * itemsize)
+    # Neighbour query results and kernel scratch buffers
+    query = 10000 * neighbours * (8 + 8 + 2 * itemsize + 1)
+    # Normalized, reprojected and float32 copies of the grid and bands
+    write = 0 if memmap else cells * (2 * itemsize + 4) * (1 + bands)
+    return points + layers * (grid + cells * (PIXEL_JSON_BYTES + bands * BAND_JSON_BYTES)) + block + query + write
 
 
+# Description of the first band of a multi-band raster, the normalized sum of the columns
+COMBINED_BAND = "combined"
+
+
+def band_names(col_weight):
+    """Descriptions of the per-column bands of a multi-band raster, in col_weight order."""
+    return [f"{key} {col_weight[key][1]}" for key in col_weight]
+
+
+def data_range(grid):
+    """Minimum and maximum of a grid's cells with data, ignoring nodata (NaN) cells; NaN if there are none"""
+    return np.fmin.reduce(grid, axis=None), np.fmax.reduce(grid, axis=None)
+
+
+def write_raster(grid, bounds, res, out_fp, bands=None, names=None):
+    """
+    Normalize an interpolated Mercator grid, reproject it to WGS 84 and write it as a GeoTIFF.
+    NaN cells are nodata: they are left out of the statistics and written as the GeoTIFF's nodata.
+
+    Args:
+        grid: Interpolated grid, shaped (x, y), in float32 or float64
+        bounds: Grid bounds (xmin, ymin, xmax, ymax)
+        res: Grid resolution in metres
+        out_fp: File path or BytesIO to write the GeoTIFF to
+        bands: Optional per-column grids, shaped (columns, x, y), written unnormalized as bands
+            after the normalized grid
+        names: Descriptions of the per-column bands, see band_names
+
+    Returns:
+        Statistics of the grid, see raster_stats.RasterStats
+    """
+    xs, ys = grid_axes(bounds, res)
+
+    with stage("reproject"):
         # Find max value and normalize
-        maximum = np.max(interpolated_grid)
-        interpolated_grid = interpolated_grid / maximum
+        minimum, maximum = data_range(grid)
+        interpolated_grid = grid / grid.dtype.type(maximum)
+
+        with stage("stats"):
+            stats = RasterStats(minimum, maximum)
+            stats.add(interpolated_grid)
 
         # Create xarray DataArray
-        da = xr.DataArray(
-            interpolated_grid,
-        dims=["x", "y"],
-            coords={"y": np.arange(ymax, ymin, -res), "x": np.arange(xmin, xmax, res)}
-        )
-        # main_logger.info("\t created dataarray")
+        if bands is None:
+            da = xr.DataArray(
+                interpolated_grid,
+            dims=["x", "y"],
+                coords={"y": ys, "x": xs}
+            )
+        else:
+            da = xr.DataArray(
+                np.concatenate([interpolated_grid[np.newaxis], bands.astype(grid.dtype, copy=False)]),
+                dims=["band", "x", "y"],
+                coords={"band": np.arange(1, len(bands) + 2), "y": ys, "x": xs},
+                attrs={"long_name": (COMBINED_BAND, *names)}
+            )
+        main_logger.info("\t created dataarray")
 
         # Transpose dimensions to match raster format expectations
-        da = da.transpose('y', 'x')
+        da = da.transpose(..., 'y', 'x')
 
 
         # Convert to raster dataset
         raster = da.rio.write_crs("EPSG:3857").rio.set_spatial_dims(x_dim="x", y_dim="y", inplace=True)
+        raster = raster.rio.write_nodata(np.nan, encoded=False)
         raster = raster.rio.reproject("EPSG:4326")
 
-        # Write to file
+    # Write to file
+    with stage("encode_geotiff"):
         if isinstance(out_fp, BytesIO):
             # with out_fp as buffer:
-            raster.astype('float32').rio.to_raster(out_fp, driver='GTiff', compress="LDZ")
+            raster.astype('float32', copy=False).rio.to_raster(out_fp, driver='GTiff', compress="LZW")
             out_fp.seek(0)
-            # main_logger.info(f"\tRaster file saved to {out_fp}")
+            main_logger.info(f"\tRaster file saved to {out_fp}")
+        else:
+            raster.astype('float32', copy=False).rio.to_raster(f"{out_fp}", driver='GTiff', compress="LZW")
+            main_logger.info(f"\tRaster file saved to {out_fp}.tif")
+    return stats.result()
+
+
+@timed("reproject")
+def stream_raster(grid, bounds, res, out_fp, workdir=None, window_size=TILE_SIZE, bands=None, names=None):
+    """
+    Normalize, reproject and write a grid window by window, so neither the normalized nor the
+    reprojected raster is ever held in memory in full. Gives the same GeoTIFF as write_raster.
+
+    Args:
+        grid: Interpolated grid, shaped (x, y), typically an np.memmap
+        bounds: Grid bounds (xmin, ymin, xmax, ymax)
+        res: Grid resolution in metres
+        out_fp: File path or BytesIO to write the GeoTIFF to
+        workdir: Directory of the intermediate Mercator GeoTIFF, the system default if None
+        window_size: Number of columns, then rows, written at a time
+        bands: Optional per-column grids, shaped (columns, x, y), see write_raster
+        names: Descriptions of the per-column bands, see band_names
+
+    Returns:
+        Statistics of the grid, see raster_stats.RasterStats
+    """
+    xs, ys = grid_axes(bounds, res)
+    nx, ny = grid.shape
+
+    # Find min and max values, reading the grid one window at a time
+    minimum, maximum = np.nan, np.nan
+    for start in range(0, nx, window_size):
+        low, high = data_range(grid[start:start + window_size])
+        minimum, maximum = np.fmin(minimum, low), np.fmax(maximum, high)
+
+    # Nested in reproject, as in write_raster
+    with stage("stats"):
+        stats = RasterStats(minimum, maximum)
+        for start in range(0, nx, window_size):
+            stats.add(grid[start:start + window_size] / maximum)
+
+    with tempfile.TemporaryDirectory(dir=workdir) as tmp:
+        mercator_fp = os.path.join(tmp, "mercator.tif")
+        count = 1 if bands is None else len(bands) + 1
+        profile = {"driver": "GTiff", "dtype": "float32", "width": nx, "height": ny, "count": count,
+                   "crs": "EPSG:3857", "transform": from_origin(xs[0] - res / 2, ys[0] + res / 2, res, res),
+                   "nodata": np.nan, "tiled": True, "blockxsize": window_size, "blockysize": window_size}
+        with rasterio.open(mercator_fp, "w", **profile) as mercator:
+            for start in range(0, nx, window_size):
+                end = min(start + window_size, nx)
+                window = Window(start, 0, end - start, ny)
+                mercator.write((grid[start:end].T / maximum).astype('float32', copy=False), 1, window=window)
+                for band in range(1, count):
+                    mercator.write(bands[band - 1, start:end].T.astype('float32', copy=False), band + 1,
+                                   window=window)
+
+        with rasterio.open(mercator_fp) as mercator, WarpedVRT(mercator, crs="EPSG:4326", nodata=np.nan) as vrt:
+            profile = {"driver": "GTiff", "dtype": "float32", "width": vrt.width, "height": vrt.height,
+                       "count": count, "crs": vrt.crs, "transform": vrt.transform, "nodata": np.nan,
+                       "compress": "LZW"}
+            memfile = MemoryFile() if isinstance(out_fp, BytesIO) else None
+            with (memfile.open(**profile) if memfile is not None else rasterio.open(f"{out_fp}", "w", **profile)) \
+                    as dst:
+                if bands is not None:
+                    for band, name in enumerate((COMBINED_BAND, *names), start=1):
+                        dst.set_band_description(band, name)
+                for start in range(0, vrt.height, window_size):
+                    window = Window(0, start, vrt.width, min(window_size, vrt.height - start))
+                    dst.write(vrt.read(window=window), window=window)
+
+            if memfile is not None:
+                memfile.seek(0)
+                out_fp.write(memfile.read())
+                out_fp.seek(0)
+                memfile.close()
+    return stats.result()
+
+
+def render_grid(coords, cols_weights, col_weight, bounds, res, out_fp, tree=None, max_distance=None,
+                occupancy=None, precision="float64", memmap_dir=None, bands=False):
+    """
+    Interpolate weighted point columns over a whole grid, chunk by chunk, and write it as a GeoTIFF.
+
+    Args:
+        coords: (n, 2) array of Mercator coordinates
+        cols_weights: Mapping of column name to weighted values
+        col_weight: Mapping of column name to [weight, interpolation type]
+        bounds: Grid bounds (xmin, ymin, xmax, ymax)
+        res: Grid resolution in metres
+        out_fp: File path or BytesIO to write the GeoTIFF to
+        tree: Prebuilt KDTree over coords
+        max_distance: Maximum influence distance of a point
+        occupancy: Prebuilt occupancy grid for max_distance
+        precision: Floating point type of the grid
+        memmap_dir: If set, the grid is an np.memmap in this directory (see generate_raster_file)
+        bands: Whether to also write each column as its own band (see generate_raster_file)
+
+    Returns:
+        The rendered grid, without its point counts (see generate_raster_file)
+    """
+    xs, ys = grid_axes(bounds, res)
+
+    # Process in chunks of whole tiles to reduce memory usage
+    chunk_size = 4 * TILE_SIZE  # Adjust based on your system's memory
+    if memmap_dir is None:
+        interpolated_grid = np.zeros((len(xs), len(ys)), dtype=precision)
+        band_grid = np.zeros((len(col_weight), len(xs), len(ys)), dtype=precision) if bands else None
+    else:
+        # The backing files are unlinked as soon as they are created, and freed with the memmaps
+        interpolated_grid = np.memmap(tempfile.TemporaryFile(dir=memmap_dir), dtype=precision, mode="w+",
+                                      shape=(len(xs), len(ys)))
+        band_grid = np.memmap(tempfile.TemporaryFile(dir=memmap_dir), dtype=precision, mode="w+",
+                              shape=(len(col_weight), len(xs), len(ys))) if bands else None
+    tile_radius = np.zeros((-(-len(xs) // TILE_SIZE), -(-len(ys) // TILE_SIZE)), dtype=precision)
+
+    for start in range(0, len(xs), chunk_size):
+        end = min(start + chunk_size, len(xs))
+
+        # Perform interpolation on this chunk
+        interpolated_grid[start:end], radius = render_block(
+            coords, cols_weights, col_weight, xs[start:end], ys, tree, max_distance, occupancy, precision,
+            None if band_grid is None else band_grid[:, start:end])
+        tile_radius[start // TILE_SIZE:-(-end // TILE_SIZE)] = tile_maximum(radius)
+
+    names = band_names(col_weight) if bands else None
+    if memmap_dir is None:
+        stats = write_raster(interpolated_grid, bounds, res, out_fp, band_grid, names)
+    else:
+        stats = stream_raster(interpolated_grid, bounds, res, out_fp, memmap_dir, bands=band_grid, names=names)
+
+    return {"grid": interpolated_grid, "bounds": bounds, "res": res, "tile_size": TILE_SIZE,
+            "tile_radius": tile_radius, "max_distance": max_distance, "bands": band_grid, "band_names": names,
+            "stats": stats}
+
+
+def generate_raster_files(in_fp, specs, geom, max_distance=None, thinning=None,
+                          precision: Literal["float64", "float32"] = "float64", memmap_dir=None, res_scale=1,
+                          bands=False):
+    """
+    Render several layers from the same points. The points are parsed and projected once, and
+    every layer shares the grid, the neighbour index and the occupancy grid.
+
+    Args:
+        in_fp: csv file path or file object, or an already parsed DataFrame
+        specs: List of (out_fp, col_weight) pairs, one per layer
+        geom: Names of the latitude and longitude columns
+        max_distance, thinning, precision, memmap_dir, res_scale, bands: see generate_raster_file
+
+    Returns:
+        A list with, per spec, its rendered grid (see generate_raster_file) with the seconds its render
+        took ("seconds"), or the exception its render failed with; or the exception the shared stages failed with
+    """
+    main_logger.info(f"generate_raster_files Started, {len(specs)} layers")
+    if isinstance(in_fp, pd.DataFrame):
+        data = in_fp
+    else:
+        data = read_csv_data(in_fp)
+
+    try:
+        if thinning is not None and thinning <= 0:
+            raise ValueError(f"thinning must be positive, got {thinning}")
+        if max_distance is not None and not max_distance > 0:
+            raise ValueError(f"max_distance must be positive, got {max_distance}")
+        df, projected = project_points(data, geom)
+
+        # Define grid for interpolation
+        bounds, res = grid_spec(projected)
+        res = res * res_scale
+        points_in = len(projected)
+    except Exception as e:
+        main_logger.error("%s, must fix in code", e, exc_info=e)
+        return e
+
+    # Thinning merges the same points into the same cells whatever their values, so the
+    # thinned coordinates, and the index and occupancy grid over them, are shared too
+    tree = None
+    occupancy = None
+    results = []
+    for out_fp, col_weight in specs:
+        started = time.perf_counter()
+        try:
+            coords, cols_weights, counts = projected, weight_columns(df, col_weight, precision), None
+            if thinning:
+                coords, cols_weights, counts = thin_points(coords, cols_weights, col_weight, res / thinning)
+                main_logger.info(f"\tThinned {points_in} points to {len(coords)}")
+
+            # One neighbour index serves every layer, every column and every chunk
+            if tree is None and any(col_weight[key][1] in ("IDW", "Density") for key in col_weight):
+                with stage("index"):
+                    tree = KDTree(coords)
+            if occupancy is None and max_distance is not None:
+                occupancy = build_occupancy(coords, max_distance)
+
+            rendered = render_grid(coords, cols_weights, col_weight, bounds, res, out_fp, tree, max_distance,
+                                   occupancy, precision, memmap_dir, bands)
+            rendered.update({"thinning": thinning, "points_in": points_in, "points": len(coords),
+                             "coords": coords, "values": cols_weights, "counts": counts,
+                             "seconds": time.perf_counter() - started})
+            results.append(rendered)
+        except Exception as e:
+            main_logger.error("%s, must fix in code", e, exc_info=e)
+            results.append(e)
+    return results
+
+
+def generate_raster_file(in_fp, out_fp, col_weight, geom, max_distance=None, thinning=None,
+                         precision: Literal["float64", "float32"] = "float64", memmap_dir=None, res_scale=1,
+                         bands=False):
+    """
+    Interpolate weighted point columns onto a grid and write it as a GeoTIFF.
+
+    Args:
+        in_fp: csv file path or file object, or an already parsed DataFrame
+        out_fp: File path or BytesIO to write the GeoTIFF to
+        col_weight: Mapping of column name to [weight, interpolation type]
+        geom: Names of the latitude and longitude columns
+        max_distance: Maximum influence distance of a point, in metres, positive. Cells with no
+            point this close are nodata (NaN in the grid, and the GeoTIFF's nodata value), and
+            those far from any point are not interpolated at all
+        thinning: If set, a positive factor; points are pre-aggregated onto cells this many times
+            finer than the output resolution before indexing (see thin_points)
+        precision: Floating point type of the weighted values, neighbour weights and grid from
+            ingest to output. float32 halves their memory; coordinates stay float64
+        memmap_dir: If set, the grid is an np.memmap in this directory that chunks are written
+            into, and the GeoTIFF is streamed from it window by window (see stream_raster)
+        res_scale: Multiplier of the grid resolution step, for coarser renders
+        bands: If set, each column's interpolated values are also written, unnormalized, as their
+            own band after the normalized sum, computed in the same pass (see band_names)
+
+    Returns:
+        The rendered grid (see grid_store.dump_grid), so it can be updated in place later,
+        with the point counts before ("points_in") and after ("points") thinning, the
+        interpolated points ("coords", "values" and, if thinned, "counts", see thin_points),
+        and the grid's statistics ("stats", see raster_stats.RasterStats)
+    """
+    main_logger.info("generate_raster_file Started")
+    results = generate_raster_files(in_fp, [(out_fp, col_weight)], geom, max_distance, thinning, precision,
+                                    memmap_dir, res_scale, bands)
+    return results if isinstance(results, Exception) else results[0]
+
+
+# Points sampled, and resolution step multiplier, of a preview render
+PREVIEW_POINTS = 20000
+PREVIEW_SCALE = 8
+
+
+def render_preview(data, out_fp, col_weight, geom, points=PREVIEW_POINTS, res_scale=PREVIEW_SCALE, **options):
+    """
+    Render a coarse preview of a layer from a random sample of its points, to show while the
+    full render runs. The sample is seeded, so the same data always gives the same preview.
+
+    Args:
+        data: DataFrame of the points
+        out_fp: File path or BytesIO to write the GeoTIFF to
+        col_weight: Mapping of column name to [weight, interpolation type]
+        geom: Names of the latitude and longitude columns
+        points: Number of points sampled
+        res_scale: Multiplier of the full render's resolution step
+        **options: Further options of generate_raster_file
+
+    Returns:
+        The rendered preview grid, see generate_raster_file
+    """
+    if len(data) > points:
+        data = data.sample(n=points, random_state=0)
+    return generate_raster_file(data, out_fp, col_weight, geom, res_scale=res_scale, **options)
+
+
+def append_raster_file(data, new_data, out_fp, col_weight, geom, rendered, memmap_dir=None):
+    """
+    Add new points to a rendered layer, re-interpolating only the tiles they can affect.
+
+    A cell's value only depends on its k nearest points, so a new point can only change
+    cells closer to it than their current furthest neighbour. Tiles are skipped unless a
+    new point lies within their largest neighbour radius. Points outside the current
+    grid, or columns not interpolated from neighbours, fall back to a full render.
+
+    Only the new points are projected: they are added to the points stored with the grid,
+    and only the points within reach of the dirty tiles are indexed.
+
+    Args:
+        data: DataFrame of the points already in the layer, or a function returning it, only
+            called for a full render or if the grid was stored without its points
+        new_data: DataFrame of the points to add
+        out_fp: File path or BytesIO to write the GeoTIFF to
+        col_weight: Mapping of column name to [weight, interpolation type]
+        geom: Names of the latitude and longitude columns
+        rendered: Grid returned by the layer's last render (see grid_store.load_grid), whose
+            max_distance, thinning, precision, bands and points are reused
+        memmap_dir: If set, the GeoTIFF is streamed window by window (see stream_raster), and
+            full renders use a memory-mapped grid (see generate_raster_file)
+
+    Returns:
+        The updated grid, with the number of re-interpolated tiles under "dirty_tiles"
+    """
+    precision = rendered["grid"].dtype.name
+    thinning = rendered["thinning"]
+    stored = rendered.get("coords") is not None and list(rendered["values"]) == list(col_weight)
+
+    try:
+        new_df, new_coords = project_points(new_data, geom)
+        xmin, ymin, xmax, ymax = rendered["bounds"]
+        inside = (len(new_coords) > 0 and new_coords[:, 0].min() >= xmin and new_coords[:, 0].max() <= xmax
+                  and new_coords[:, 1].min() >= ymin and new_coords[:, 1].max() <= ymax)
+
+        if inside and stored:
+            new_weights = weight_columns(new_df, col_weight, precision)
+            coords = np.concatenate([rendered["coords"], new_coords])
+            cols_weights = {key: np.concatenate([rendered["values"][key], new_weights[key]]) for key in col_weight}
+            points_in = rendered["points_in"] + len(new_coords)
+            counts = None
+            if thinning:
+                # New points act from their cell centres, where their cell's aggregate may also change
+                cell_size = rendered["res"] / thinning
+                new_coords, _, _ = thin_points(new_coords, {}, {}, cell_size)
+                counts = np.concatenate([rendered["counts"], np.ones(len(new_df), dtype=np.int64)])
+                coords, cols_weights, counts = thin_points(coords, cols_weights, col_weight, cell_size, counts)
+    except Exception as e:
+        return e
+
+    # With fewer points than neighbours, every cell already uses every point
+    if not inside or not stored or not uses_neighbours(col_weight) or rendered["points"] < MAX_NEIGHBOURS:
+        merged = pd.concat([data() if callable(data) else data, new_data], ignore_index=True)
+        result = generate_raster_file(merged, out_fp, col_weight, geom, rendered["max_distance"], thinning,
+                                      precision, memmap_dir, bands=rendered.get("bands") is not None)
+        if not isinstance(result, Exception):
+            result["dirty_tiles"] = result["tile_radius"].size
+        return result
+
+    try:
+        bounds, res, tile_size = rendered["bounds"], rendered["res"], rendered["tile_size"]
+        max_distance = rendered["max_distance"]
+        grid, tile_radius = rendered["grid"], rendered["tile_radius"]
+        bands, names = rendered.get("bands"), rendered.get("band_names")
+        xs, ys = grid_axes(bounds, res)
+
+        # Distance from each tile's extent to its closest new point
+        tiles_x, tiles_y = np.indices(tile_radius.shape)
+        left = xs[0] + tiles_x * tile_size * res
+        right = xs[0] + np.minimum((tiles_x + 1) * tile_size - 1, len(xs) - 1) * res
+        top = ys[0] - tiles_y * tile_size * res
+        bottom = ys[0] - np.minimum((tiles_y + 1) * tile_size - 1, len(ys) - 1) * res
+        dirty = np.zeros(tile_radius.shape, dtype=bool)
+        for x, y in new_coords:
+            dx = np.maximum(np.maximum(left - x, x - right), 0)
+            dy = np.maximum(np.maximum(bottom - y, y - top), 0)
+            dirty |= np.hypot(dx, dy) <= tile_radius
+
+        # New points only bring a cell's neighbours closer, so they all lie within its tile's radius,
+        # padded by a cell against its rounding
+        reach = np.zeros(len(coords), dtype=bool)
+        for tx, ty in zip(*np.nonzero(dirty)):
+            margin = tile_radius[tx, ty] + res
+            reach |= ((coords[:, 0] >= left[tx, ty] - margin) & (coords[:, 0] <= right[tx, ty] + margin)
+                      & (coords[:, 1] >= bottom[tx, ty] - margin) & (coords[:, 1] <= top[tx, ty] + margin))
+        if np.count_nonzero(reach) < MAX_NEIGHBOURS:
+            reach[:] = True
+        local_coords = coords[reach]
+        local_weights = {key: values[reach] for key, values in cols_weights.items()}
+        with stage("index"):
+            tree = KDTree(local_coords)
+        occupancy = build_occupancy(local_coords, max_distance) if max_distance is not None else None
+
+        for tx, ty in zip(*np.nonzero(dirty)):
+            x_slice = slice(tx * tile_size, (tx + 1) * tile_size)
+            y_slice = slice(ty * tile_size, (ty + 1) * tile_size)
+            grid[x_slice, y_slice], radius = render_block(
+                local_coords, local_weights, col_weight, xs[x_slice], ys[y_slice], tree, max_distance, occupancy,
+                precision, None if bands is None else bands[:, x_slice, y_slice])
+            tile_radius[tx, ty] = radius.max()
+
+        if memmap_dir is None:
+            stats = write_raster(grid, bounds, res, out_fp, bands, names)
         else:
-            raster.astype('float32').rio.to_raster(f"{out_fp}", driver='GTiff', compress="LDZ")
-            # main_logger.info(f"\tRaster file saved to {out_fp}.tif")
+            stats = stream_raster(grid, bounds, res, out_fp, memmap_dir, bands=bands, names=names)
+
+        return {"grid": grid, "bounds": bounds, "res": res, "tile_size": tile_size, "tile_radius": tile_radius,
+                "max_distance": max_distance, "thinning": thinning, "points_in": points_in, "points": len(coords),
+                "coords": coords, "values": cols_weights, "counts": counts, "dirty_tiles": int(dirty.sum()),
+                "bands": bands, "band_names": names, "stats": stats}
     except Exception as e:
         return e
-        # main_logger.error("%s, must fix in code", e, exc_info=e)
+
+
+def positive(type_):
+    """Command line argument type of positive numbers of type_"""
+    def parse(value):
+        number = type_(value)
+        if not number > 0:
+            raise argparse.ArgumentTypeError(f"must be positive, got {value}")
+        return number
+    return parse
+
 
 if __name__ == "__main__":
     # Set up command line argument parser
@@ -310,6 +1166,36 @@ if __name__ == "__main__":
     parser.add_argument("geom",
                         help="The names of the geometry columns, in degrees WGS_84 (eg. \"lat_col\" \"long_col\" ",
                         type=str, nargs=2)
+    parser.add_argument("--thinning",
+                        help="Pre-aggregate points onto cells this many times finer than the output resolution",
+                        type=positive(int), default=None)
+    parser.add_argument("--precision", help="Floating point type used from ingest to output",
+                        choices=["float64", "float32"], default="float64")
+    parser.add_argument("--memmap-dir",
+                        help="Keep the grid in a memory-mapped file in this directory and stream the output from it",
+                        type=str, default=None)
+    parser.add_argument("--max-distance",
+                        help="Maximum influence distance of a point in metres; cells further from any point are nodata",
+                        type=positive(float), default=None)
+    parser.add_argument("--bands", help="Also write each column as its own band, after their normalized sum",
+                        action="store_true")
+    parser.add_argument("--profile",
+                        help="Profile the render with cProfile and tracemalloc, and write the report as json to this "
+                             "file (stdout if no file is given)",
+                        type=str, nargs="?", const="-", default=None)
     args = parser.parse_args()
 
-    generate_raster_file(args.in_fp, args.out_fp, json.loads(args.col_weight), args.geom)
\ No newline at end of file
+    with (profiled() if args.profile else contextlib.nullcontext({})) as report:
+        rendered = generate_raster_file(args.in_fp, args.out_fp, json.loads(args.col_weight), args.geom,
+                                        args.max_distance, args.thinning, args.precision, args.memmap_dir,
+                                        bands=args.bands)
+    if args.profile == "-":
+        print(json.dumps(report, indent=2))
+    elif args.profile:
+        with open(args.profile, "w") as f:
+            json.dump(report, f, indent=2)
+    if isinstance(rendered, Exception):
+        raise rendered
+    if args.thinning:
+        print(f"Thinned {rendered['points_in']} points to {rendered['points']} "
+              f"({rendered['points_in'] / rendered['points']:.1f}x reduction)")
\ No newline at end of file
@@ -1,9 +1,16 @@
 from PIL import Image
 import rasterio
+from rasterio.io import MemoryFile
+from rasterio.windows import Window
 import json
+import math
 from typing import *
 from io import BytesIO, StringIO
 import io
+try:
+    from .instrumentation import timed
+except ImportError:  # Run as a script
+    from instrumentation import timed
 
 
 def get_pixel_val(img: Image, x: int, y: int) -> float:
@@ -17,6 +24,24 @@ def set_pixel_val(img: Image, x: int, y: int, val = float | tuple[float, float,
     return img
 
 
+def first_band(dataset) -> BytesIO:
+    """The first band of an open multi-band raster, as a single band GeoTIFF PIL can open"""
+    profile = dataset.profile
+    profile.update(count=1)
+    with MemoryFile() as memfile:
+        with memfile.open(**profile) as dst:
+            dst.write(dataset.read(1), 1)
+        return BytesIO(memfile.read())
+
+
+def raster_bounds(fp: str | BytesIO) -> tuple[float, float, float, float]:
+    """The extent (west, south, east, north) of a raster, read from its header"""
+    if isinstance(fp, BytesIO):
+        fp.seek(0)
+    with rasterio.open(fp) as dataset:
+        return tuple(float(bound) for bound in dataset.bounds)
+
+
 def img_to_pixel(img_path: str | BytesIO):
     val_dict = {}
     if isinstance(img_path, BytesIO):
@@ -25,6 +50,13 @@ def img_to_pixel(img_path: str | BytesIO):
         dataset = rasterio.open(img_path)
     print(dataset.bounds)
 
+    # Values of the per-column bands after the first, named by their descriptions
+    bands = None
+    if dataset.count > 1:
+        bands = dataset.read()[1:]
+        names = [name or f"band {i}" for i, name in enumerate(dataset.descriptions[1:], start=2)]
+        img_path = first_band(dataset)
+
     val_dict["lbound"] = dataset.bounds[0]
     val_dict["bbound"] = dataset.bounds[1]
     val_dict["rbound"] = dataset.bounds[2]
@@ -35,24 +67,80 @@ def img_to_pixel(img_path: str | BytesIO):
     val_dict["sizex"] = w
     val_dict["sizey"] = h
 
+    # Nodata (NaN) cells are null, as JSON has no NaN
     for x in range(w):
         for y in range(h):
-            val_dict[f"{x},{y}"] = {"name": get_pixel_val(im, x, y)}
+            value = get_pixel_val(im, x, y)
+            val_dict[f"{x},{y}"] = {"name": None if math.isnan(value) else value}
+            if bands is not None:
+                val_dict[f"{x},{y}"]["bands"] = {name: None if math.isnan(band[y, x]) else float(band[y, x])
+                                                 for name, band in zip(names, bands)}
     return val_dict
 
+# Cells of a raster read, and encoded into its pixel index, at a time
+PIXEL_WINDOW_CELLS = 16384
+
+
+def _json_value(value: float) -> str:
+    """A cell value as json.dump writes it, nodata (NaN) as null"""
+    return "null" if math.isnan(value) else repr(value)
+
+
+def iter_pixel_json(img_path: str | BytesIO, window_cells: int = PIXEL_WINDOW_CELLS) -> Iterator[str]:
+    """
+    The pixel index of img_to_pixel as JSON text, in pieces encoded a window of columns at a time,
+    so neither the raster nor the index is ever held in full.
+
+    Args:
+        img_path: File path or BytesIO of the GeoTIFF
+        window_cells: Number of cells read and encoded at a time
+
+    Returns:
+        Iterator of pieces of the same JSON text json.dump writes of img_to_pixel
+    """
+    if isinstance(img_path, BytesIO):
+        img_path.seek(0)
+    with rasterio.open(img_path) as dataset:
+        w, h = dataset.width, dataset.height
+        names = [json.dumps(name or f"band {i}") for i, name in enumerate(dataset.descriptions[1:], start=2)]
+        header = {"lbound": dataset.bounds[0], "bbound": dataset.bounds[1], "rbound": dataset.bounds[2],
+                  "tbound": dataset.bounds[3], "sizex": w, "sizey": h}
+        yield json.dumps(header)[:-1]
+
+        step = max(window_cells // max(h, 1), 1)
+        for start in range(0, w, step):
+            width = min(step, w - start)
+            # Per band, per column, the values down the column
+            columns = dataset.read(window=Window(start, 0, width, h)).transpose(0, 2, 1).tolist()
+            pieces = []
+            for i in range(width):
+                for y, value in enumerate(columns[0][i]):
+                    if names:
+                        bands = ", ".join(f"{name}: {_json_value(band[i][y])}"
+                                          for name, band in zip(names, columns[1:]))
+                        pieces.append(f', "{start + i},{y}": {{"name": {_json_value(value)}, "bands": {{{bands}}}}}')
+                    else:
+                        pieces.append(f', "{start + i},{y}": {{"name": {_json_value(value)}}}')
+            yield "".join(pieces)
+        yield "}"
+
+
+@timed("encode_index")
 def write_pix_json(fp: str, out_fp = None):
+    # The index is written as it is encoded, a window of the raster at a time
     if not out_fp:
         for i, x in enumerate(fp):
             if x == "." and not fp[i+1] == "/":
                 new_fp = fp[:i]
         with open(f"{new_fp}_pix.json", 'w') as f:
-            json.dump(img_to_pixel(fp), f)
+            f.writelines(iter_pixel_json(fp))
     elif isinstance(out_fp, StringIO):
-        json.dump(img_to_pixel(fp), out_fp)
+        out_fp.writelines(iter_pixel_json(fp))
     else:
         with open(out_fp, 'w') as f:
-            json.dump(img_to_pixel(fp), f)
+            f.writelines(iter_pixel_json(fp))
 
+@timed("encode_png")
 def convert_to_alpha(fp: str | BytesIO, replace: Literal[True] | str=True, out_fp = None):
     if isinstance(replace, bool):
         new_fp = fp
@@ -62,18 +150,25 @@ def convert_to_alpha(fp: str | BytesIO, replace: Literal[True] | str=True, out_f
             if x == "." and not fp[i + 1] == "/":
                 new_fp = fp[:i] + replace
                 suffix = fp[i:]
-    if isinstance(fp, BytesIO):
-        image = Image.open(fp)
-    else:
-        image = Image.open(fp+suffix)
+    source = fp if isinstance(fp, BytesIO) else fp + suffix
+    if isinstance(source, BytesIO):
+        source.seek(0)
+    # PIL only opens single band float rasters, so multi-band ones are drawn from their first band
+    with rasterio.open(source) as dataset:
+        if dataset.count > 1:
+            source = first_band(dataset)
+    if isinstance(source, BytesIO):
+        source.seek(0)
+    image = Image.open(source)
 
     format = image.format
     print("FORMAT:", format)
     w, h = image.size
+    # Nodata (NaN) cells are fully transparent
     for x in range(w):
         for y in range(h):
             color = get_pixel_val(image, x, y)
-            image.putpixel((x, y), color*255)
+            image.putpixel((x, y), 0 if math.isnan(color) else color*255)
     image = image.convert("LA")
     for x in range(w):
         for y in range(h):
@@ -0,0 +1,122 @@
+import tempfile
+import zipfile
+
+import numpy as np
+from io import BytesIO
+
+# Bytes of an array compressed at a time, so memory-mapped grids are never read in full
+WINDOW_BYTES = 4 * 1024 ** 2
+
+
+def write_npz(file, arrays: dict, window_bytes: int = WINDOW_BYTES):
+    """
+    Write arrays as a compressed npz, as np.savez_compressed does, compressing each a window at a time.
+
+    Args:
+        file: File object to write to
+        arrays: Mapping of name to array
+        window_bytes: Bytes of an array compressed at a time
+    """
+    with zipfile.ZipFile(file, "w", compression=zipfile.ZIP_DEFLATED, allowZip64=True) as npz:
+        for name, array in arrays.items():
+            array = np.asarray(array, order="C")
+            with npz.open(f"{name}.npy", "w", force_zip64=True) as member:
+                np.lib.format.write_array_header_1_0(member, np.lib.format.header_data_from_array_1_0(array))
+                flat = array.reshape(-1)
+                step = max(window_bytes // max(array.itemsize, 1), 1)
+                for start in range(0, flat.size, step):
+                    member.write(memoryview(flat[start:start + step]).cast("B"))
+
+
+def dump_grid(rendered: dict, workdir=None) -> bytes:
+    """
+    Serialize a rendered grid, as returned by generate_raster_file, into compressed bytes.
+
+    Args:
+        rendered: Rendered grid, with the render metadata needed to update it in place
+        workdir: If set, the npz is written to a temporary file in this directory and read back
+            once, so a memory-mapped grid is stored holding only a window of it and the result
+
+    Returns:
+        The grid in compressed npz bytes
+    """
+    # Per-column bands are only stored for multi-band renders
+    bands = {}
+    if rendered.get("bands") is not None:
+        bands = {"bands": rendered["bands"], "band_names": np.asarray(rendered["band_names"])}
+    # The interpolated points are stored for appends, which only project and add the new ones. Composites have none
+    points = {}
+    if rendered.get("coords") is not None:
+        points = {"coords": rendered["coords"], "values": np.stack(list(rendered["values"].values())),
+                  "value_names": np.asarray(list(rendered["values"])), "points_in": rendered["points_in"]}
+        if rendered.get("counts") is not None:
+            points["counts"] = rendered["counts"]
+    arrays = {"grid": rendered["grid"], "bounds": np.asarray(rendered["bounds"]), "res": rendered["res"],
+              "tile_size": rendered["tile_size"], "tile_radius": rendered["tile_radius"],
+              "max_distance": np.nan if rendered["max_distance"] is None else rendered["max_distance"],
+              "thinning": rendered["thinning"] or 0, "points": rendered["points"], **bands, **points}
+    if workdir is None:
+        buffer = BytesIO()
+        write_npz(buffer, arrays)
+        return buffer.getvalue()
+    with tempfile.TemporaryFile(dir=workdir) as file:
+        write_npz(file, arrays)
+        file.seek(0)
+        return file.read()
+
+
+def load_grid(data: bytes, points: bool = True) -> dict:
+    """
+    Deserialize a rendered grid stored by dump_grid.
+
+    Args:
+        data: The grid in compressed npz bytes
+        points: Whether to decode the interpolated points too, which only appends need
+
+    Returns:
+        Rendered grid, with the render metadata needed to update it in place. The points ("coords",
+        "values" and "counts") are None if not decoded, or if the grid was stored without them
+    """
+    with np.load(BytesIO(data)) as npz:
+        max_distance = npz["max_distance"].item()
+        stored = {"coords": None, "values": None, "counts": None}
+        if points and "coords" in npz:
+            stored = {"coords": npz["coords"], "values": dict(zip(npz["value_names"].tolist(), npz["values"])),
+                      "counts": npz["counts"] if "counts" in npz else None, "points_in": int(npz["points_in"])}
+        return {**stored, "grid": npz["grid"], "bounds": tuple(npz["bounds"].tolist()), "res": npz["res"].item(),
+                "tile_size": int(npz["tile_size"]), "tile_radius": npz["tile_radius"],
+                "max_distance": None if np.isnan(max_distance) else max_distance,
+                "thinning": int(npz["thinning"]) or None, "points": int(npz["points"]),
+                "bands": npz["bands"] if "bands" in npz else None,
+                "band_names": npz["band_names"].tolist() if "band_names" in npz else None}
+
+
+def _array_header(npz, name):
+    """Shape and dtype of an array in an npz, from its npy header, without decompressing the array"""
+    with npz.zip.open(f"{name}.npy") as file:
+        version = np.lib.format.read_magic(file)
+        if version == (1, 0):
+            shape, _, dtype = np.lib.format.read_array_header_1_0(file)
+        else:
+            shape, _, dtype = np.lib.format.read_array_header_2_0(file)
+    return shape, dtype
+
+
+def grid_info(data: bytes) -> dict:
+    """
+    Read the extent, dtype and decoded size of a grid stored by dump_grid, without decoding the grid.
+
+    Args:
+        data: The grid in compressed npz bytes
+
+    Returns:
+        Dict of the grid's bounds, res, dtype, and nbytes, the size of its grid and bands once decoded
+    """
+    with np.load(BytesIO(data)) as npz:
+        shape, dtype = _array_header(npz, "grid")
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        if "bands" in npz:
+            bands_shape, bands_dtype = _array_header(npz, "bands")
+            nbytes += int(np.prod(bands_shape)) * bands_dtype.itemsize
+        return {"bounds": tuple(npz["bounds"].tolist()), "res": npz["res"].item(), "dtype": dtype,
+                "nbytes": nbytes}
@@ -0,0 +1,133 @@
+import bisect
+import functools
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+instrumentation_logger = logging.getLogger(__name__)
+
+# Upper bounds of the default duration buckets, in seconds
+TIME_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+# Upper bounds of the default size buckets, in bytes
+SIZE_BUCKETS = (1024, 10 * 1024, 100 * 1024, 1024 ** 2, 10 * 1024 ** 2, 100 * 1024 ** 2, 1024 ** 3)
+
+
+class Histogram:
+    """
+    A Prometheus histogram: per label set, cumulative bucket counts with the sum and count of observations.
+    """
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=TIME_BUCKETS):
+        """
+        Parameters:
+                name (str): metric name
+                documentation (str): help text of the metric
+                labelnames (tuple): names of the labels every observation is made with
+                buckets (tuple): increasing upper bounds of the buckets; +Inf is always added
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labelvalues):
+        """Record one observation, with one value per label name"""
+        if len(labelvalues) != len(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {labelvalues}")
+        labelvalues = tuple(str(label) for label in labelvalues)
+        with self._lock:
+            series = self._series.get(labelvalues)
+            if series is None:
+                series = self._series[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+
+    def expose(self):
+        """The metric in the Prometheus text exposition format, as a list of lines"""
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = sorted((labels, list(counts), total) for labels, (counts, total) in self._series.items())
+        for labelvalues, counts, total in series:
+            labels = [f'{name}="{_escape(value)}"' for name, value in zip(self.labelnames, labelvalues)]
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                bucket_labels = ",".join(labels + [f'le="{le}"'])
+                lines.append(f"{self.name}_bucket{{{bucket_labels}}} {cumulative}")
+            suffix = f"{{{','.join(labels)}}}" if labels else ""
+            lines.append(f"{self.name}_sum{suffix} {total}")
+            lines.append(f"{self.name}_count{suffix} {cumulative}")
+        return lines
+
+
+def _escape(value: str) -> str:
+    """Escape a label value for the text exposition format"""
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Registry:
+    """A set of metrics exposed together"""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def histogram(self, name: str, documentation: str, labelnames=(), buckets=TIME_BUCKETS) -> Histogram:
+        """Create and register a histogram, or return the one already registered under name"""
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = Histogram(name, documentation, labelnames, buckets)
+            return self._metrics[name]
+
+    def expose(self) -> str:
+        """All metrics in the Prometheus text exposition format"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "".join(line + "\n" for metric in metrics for line in metric.expose())
+
+
+# Registry of every metric in the process
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.histogram("raster_stage_seconds",
+                                   "Time spent in each stage of reading, rendering and storing a layer",
+                                   ["stage"])
+
+# Objects notified of every stage, with enter_stage(name) and exit_stage(name, elapsed) methods
+stage_listeners = []
+
+
+@contextmanager
+def stage(name: str):
+    """
+    Time a block as one observation of a stage.
+        Parameters:
+                name (str): stage name, the stage label of raster_stage_seconds
+    """
+    for listener in list(stage_listeners):
+        listener.enter_stage(name)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.observe(elapsed, name)
+        instrumentation_logger.debug(f"Stage {name} took {elapsed:.4f}s")
+        for listener in list(stage_listeners):
+            listener.exit_stage(name, elapsed)
+
+
+def timed(name: str):
+    """Decorator timing every call of a function as one observation of a stage"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,118 @@
+import cProfile
+import pstats
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+try:
+    from .instrumentation import stage_listeners
+except ImportError:  # Run as a script
+    from instrumentation import stage_listeners
+
+# Only one profile can run at a time, since tracemalloc traces the whole process
+_profile_lock = threading.Lock()
+
+
+class Profiler:
+    """
+    Profiles one thread's work with cProfile and tracemalloc, reporting the slowest functions and
+    the time and peak memory of every instrumented stage it runs (see instrumentation.stage).
+
+    tracemalloc traces every thread, so memory figures include allocations made concurrently by
+    other threads.
+    """
+
+    def __init__(self, top: int = 30):
+        """
+        Parameters:
+                top (int): number of functions listed in the report, by cumulative time
+        """
+        self.top = top
+        self._thread = None
+        self._profile = None
+        self._start = None
+        self._stages = {}
+        # Peak memory so far of the profile and each open stage, as tracemalloc has a single peak
+        self._peaks = [0]
+
+    def start(self):
+        """
+        Start profiling the calling thread.
+            Raises:
+                    RuntimeError: if another profile is already running
+        """
+        if not _profile_lock.acquire(blocking=False):
+            raise RuntimeError("Another profile is already running")
+        self._thread = threading.get_ident()
+        tracemalloc.start()
+        stage_listeners.append(self)
+        self._profile = cProfile.Profile()
+        self._start = time.perf_counter()
+        self._profile.enable()
+
+    def stop(self) -> dict:
+        """
+        Stop profiling and build the report.
+            Returns:
+                    A dictionary of the wall time and peak memory, the time and peak memory of each
+                    stage, and the top functions by cumulative time
+        """
+        try:
+            self._profile.disable()
+            wall = time.perf_counter() - self._start
+            stage_listeners.remove(self)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        finally:
+            _profile_lock.release()
+
+        stats = pstats.Stats(self._profile)
+        functions = []
+        for (filename, line, name), (_, calls, total, cumulative, _) in stats.stats.items():
+            functions.append({"function": f"{filename}:{line}({name})", "calls": calls,
+                              "totalSeconds": total, "cumulativeSeconds": cumulative})
+        functions.sort(key=lambda function: function["cumulativeSeconds"], reverse=True)
+
+        return {
+            "wallSeconds": wall,
+            "peakMemory": max(peak, self._peaks[0]),
+            "stages": self._stages,
+            "functions": functions[:self.top]
+        }
+
+    def enter_stage(self, name):
+        """Start measuring the peak memory of a stage run by the profiled thread"""
+        if threading.get_ident() != self._thread:
+            return
+        self._peaks[-1] = max(self._peaks[-1], tracemalloc.get_traced_memory()[1])
+        self._peaks.append(0)
+        tracemalloc.reset_peak()
+
+    def exit_stage(self, name, elapsed):
+        """Record the time and peak memory of a stage run by the profiled thread"""
+        if threading.get_ident() != self._thread:
+            return
+        peak = max(tracemalloc.get_traced_memory()[1], self._peaks.pop())
+        self._peaks[-1] = max(self._peaks[-1], peak)
+        record = self._stages.setdefault(name, {"calls": 0, "seconds": 0.0, "peakMemory": 0})
+        record["calls"] += 1
+        record["seconds"] += elapsed
+        record["peakMemory"] = max(record["peakMemory"], peak)
+
+
+@contextmanager
+def profiled(top: int = 30):
+    """
+    Profile a block, see Profiler.
+        Parameters:
+                top (int): number of functions listed in the report
+        Yields:
+                A dictionary filled with the report once the block exits
+    """
+    report = {}
+    profiler = Profiler(top)
+    profiler.start()
+    try:
+        yield report
+    finally:
+        report.update(profiler.stop())
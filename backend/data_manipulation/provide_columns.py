@@ -1,7 +1,10 @@
 import pandas as pd
+import codecs
 import csv
 from io import BytesIO, StringIO
 
+ENCODINGS = ['utf-8', 'utf-16', 'utf-16-be', 'utf-16-le', 'latin-1', 'iso-8859-1']
+
 
 def detect_delimiter(file_obj, num_bytes=4096):
     """
@@ -37,19 +40,152 @@ def detect_delimiter(file_obj, num_bytes=4096):
         return max(delimiter_counts, key=delimiter_counts.get)
 
 
-def provide_columns(csv_file: BytesIO | str):
+def _read_sample(csv_file, sample_bytes: int, strides: int, encoding: str):
+    """
+    Reads a bounded sample of a csv file: its head plus evenly strided windows through the body
+        Parameters:
+                csv_file (BytesIO | file): seekable csv file in bytes
+                sample_bytes (int): total byte budget of the sample
+                strides (int): number of windows taken after the head
+                encoding (str): encoding used to decode the sample
+        Returns:
+                The sampled text, made only of whole lines, header first
+    """
+    csv_file.seek(0, 2)
+    size = csv_file.tell()
+    csv_file.seek(0)
+    if size <= sample_bytes:
+        return csv_file.read().decode(encoding)
+
+    head_bytes = sample_bytes // 2 if strides else sample_bytes
+    window_bytes = (sample_bytes - head_bytes) // strides if strides else 0
+
+    head = csv_file.read(head_bytes)
+    text = codecs.getincrementaldecoder(encoding)().decode(head, final=False)
+    text = text[:text.rfind('\n') + 1]
+    lines = [text]
+
+    # Windows are decoded without a BOM, so fix the byte order from the head
+    window_encoding = encoding
+    unit = 1
+    if encoding.startswith('utf-16'):
+        unit = 2
+        if encoding == 'utf-16':
+            window_encoding = 'utf-16-be' if head.startswith(codecs.BOM_UTF16_BE) else 'utf-16-le'
+
+    body = size - head_bytes
+    for i in range(strides):
+        offset = head_bytes + (body * (i + 1)) // (strides + 1)
+        offset -= offset % unit
+        csv_file.seek(offset)
+        window = csv_file.read(window_bytes)
+        window = codecs.getincrementaldecoder(window_encoding)(errors='ignore').decode(window, final=False)
+        # Drop the partial lines at both ends of the window
+        start, end = window.find('\n'), window.rfind('\n')
+        if start != end:
+            lines.append(window[start + 1:end + 1])
+
+    csv_file.seek(0)
+    return "".join(lines)
+
+
+def sample_columns(csv_file: BytesIO, sample_bytes: int, strides: int = 4):
+    """
+    Infers the numerical columns of a csv file from a bounded sample rather than the whole file
+        Parameters:
+                csv_file (BytesIO | file): seekable csv file in bytes
+                sample_bytes (int): total byte budget of the sample, split between the head and the strides
+                strides (int): number of windows sampled through the body of the file
+        Returns:
+                A list of columns that contain numerical entries within the sample
+    """
+    delimiter = detect_delimiter(csv_file)
+
+    for encoding in ENCODINGS:
+        try:
+            sample = _read_sample(csv_file, sample_bytes, strides, encoding)
+            # Strided windows may cut through quoted fields, so malformed lines are dropped
+            df = pd.read_csv(StringIO(sample), sep=delimiter, engine='python', on_bad_lines='skip')
+
+            if len(df.columns) > 1 or len(df) > 0:
+                return list(df.select_dtypes(include="number").columns.values)
+
+        except (UnicodeError, UnicodeDecodeError, pd.errors.ParserError):
+            continue
+        except Exception as e:
+            print(f"Unexpected error with encoding {encoding}: {e}")
+            continue
+
+    raise ValueError("Unable to read CSV file with any supported encoding")
+
+
+def validate_columns(csv_file: BytesIO | str, columns: list[str] | None = None, chunksize: int = 100000):
+    """
+    Confirms which columns are numerical over every row of a csv file, reading it in chunks
+        Parameters:
+                csv_file (BytesIO | str): csv filename or file in Bytes
+                columns (list[str] | None): columns to check, all columns if None
+                chunksize (int): number of rows parsed at a time
+        Returns:
+                The subset of columns that are numerical in every chunk
+    """
+    if isinstance(csv_file, str):
+        with open(csv_file, 'rb') as f:
+            return validate_columns(f, columns, chunksize)
+
+    delimiter = detect_delimiter(csv_file)
+
+    for encoding in ENCODINGS:
+        try:
+            csv_file.seek(0)
+            reader = pd.read_csv(csv_file, sep=delimiter, encoding=encoding, usecols=columns, chunksize=chunksize)
+            numeric = None
+            for chunk in reader:
+                chunk_numeric = set(chunk.select_dtypes(include="number").columns)
+                numeric = chunk_numeric if numeric is None else numeric & chunk_numeric
+            if numeric is None:
+                continue
+            order = columns if columns is not None else list(chunk.columns)
+            return [col for col in order if col in numeric]
+
+        except (UnicodeError, UnicodeDecodeError, pd.errors.ParserError):
+            continue
+        except ValueError:
+            # A requested column is missing from the file
+            raise
+        except Exception as e:
+            print(f"Unexpected error with encoding {encoding}: {e}")
+            continue
+
+    raise ValueError("Unable to read CSV file with any supported encoding")
+
+
+def provide_columns(csv_file: BytesIO | str, sample_bytes: int | None = None, strides: int = 4):
     """
     Provides all columns in csv file that contain numerical entries
         Parameters:
                 csv_file (BytesIO | str): csv filename or file in Bytes
+                sample_bytes (int | None): if set, files larger than this are only sampled
+                        (see sample_columns) instead of fully parsed
+                strides (int): number of windows sampled through the file in sample mode
         Returns:
                 A list of columns that contain numerical entries
     """
+    if isinstance(csv_file, str):
+        with open(csv_file, 'rb') as f:
+            return provide_columns(f, sample_bytes, strides)
+
+    if sample_bytes is not None:
+        csv_file.seek(0, 2)
+        size = csv_file.tell()
+        csv_file.seek(0)
+        if size > sample_bytes:
+            return sample_columns(csv_file, sample_bytes, strides)
 
     # Detect delimiter first
     delimiter = detect_delimiter(csv_file)
 
-    encodings = ['utf-8', 'utf-16', 'utf-16-be', 'utf-16-le', 'latin-1', 'iso-8859-1']
+    encodings = ENCODINGS
 
     for encoding in encodings:
         try:
@@ -0,0 +1,89 @@
+import math
+
+import numpy as np
+
+# Bins of the stored histogram, and percentiles reported
+STATS_BINS = 32
+PERCENTILES = (1, 5, 25, 50, 75, 95, 99)
+
+# Bins of the histogram percentiles are read from; a multiple of STATS_BINS
+FINE_BINS = 1024
+
+
+class RasterStats:
+    """
+    Statistics of a grid, accumulated from its normalized values window by window, so streamed grids
+    are never normalized in full. Percentiles are read from a fine histogram over the grid's value
+    range, to within 1/FINE_BINS of it. Nodata (NaN) cells are left out.
+    """
+
+    def __init__(self, minimum: float, maximum: float):
+        """
+        Args:
+            minimum: Minimum of the grid before normalization, NaN if it has no data
+            maximum: Maximum of the grid before normalization, which it is divided by, NaN if it has no data
+        """
+        self.minimum = float(minimum)
+        self.maximum = float(maximum)
+        # Value range of the histogram, widened for a constant grid, or a grid of nodata only
+        self.low = self.minimum if math.isfinite(self.minimum) else 0.0
+        self.high = self.maximum if self.maximum > self.minimum else self.low + 1.0
+        self.count = 0
+        self.zeros = 0
+        self.total = 0.0
+        self.total_squares = 0.0
+        self.fine = np.zeros(FINE_BINS, dtype=np.int64)
+
+    def add(self, values):
+        """Accumulate a window of normalized values"""
+        values = np.asarray(values).ravel()
+        finite = np.isfinite(values)
+        if not finite.all():
+            values = values[finite]
+        self.count += values.size
+        self.zeros += int(np.count_nonzero(values == 0))
+        self.total += float(values.sum(dtype=np.float64))
+        self.total_squares += float(np.dot(values.astype(np.float64, copy=False), values))
+        # Back in the grid's units, clipped to its range against rounding in the normalization round trip
+        values = np.clip(values * self.maximum, self.low, self.high)
+        self.fine += np.histogram(values, bins=FINE_BINS, range=(self.low, self.high))[0]
+
+    def _percentile(self, cumulative, percentile):
+        target = percentile / 100 * self.count
+        index = min(int(np.searchsorted(cumulative, target)), FINE_BINS - 1)
+        below = cumulative[index - 1] if index else 0
+        fraction = (target - below) / self.fine[index] if self.fine[index] else 0.0
+        return self.low + (index + fraction) * (self.high - self.low) / FINE_BINS
+
+    def result(self) -> dict:
+        """
+        The statistics, in the grid's units before normalization.
+
+        Returns:
+            Dictionary of the count of cells with data and of empty (0) cells, the minimum, maximum
+            (by which the grid is normalized), mean and standard deviation, percentiles, and a
+            STATS_BINS bin histogram of counts and bin edges; None where there are no values
+        """
+        scale = self.maximum
+        # Without any finite value (an all zero grid normalizes to NaN), there is nothing to describe
+        mean = std = None
+        percentiles = {f"p{p}": None for p in PERCENTILES}
+        if self.count:
+            mean = self.total / self.count
+            std = math.sqrt(max(self.total_squares / self.count - mean * mean, 0.0))
+            cumulative = np.cumsum(self.fine)
+            mean, std = mean * scale, std * abs(scale)
+            percentiles = {f"p{p}": self._percentile(cumulative, p) for p in PERCENTILES}
+        return {
+            "cells": self.count,
+            "emptyCells": self.zeros,
+            "min": self.minimum if math.isfinite(self.minimum) else None,
+            "max": self.maximum if math.isfinite(self.maximum) else None,
+            "mean": mean,
+            "std": std,
+            "percentiles": percentiles,
+            "histogram": {
+                "counts": self.fine.reshape(STATS_BINS, -1).sum(axis=1).tolist(),
+                "edges": np.linspace(self.low, self.high, STATS_BINS + 1).tolist()
+            }
+        }
@@ -0,0 +1,182 @@
+"""
+Server-side styling of rendered layers.
+
+A layer's displayed raster is stored once as a 16-bit quantized grid. A style (colour ramp, value
+range, opacity) compiles into a lookup table of RGBA colours, and a styled image is a single gather
+of the table by the grid, so switching styles never re-renders the layer.
+"""
+import hashlib
+import json
+from functools import lru_cache
+from io import BytesIO
+
+import numpy as np
+import rasterio
+from PIL import Image
+try:
+    from .instrumentation import timed
+except ImportError:  # Run as a script
+    from instrumentation import timed
+
+# Levels of the stored quantized grids
+QUANTIZED_LEVELS = 65536
+
+# Named colour ramps, as evenly spaced colour stops from the lowest value to the highest
+RAMPS = {
+    "black": ["#000000", "#000000"],
+    "grayscale": ["#000000", "#ffffff"],
+    "viridis": ["#440154", "#3b528b", "#21918c", "#5ec962", "#fde725"],
+    "magma": ["#000004", "#51127c", "#b73779", "#fc8961", "#fcfdbf"],
+    "heat": ["#ffffb2", "#fecc5c", "#fd8d3c", "#f03b20", "#bd0026"],
+    "blues": ["#eff3ff", "#bdd7e7", "#6baed6", "#3182bd", "#08519c"],
+}
+
+# The look of a layer's stored image: black, with the value as opacity
+DEFAULT_STYLE = {"ramp": "black", "min": 0.0, "max": 1.0, "opacity": 1.0, "alpha": "value", "levels": 256}
+
+
+def hex_to_rgb(colour: str) -> tuple[int, int, int]:
+    """Convert a #rrggbb colour to its red, green and blue components"""
+    if len(colour) != 7 or colour[0] != "#":
+        raise ValueError(f"Colours must be #rrggbb, got {colour!r}")
+    return int(colour[1:3], 16), int(colour[3:5], 16), int(colour[5:7], 16)
+
+
+def normalize_style(style: dict) -> dict:
+    """
+    Validate a style and fill in its defaults.
+
+    Args:
+        style: Any of ramp (a name in RAMPS, or a list of #rrggbb colour stops), min and max (the
+            normalized value range the ramp spans), opacity (0 to 1), alpha ("value" to fade in with
+            the value, or "constant") and levels (256 or 65536 entry lookup table)
+
+    Returns:
+        The complete style
+
+    Raises:
+        ValueError: if the style is invalid
+    """
+    unknown = set(style) - set(DEFAULT_STYLE)
+    if unknown:
+        raise ValueError(f"Unknown style options {sorted(unknown)}")
+    style = {**DEFAULT_STYLE, **style}
+
+    ramp = style["ramp"]
+    if isinstance(ramp, str):
+        if ramp not in RAMPS:
+            raise ValueError(f"Unknown ramp {ramp!r}, expected one of {list(RAMPS)} or a list of colours")
+    elif not isinstance(ramp, list) or not ramp:
+        raise ValueError("A ramp must be a name or a list of colours")
+    else:
+        for colour in ramp:
+            hex_to_rgb(colour)
+        ramp = [colour.lower() for colour in ramp]
+
+    style = {"ramp": ramp, "min": float(style["min"]), "max": float(style["max"]),
+             "opacity": float(style["opacity"]), "alpha": style["alpha"], "levels": int(style["levels"])}
+    if not style["min"] < style["max"]:
+        raise ValueError("The style's min must be below its max")
+    if not 0 <= style["opacity"] <= 1:
+        raise ValueError("Opacity must be between 0 and 1")
+    if style["alpha"] not in ("value", "constant"):
+        raise ValueError("Alpha must be 'value' or 'constant'")
+    if style["levels"] not in (256, QUANTIZED_LEVELS):
+        raise ValueError(f"Levels must be 256 or {QUANTIZED_LEVELS}")
+    return style
+
+
+def style_key(style: dict) -> str:
+    """Canonical json of a complete style (see normalize_style)"""
+    return json.dumps(style, sort_keys=True, separators=(",", ":"))
+
+
+def style_hash(style: dict) -> str:
+    """Short hash identifying a complete style, for caching its styled images"""
+    return hashlib.sha1(style_key(style).encode()).hexdigest()[:16]
+
+
+@lru_cache(maxsize=64)
+def _lookup_table(key: str) -> np.ndarray:
+    style = json.loads(key)
+    levels = style["levels"]
+    values = np.linspace(0, 1, levels)
+    t = np.clip((values - style["min"]) / (style["max"] - style["min"]), 0, 1)
+
+    ramp = RAMPS[style["ramp"]] if isinstance(style["ramp"], str) else style["ramp"]
+    stops = np.array([hex_to_rgb(colour) for colour in ramp], dtype=np.float64)
+    positions = np.linspace(0, 1, len(stops))
+    alpha = (t if style["alpha"] == "value" else np.ones(levels)) * style["opacity"]
+    # Values below the range, and cells without data, are transparent
+    alpha[values < style["min"]] = 0
+    alpha[0] = 0
+
+    table = np.empty((levels, 4), dtype=np.uint8)
+    for channel in range(3):
+        table[:, channel] = np.round(np.interp(t, positions, stops[:, channel]))
+    table[:, 3] = np.round(alpha * 255)
+    table.flags.writeable = False
+    return table
+
+
+def lookup_table(style: dict) -> np.ndarray:
+    """
+    The RGBA colour of every quantized value under a complete style, cached per style.
+
+    Returns:
+        Read-only (levels, 4) uint8 array
+    """
+    return _lookup_table(style_key(style))
+
+
+@timed("quantize")
+def quantize_raster(fp) -> bytes:
+    """
+    Quantize the normalized first band of a rendered GeoTIFF to 16 bits, for styling.
+
+    Args:
+        fp: File path or BytesIO of the GeoTIFF
+
+    Returns:
+        The quantized grid in compressed npz bytes; cells without data are 0
+    """
+    if isinstance(fp, BytesIO):
+        fp.seek(0)
+    with rasterio.open(fp) as raster:
+        values = raster.read(1)
+    values = np.clip(np.nan_to_num(values, nan=0.0), 0, 1)
+    quantized = np.round(values * (QUANTIZED_LEVELS - 1)).astype(np.uint16)
+    buffer = BytesIO()
+    np.savez_compressed(buffer, quantized=quantized)
+    return buffer.getvalue()
+
+
+def load_quantized(data: bytes) -> np.ndarray:
+    """Deserialize a quantized grid stored by quantize_raster"""
+    with np.load(BytesIO(data)) as npz:
+        return npz["quantized"]
+
+
+def quantized_from_image(data: bytes) -> np.ndarray:
+    """Quantized grid of a layer stored before quantized grids were, from the opacity of its image"""
+    alpha = np.asarray(Image.open(BytesIO(data)).convert("LA"))[:, :, 1]
+    return alpha.astype(np.uint16) * 257
+
+
+@timed("style")
+def style_image(quantized: np.ndarray, style: dict) -> bytes:
+    """
+    Style a quantized grid into a PNG.
+
+    Args:
+        quantized: Quantized grid (see quantize_raster)
+        style: Complete style (see normalize_style)
+
+    Returns:
+        The RGBA PNG bytes
+    """
+    table = lookup_table(style)
+    index = quantized if style["levels"] == QUANTIZED_LEVELS else quantized >> 8
+    buffer = BytesIO()
+    Image.fromarray(table[index], "RGBA").save(buffer, format="PNG")
+    return buffer.getvalue()
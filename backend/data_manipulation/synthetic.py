@@ -0,0 +1,53 @@
+import numpy as np
+import pandas as pd
+from typing import Literal
+
+# Default extent of generated points (west, south, east, north), in degrees WGS 84
+DEFAULT_BOUNDS = (-75.0, 45.0, -74.0, 46.0)
+
+DISTRIBUTIONS = ("uniform", "clustered", "corridor")
+
+
+def synthetic_points(n: int, distribution: Literal["uniform", "clustered", "corridor"] = "uniform",
+                     seed: int = 0, bounds=DEFAULT_BOUNDS) -> pd.DataFrame:
+    """
+    Generate a deterministic set of points with a smooth value field, for benchmarks and tests.
+
+    Args:
+        n: Number of points
+        distribution: "uniform" over the extent, "clustered" around 20 gaussian centres, or "corridor",
+            a thin winding band across the extent with 1% of the points scattered around it
+        seed: Random seed; the same arguments always give the same points
+        bounds: Extent (west, south, east, north) in degrees
+
+    Returns:
+        DataFrame with "lat", "lon", "value" (positive float) and "category" (0-9 integer) columns
+    """
+    rng = np.random.default_rng(seed)
+    west, south, east, north = bounds
+    width, height = east - west, north - south
+
+    if distribution == "uniform":
+        u, v = rng.random(n), rng.random(n)
+    elif distribution == "clustered":
+        centres = rng.random((20, 2))
+        spread = rng.uniform(0.005, 0.03, 20)
+        cluster = rng.integers(0, 20, n)
+        u = centres[cluster, 0] + rng.normal(0, 1, n) * spread[cluster]
+        v = centres[cluster, 1] + rng.normal(0, 1, n) * spread[cluster]
+    elif distribution == "corridor":
+        u = rng.random(n)
+        v = 0.5 + 0.3 * np.sin(2 * np.pi * u) + rng.normal(0, 0.005, n)
+        scattered = rng.random(n) < 0.01
+        v[scattered] = rng.random(np.count_nonzero(scattered))
+    else:
+        raise ValueError(f"Unknown distribution {distribution!r}, expected one of {DISTRIBUTIONS}")
+
+    u, v = np.clip(u, 0, 1), np.clip(v, 0, 1)
+    value = 5 + 2 * np.sin(6 * u) * np.cos(4 * v) + rng.normal(0, 0.5, n)
+    return pd.DataFrame({
+        "lat": south + v * height,
+        "lon": west + u * width,
+        "value": np.abs(value),
+        "category": rng.integers(0, 10, n)
+    })
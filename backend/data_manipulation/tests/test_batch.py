@@ -0,0 +1,80 @@
+import json
+import os
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+import rasterio
+from backend.data_manipulation.batch import load_manifest, run_batch, format_summary
+from backend.data_manipulation.generate_raster_file import generate_raster_file
+
+
+class TestBatch(unittest.TestCase):
+    """Tests for rendering manifests of jobs"""
+
+    def setUp(self):
+        """Set up two input files in a temporary directory"""
+        self.directory = tempfile.TemporaryDirectory()
+        self.dir = self.directory.name
+        rng = np.random.default_rng(0)
+        for name, lon in (("a.csv", -80.0), ("b.csv", -70.0)):
+            pd.DataFrame({"latitude": rng.uniform(43.5, 43.8, 300), "longitude": rng.uniform(lon, lon + 1, 300),
+                          "value": rng.uniform(0, 10, 300)}).to_csv(os.path.join(self.dir, name), index=False)
+        self.jobs = [
+            {"in_fp": "a.csv", "out_fp": "out/a_value.tif", "col_weight": {"value": [1, "IDW"]}},
+            {"in_fp": "a.csv", "out_fp": "out/a_count.tif", "col_weight": {"Count": [1, "Density"]}},
+            {"in_fp": "b.csv", "out_fp": "out/b_value.tif", "col_weight": {"missing": [1, "IDW"]}},
+        ]
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write_manifest(self, jobs):
+        """Helper to write a manifest of jobs sharing their geometry columns"""
+        path = os.path.join(self.dir, "manifest.json")
+        with open(path, "w") as f:
+            json.dump({"defaults": {"geom": ["latitude", "longitude"]}, "jobs": jobs}, f)
+        return path
+
+    def test_failed_jobs_resume(self):
+        """Test that a failed job fails alone, and a second run only renders what isn't done"""
+        path = self.write_manifest(self.jobs)
+        results = run_batch(path, workers=1, log=lambda line: None)
+        self.assertEqual([result["status"] for result in results], ["ok", "ok", "failed"])
+        self.assertTrue(os.path.exists(os.path.join(self.dir, "out", "a_value.tif")))
+        self.assertIn("3 jobs", format_summary(results, 1.0))
+
+        self.jobs[2]["col_weight"] = {"value": [1, "IDW"]}
+        path = self.write_manifest(self.jobs)
+        results = run_batch(path, workers=1, log=lambda line: None)
+        self.assertEqual([result["status"] for result in results], ["skipped", "skipped", "ok"])
+
+        # Changing an input renders its jobs again
+        os.utime(os.path.join(self.dir, "a.csv"), ns=(0, 0))
+        results = run_batch(path, workers=1, log=lambda line: None)
+        self.assertEqual([result["status"] for result in results], ["ok", "ok", "skipped"])
+
+    def test_parallel_matches_single_renders(self):
+        """Test that jobs rendered across processes, sharing their input, match rendering them one by one"""
+        self.jobs[2]["col_weight"] = {"value": [1, "IDW"]}
+        path = self.write_manifest(self.jobs)
+        results = run_batch(path, workers=2, log=lambda line: None)
+        self.assertEqual([result["status"] for result in results], ["ok", "ok", "ok"])
+
+        for job in self.jobs:
+            expected = os.path.join(self.dir, "expected.tif")
+            generate_raster_file(os.path.join(self.dir, job["in_fp"]), expected, job["col_weight"],
+                                 ["latitude", "longitude"])
+            with rasterio.open(expected) as a, rasterio.open(os.path.join(self.dir, job["out_fp"])) as b:
+                np.testing.assert_array_equal(a.read(1), b.read(1))
+
+    def test_invalid_manifests(self):
+        """Test that manifests with missing or unknown job fields are rejected"""
+        for jobs in ([{"in_fp": "a.csv", "out_fp": "out.tif"}],
+                     [{**self.jobs[0], "colour": "red"}]):
+            with self.assertRaises(ValueError):
+                load_manifest(self.write_manifest(jobs))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+import unittest
+from io import BytesIO
+import pandas as pd
+from backend.data_manipulation.columnar import to_columnar, append_columnar, columnar_columns, read_columnar
+from backend.data_manipulation.generate_raster_file import read_csv_data
+
+
+class TestColumnar(unittest.TestCase):
+
+    def setUp(self):
+        """Set up a parsed csv with mixed column types"""
+        csv_content = """name,age,salary,latitude,longitude
+John Doe,30,50000.50,40.7128,-74.0060
+Jane Smith,25,60000.75,34.0522,-118.2437
+Bob Johnson,35,55000.00,41.8781,-87.6298"""
+        self.df = read_csv_data(BytesIO(csv_content.encode('utf-8')))
+
+    def test_only_numeric_columns_kept(self):
+        """Test that string columns are dropped from the columnar copy"""
+        data = to_columnar(self.df)
+        self.assertEqual(columnar_columns(data), ['age', 'salary', 'latitude', 'longitude'])
+
+    def test_geometry_columns_kept(self):
+        """Test that the columns to keep are stored whatever their type, and appended rows keep them too"""
+        df = self.df.assign(latitude=self.df['latitude'].astype(str))
+        data = to_columnar(df, keep=['latitude', 'longitude'])
+        self.assertEqual(columnar_columns(data), ['age', 'salary', 'latitude', 'longitude'])
+        data = append_columnar(data, df, keep=['latitude', 'longitude'])
+        self.assertEqual(read_columnar(data, ['latitude'])['latitude'].tolist(), df['latitude'].tolist() * 2)
+
+    def test_round_trip_selected_columns(self):
+        """Test that only the requested columns are loaded, with their values and types"""
+        data = to_columnar(self.df)
+        df = read_columnar(data, ['latitude', 'age'])
+        self.assertEqual(list(df.columns), ['latitude', 'age'])
+        pd.testing.assert_series_equal(df['latitude'], self.df['latitude'])
+        self.assertTrue(pd.api.types.is_integer_dtype(df['age']))
+
+    def test_uncompressed(self):
+        """Test writing without compression"""
+        data = to_columnar(self.df, compression="uncompressed")
+        self.assertEqual(len(read_columnar(data)), 3)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,93 @@
+import unittest
+import numpy as np
+import pandas as pd
+import rasterio
+from io import BytesIO
+from backend.data_manipulation.composite import GridCache, composite_grid, composite_spec, resample, \
+    estimate_composite_memory
+from backend.data_manipulation.generate_raster_file import generate_raster_file, grid_axes
+from backend.data_manipulation.grid_store import dump_grid, grid_info
+
+
+class TestComposite(unittest.TestCase):
+    """Tests for combining stored layer grids"""
+
+    def setUp(self):
+        """Set up two overlapping layers"""
+        rng = np.random.default_rng(11)
+        self.geom = ["latitude", "longitude"]
+        self.west = generate_raster_file(
+            pd.DataFrame({"latitude": rng.uniform(43.5, 43.8, 500), "longitude": rng.uniform(-80.0, -79.0, 500),
+                          "value": rng.uniform(0, 10, 500)}), BytesIO(), {"value": [1.0, "IDW"]}, self.geom)
+        self.east = generate_raster_file(
+            pd.DataFrame({"latitude": rng.uniform(43.6, 43.9, 500), "longitude": rng.uniform(-79.5, -78.5, 500),
+                          "value": rng.uniform(0, 10, 500)}), BytesIO(), {"value": [1.0, "IDW"]}, self.geom)
+
+    def test_resample_own_grid(self):
+        """Test that sampling a grid at its own cells gives it back"""
+        xs, ys = grid_axes(self.west["bounds"], self.west["res"])
+        np.testing.assert_allclose(resample(self.west, xs, ys), self.west["grid"])
+
+    def test_single_layer_is_normalized(self):
+        """Test that a composite of one layer is that layer, normalized"""
+        out = BytesIO()
+        composite = composite_grid([self.west], [1.0], out)
+        np.testing.assert_allclose(composite["grid"], self.west["grid"] / self.west["grid"].max())
+        with rasterio.open(out) as raster:
+            self.assertEqual(raster.count, 1)
+
+    def test_resample_is_bilinear(self):
+        """Test that sampling a linear ramp between and outside its cells is exact, and 0 outside"""
+        bounds, res = (0.0, 0.0, 1000.0, 500.0), 100.0
+        xs, ys = grid_axes(bounds, res)
+        ramp = {"grid": 2 * xs[:, np.newaxis] + 3 * ys[np.newaxis, :], "bounds": bounds, "res": res}
+        sample_xs, sample_ys = np.array([-50.0, 0.0, 123.0, 877.5]), np.array([480.0, 250.5, 100.0, 50.0])
+        expected = 2 * sample_xs[:, np.newaxis] + 3 * sample_ys[np.newaxis, :]
+        expected[0] = 0
+        expected[:, -1] = 0
+        np.testing.assert_allclose(resample(ramp, sample_xs, sample_ys), expected)
+
+    def test_weighted_sum_covers_union(self):
+        """Test that the composite is the weighted sum of the normalized layers over both, in blocks as in one"""
+        composite = composite_grid([self.west, self.east], [0.6, 0.4], BytesIO(), chunk_size=7)
+        bounds, res = composite_spec([self.west, self.east])
+        self.assertEqual(composite["bounds"], bounds)
+        xs, ys = grid_axes(bounds, res)
+        expected = (0.6 * resample(self.west, xs, ys) / self.west["grid"].max()
+                    + 0.4 * resample(self.east, xs, ys) / self.east["grid"].max())
+        np.testing.assert_allclose(composite["grid"], expected)
+        self.assertLessEqual(composite["grid"].max(), 1.0 + 1e-9)
+
+    def test_grid_cache_evicts_oldest(self):
+        """Test that the cache stays within its size bound"""
+        cache = GridCache(self.west["grid"].nbytes * 2)
+        cache.put((1, 1), self.west)
+        cache.put((2, 1), self.west)
+        cache.get((1, 1))
+        cache.put((3, 1), self.west)
+        self.assertIsNotNone(cache.get((1, 1)))
+        self.assertIsNone(cache.get((2, 1)))
+
+    def test_grid_cache_evict(self):
+        """Test that evicted grids are dropped and no longer counted against the bound"""
+        cache = GridCache(self.west["grid"].nbytes * 2)
+        cache.put("a", self.west)
+        cache.put("b", self.west)
+        cache.evict(lambda key: key == "a")
+        self.assertIsNone(cache.get("a"))
+        cache.put("c", self.west)
+        self.assertIsNotNone(cache.get("b"))
+
+    def test_estimate_counts_sources(self):
+        """Test that the composite estimate, from the stored grids' headers, covers the decoded sources on top of
+        the output grid"""
+        west, east = grid_info(dump_grid(self.west)), grid_info(dump_grid(self.east))
+        self.assertEqual((west["bounds"], west["res"], west["dtype"], west["nbytes"]),
+                         (self.west["bounds"], self.west["res"], self.west["grid"].dtype, self.west["grid"].nbytes))
+        estimate = estimate_composite_memory([west, east])
+        self.assertGreater(estimate, self.west["grid"].nbytes + self.east["grid"].nbytes)
+        self.assertGreaterEqual(estimate - estimate_composite_memory([west]), self.east["grid"].nbytes)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -1,8 +1,22 @@
+import json
+import os
+import tracemalloc
 import unittest
+import tempfile
+import numpy as np
 import pandas as pd
+import rasterio
 from io import BytesIO
 from unittest.mock import Mock, patch, MagicMock
-from backend.data_manipulation.generate_raster_file import detect_delimiter, generate_raster_file
+from backend.data_manipulation.generate_raster_file import detect_delimiter, generate_raster_file, \
+    append_raster_file, interpolate, build_occupancy, near_data, thin_points, neighbour_kernel, neighbour_scratch, \
+    estimate_grid_shape, estimate_render_memory, render_preview, generate_raster_files, project_points
+from backend.data_manipulation.grid_store import dump_grid, load_grid, WINDOW_BYTES
+from backend.data_manipulation.getImage import convert_to_alpha, img_to_pixel, write_pix_json
+from io import StringIO
+from rasterio.io import MemoryFile
+from rasterio.transform import from_origin
+from PIL import Image
 
 
 class TestGenerateRasterFile(unittest.TestCase):
@@ -242,5 +256,457 @@ Doe, Jane\t456 Oak Ave, Suite 200\t34.0522\t-118.2437"""
         self.assertEqual(delimiters[0], ',')
 
 
+class TestAppendRasterFile(unittest.TestCase):
+    """Tests for incrementally appending points to a rendered grid"""
+
+    def setUp(self):
+        """Set up a wide layer spanning several tiles"""
+        self.rng = np.random.default_rng(1)
+        self.col_weights = {"value": [1.0, "IDW"], "Count": [0.5, "Density"]}
+        self.geom = ["latitude", "longitude"]
+        self.data = self.create_points(3000, -80.0, -77.0)
+
+    def create_points(self, n, lon_min, lon_max):
+        """Helper to create random points in a band of longitudes"""
+        return pd.DataFrame({"latitude": self.rng.uniform(43.5, 43.8, n),
+                             "longitude": self.rng.uniform(lon_min, lon_max, n),
+                             "value": self.rng.uniform(0, 10, n)})
+
+    def test_append_matches_full_render(self):
+        """Test that re-rendering only dirty tiles gives the same grid as a full render"""
+        rendered = generate_raster_file(self.data, BytesIO(), self.col_weights, self.geom)
+        stored = load_grid(dump_grid(rendered))
+        np.testing.assert_array_equal(stored["grid"], rendered["grid"])
+
+        new_data = self.create_points(30, -79.9, -79.7)
+        appended = append_raster_file(self.data, new_data, BytesIO(), self.col_weights, self.geom, stored)
+        self.assertLess(appended["dirty_tiles"], appended["tile_radius"].size)
+
+        full = generate_raster_file(pd.concat([self.data, new_data], ignore_index=True), BytesIO(),
+                                    self.col_weights, self.geom)
+        np.testing.assert_allclose(appended["grid"], full["grid"])
+
+    def test_append_projects_new_points_only(self):
+        """Test that appends to a stored grid project only the new points, without reading the layer's data, and
+        stream the GeoTIFF in memmap mode"""
+        rendered = generate_raster_file(self.data, BytesIO(), self.col_weights, self.geom)
+        new_data = self.create_points(30, -79.9, -79.7)
+        data = Mock(side_effect=AssertionError("The layer's data should not be read"))
+        in_memory, streamed = BytesIO(), BytesIO()
+        with patch("backend.data_manipulation.generate_raster_file.project_points",
+                   wraps=project_points) as projected:
+            appended = append_raster_file(data, new_data, in_memory, self.col_weights, self.geom,
+                                          load_grid(dump_grid(rendered)))
+            self.assertEqual([len(call.args[0]) for call in projected.call_args_list], [30])
+        self.assertEqual(appended["points_in"], 3030)
+        self.assertEqual(len(appended["coords"]), 3030)
+
+        with tempfile.TemporaryDirectory() as memmap_dir:
+            append_raster_file(data, new_data, streamed, self.col_weights, self.geom, load_grid(dump_grid(rendered)),
+                               memmap_dir=memmap_dir)
+        with rasterio.open(in_memory) as expected, rasterio.open(streamed) as actual:
+            np.testing.assert_array_equal(actual.read(1), expected.read(1))
+
+    def test_append_without_stored_points(self):
+        """Test that grids stored without their points are appended to from the layer's data"""
+        rendered = generate_raster_file(self.data, BytesIO(), self.col_weights, self.geom)
+        new_data = self.create_points(30, -79.9, -79.7)
+        appended = append_raster_file(lambda: self.data, new_data, BytesIO(), self.col_weights, self.geom,
+                                      load_grid(dump_grid(rendered), points=False))
+        full = generate_raster_file(pd.concat([self.data, new_data], ignore_index=True), BytesIO(),
+                                    self.col_weights, self.geom)
+        np.testing.assert_allclose(appended["grid"], full["grid"])
+
+    def test_append_outside_bounds_renders_fully(self):
+        """Test that points extending the grid trigger a full render"""
+        rendered = generate_raster_file(self.data, BytesIO(), self.col_weights, self.geom)
+        new_data = self.create_points(10, -76.5, -76.0)
+        appended = append_raster_file(self.data, new_data, BytesIO(), self.col_weights, self.geom, rendered)
+        self.assertEqual(appended["dirty_tiles"], appended["tile_radius"].size)
+        self.assertGreater(appended["grid"].shape[0], rendered["grid"].shape[0])
+
+    def test_append_with_max_distance(self):
+        """Test that appending into an empty region re-renders it under a maximum influence distance"""
+        rendered = generate_raster_file(self.data, BytesIO(), self.col_weights, self.geom, max_distance=5000)
+        new_data = self.create_points(30, -79.9, -79.7)
+        appended = append_raster_file(self.data, new_data, BytesIO(), self.col_weights, self.geom, rendered)
+        self.assertEqual(appended["max_distance"], 5000)
+        full = generate_raster_file(pd.concat([self.data, new_data], ignore_index=True), BytesIO(),
+                                    self.col_weights, self.geom, max_distance=5000)
+        np.testing.assert_allclose(appended["grid"], full["grid"])
+
+    def test_append_with_thinning(self):
+        """Test that appending to a thinned layer matches a full thinned render"""
+        rendered = generate_raster_file(self.data, BytesIO(), self.col_weights, self.geom, thinning=2)
+        self.assertLess(rendered["points"], rendered["points_in"])
+        new_data = self.create_points(30, -79.9, -79.7)
+        appended = append_raster_file(self.data, new_data, BytesIO(), self.col_weights, self.geom,
+                                      load_grid(dump_grid(rendered)))
+        full = generate_raster_file(pd.concat([self.data, new_data], ignore_index=True), BytesIO(),
+                                    self.col_weights, self.geom, thinning=2)
+        self.assertEqual(appended["points"], full["points"])
+        np.testing.assert_allclose(appended["grid"], full["grid"])
+
+    def test_float32_render(self):
+        """Test that a float32 render stays float32 and close to the float64 render, including after appends"""
+        rendered = generate_raster_file(self.data, BytesIO(), self.col_weights, self.geom, precision="float32")
+        self.assertEqual(rendered["grid"].dtype, np.float32)
+        reference = generate_raster_file(self.data, BytesIO(), self.col_weights, self.geom)
+        np.testing.assert_allclose(rendered["grid"], reference["grid"], rtol=1e-4)
+
+        new_data = self.create_points(30, -79.9, -79.7)
+        appended = append_raster_file(self.data, new_data, BytesIO(), self.col_weights, self.geom,
+                                      load_grid(dump_grid(rendered)))
+        self.assertEqual(appended["grid"].dtype, np.float32)
+
+    def test_memmap_render_matches_in_memory(self):
+        """Test that a memory-mapped grid streamed window by window gives the same GeoTIFF"""
+        in_memory, streamed = BytesIO(), BytesIO()
+        generate_raster_file(self.data, in_memory, self.col_weights, self.geom)
+        with tempfile.TemporaryDirectory() as memmap_dir:
+            rendered = generate_raster_file(self.data, streamed, self.col_weights, self.geom, memmap_dir=memmap_dir)
+            self.assertIsInstance(rendered["grid"], np.memmap)
+            del rendered
+
+        with rasterio.open(in_memory) as expected, rasterio.open(streamed) as actual:
+            self.assertTrue(actual.transform.almost_equals(expected.transform))
+            np.testing.assert_array_equal(actual.read(1), expected.read(1))
+
+
+class TestMultiBand(unittest.TestCase):
+    """Tests for writing each weighted column as its own band"""
+
+    def setUp(self):
+        """Set up a layer with a neighbour and a griddata column"""
+        rng = np.random.default_rng(7)
+        self.data = pd.DataFrame({"latitude": rng.uniform(43.5, 43.8, 2000),
+                                  "longitude": rng.uniform(-80.0, -78.0, 2000), "value": rng.uniform(0, 10, 2000),
+                                  "other": rng.uniform(0, 3, 2000)})
+        self.col_weights = {"value": [1.0, "IDW"], "other": [2.0, "Linear"], "Count": [0.5, "Density"]}
+        self.geom = ["latitude", "longitude"]
+
+    def test_bands_sum_to_grid(self):
+        """Test that the bands are the columns of the single band render, which is the first band"""
+        out = BytesIO()
+        rendered = generate_raster_file(self.data, out, self.col_weights, self.geom, bands=True)
+        single = generate_raster_file(self.data, BytesIO(), self.col_weights, self.geom)
+        np.testing.assert_allclose(rendered["grid"], single["grid"])
+        np.testing.assert_allclose(rendered["bands"].sum(axis=0), rendered["grid"])
+        self.assertEqual(rendered["band_names"], ["value IDW", "other Linear", "Count Density"])
+
+        with rasterio.open(out) as raster:
+            self.assertEqual(raster.count, 4)
+            self.assertEqual(raster.descriptions, ("combined", "value IDW", "other Linear", "Count Density"))
+
+    def test_memmap_bands_match_in_memory(self):
+        """Test that streamed bands match the in-memory GeoTIFF"""
+        in_memory, streamed = BytesIO(), BytesIO()
+        generate_raster_file(self.data, in_memory, self.col_weights, self.geom, bands=True)
+        with tempfile.TemporaryDirectory() as memmap_dir:
+            rendered = generate_raster_file(self.data, streamed, self.col_weights, self.geom, memmap_dir=memmap_dir,
+                                            bands=True)
+            del rendered
+
+        with rasterio.open(in_memory) as expected, rasterio.open(streamed) as actual:
+            self.assertEqual(actual.descriptions, expected.descriptions)
+            np.testing.assert_allclose(actual.read(), expected.read(), rtol=1e-6)
+
+    def test_append_updates_bands(self):
+        """Test that appending to a multi-band layer updates its stored bands"""
+        col_weights = {"value": [1.0, "IDW"], "Count": [0.5, "Density"]}
+        rendered = generate_raster_file(self.data, BytesIO(), col_weights, self.geom, bands=True)
+        new_data = self.data.sample(n=20, random_state=1).assign(value=5.0)
+        appended = append_raster_file(self.data, new_data, BytesIO(), col_weights, self.geom,
+                                      load_grid(dump_grid(rendered)))
+        full = generate_raster_file(pd.concat([self.data, new_data], ignore_index=True), BytesIO(), col_weights,
+                                    self.geom, bands=True)
+        np.testing.assert_allclose(appended["bands"], full["bands"])
+        self.assertEqual(appended["band_names"], full["band_names"])
+
+
+class TestThinPoints(unittest.TestCase):
+    """Tests for pre-aggregating points onto a sub-pixel grid"""
+
+    def test_duplicates_merged(self):
+        """Test that points sharing a cell are summed for Density and averaged otherwise"""
+        coords = np.array([[10.0, 10.0], [10.0, 10.0], [12.0, 14.0], [130.0, 10.0]])
+        cols_weights = {"value": np.array([1.0, 2.0, 3.0, 4.0]), "Count": np.ones(4)}
+        col_weight = {"value": [1.0, "IDW"], "Count": [1.0, "Density"]}
+
+        thinned_coords, thinned, counts = thin_points(coords, cols_weights, col_weight, 25)
+        self.assertEqual(len(thinned_coords), 2)
+        np.testing.assert_allclose(thinned_coords, [[12.5, 12.5], [137.5, 12.5]])
+        np.testing.assert_allclose(thinned["value"], [2.0, 4.0])
+        np.testing.assert_allclose(thinned["Count"], [3.0, 1.0])
+        np.testing.assert_array_equal(counts, [3, 1])
+
+    def test_aggregates_thinned_again(self):
+        """Test that thinning aggregates with new points, weighted by their counts, is thinning all points at once"""
+        rng = np.random.default_rng(5)
+        coords = rng.uniform(0, 500, (400, 2))
+        cols_weights = {"value": rng.uniform(0, 10, 400), "Count": np.ones(400)}
+        col_weight = {"value": [1.0, "IDW"], "Count": [1.0, "Density"]}
+        expected = thin_points(coords, cols_weights, col_weight, 50)
+
+        thinned_coords, thinned, counts = thin_points(coords[:300], {key: values[:300] for key, values in
+                                                                     cols_weights.items()}, col_weight, 50)
+        merged = thin_points(np.concatenate([thinned_coords, coords[300:]]),
+                             {key: np.concatenate([thinned[key], cols_weights[key][300:]]) for key in col_weight},
+                             col_weight, 50, np.concatenate([counts, np.ones(100, dtype=np.int64)]))
+        np.testing.assert_allclose(merged[0], expected[0])
+        for key in col_weight:
+            np.testing.assert_allclose(merged[1][key], expected[1][key])
+        np.testing.assert_array_equal(merged[2], expected[2])
+
+
+class TestNeighbourKernel(unittest.TestCase):
+    """Tests for the in-place IDW / Density kernel"""
+
+    def setUp(self):
+        """Set up random neighbour distances and indices"""
+        rng = np.random.default_rng(3)
+        self.values = rng.uniform(0, 10, 100)
+        self.distances = np.sort(rng.uniform(1, 50, (64, 8)), axis=1)
+        self.indices = rng.integers(0, 100, (64, 8))
+        self.scratch = neighbour_scratch(128, 8)
+
+    def test_idw_matches_formula(self):
+        """Test the IDW kernel against the direct formula for several powers"""
+        for power in (1, 2, 3):
+            out = np.empty(64)
+            neighbour_kernel("IDW", self.distances, self.indices, self.values, power, self.scratch, out)
+            weights = 1.0 / self.distances ** power
+            expected = np.sum(weights * self.values[self.indices], axis=1) / np.sum(weights, axis=1)
+            np.testing.assert_allclose(out, expected)
+
+    def test_density_matches_formula(self):
+        """Test the Density kernel against the direct formula"""
+        out = np.empty(64)
+        neighbour_kernel("Density", self.distances, self.indices, self.values, 2, self.scratch, out)
+        np.testing.assert_allclose(out, np.sum(self.values[self.indices] / self.distances, axis=1))
+
+    def test_exact_hit(self):
+        """Test that a cell on data points takes the mean of the coincident points' values"""
+        self.distances[0, :2] = 0
+        out = np.empty(64)
+        neighbour_kernel("IDW", self.distances, self.indices, self.values, 2, self.scratch, out)
+        self.assertAlmostEqual(out[0], self.values[self.indices[0, :2]].mean())
+
+
+class TestMaxInfluenceDistance(unittest.TestCase):
+    """Tests for skipping cells far from any data"""
+
+    def setUp(self):
+        """Set up two clusters of points with empty space between them"""
+        rng = np.random.default_rng(2)
+        self.points = np.vstack((rng.uniform(0, 1000, (200, 2)), rng.uniform(9000, 10000, (200, 2))))
+        self.values = rng.uniform(1, 10, 400)
+        self.grid_x, self.grid_y = np.mgrid[0:10000:100, 0:10000:100]
+
+    def test_occupancy_never_skips_near_cells(self):
+        """Test that every cell with a point within the distance passes the occupancy test"""
+        cells = np.column_stack((self.grid_x.ravel(), self.grid_y.ravel()))
+        nearest = np.min(np.hypot(cells[:, None, 0] - self.points[None, :, 0],
+                                  cells[:, None, 1] - self.points[None, :, 1]), axis=1)
+        mask = near_data(build_occupancy(self.points, 500), cells)
+        self.assertTrue(mask[nearest <= 500].all())
+        self.assertFalse(mask.all(), "Cells between the clusters should be skipped")
+
+    def test_occupancy_needs_positive_distance(self):
+        """Test that bins can't be sized by a distance that isn't positive"""
+        for max_distance in (0, -500):
+            with self.assertRaises(ValueError):
+                build_occupancy(self.points, max_distance)
+
+    def test_far_cells_are_nodata(self):
+        """Test that cells with no point within the distance are nodata, not 0, whether or not the occupancy
+        test skips them, and cells within it are interpolated"""
+        cells = np.column_stack((self.grid_x.ravel(), self.grid_y.ravel()))
+        nearest = np.min(np.hypot(cells[:, None, 0] - self.points[None, :, 0],
+                                  cells[:, None, 1] - self.points[None, :, 1]), axis=1)
+        for type_ in ("IDW", "Density"):
+            result = interpolate(self.points, self.values, self.grid_x, self.grid_y, type_, max_distance=500)
+            self.assertTrue(np.isnan(result[50, 50]))
+            self.assertTrue(np.isnan(result.ravel()[nearest > 500]).all())
+            self.assertGreater(result[5, 5], 0)
+            self.assertFalse(np.isnan(result.ravel()[nearest <= 500]).any())
+
+    def test_far_cells_written_as_nodata(self):
+        """Test that far cells are the GeoTIFF's nodata, left out of the statistics, transparent and null in the
+        pixel index, in memory and streamed"""
+        rng = np.random.default_rng(4)
+        data = pd.DataFrame({"lat": np.concatenate([rng.uniform(43.5, 43.55, 200), rng.uniform(43.75, 43.8, 200)]),
+                             "lon": np.concatenate([rng.uniform(-80.0, -79.95, 200), rng.uniform(-79.2, -79.15, 200)]),
+                             "value": rng.uniform(1, 10, 400)})
+        with tempfile.TemporaryDirectory() as memmap_dir:
+            for options in ({}, {"memmap_dir": memmap_dir}):
+                out = BytesIO()
+                rendered = generate_raster_file(data, out, {"value": [1.0, "IDW"]}, ["lat", "lon"],
+                                                max_distance=2000, **options)
+                far = np.isnan(rendered["grid"])
+                self.assertTrue(far.any())
+                self.assertEqual(rendered["stats"]["cells"], rendered["grid"].size - far.sum())
+                self.assertEqual(rendered["stats"]["max"], np.nanmax(rendered["grid"]))
+
+                with rasterio.open(out) as raster:
+                    self.assertTrue(np.isnan(raster.nodata))
+                    values = raster.read(1)
+                    y, x = np.argwhere(np.isnan(values))[0]
+                self.assertIsNone(img_to_pixel(out)[f"{x},{y}"]["name"])
+                image = BytesIO()
+                convert_to_alpha(out, out_fp=image)
+                self.assertEqual(Image.open(image).getpixel((int(x), int(y)))[1], 0)
+                del rendered, far
+
+    def test_unbounded_matches_default(self):
+        """Test that near cells use the same neighbours as without a distance when all are within it"""
+        bounded = interpolate(self.points, self.values, self.grid_x, self.grid_y, "IDW", max_distance=1e6)
+        unbounded = interpolate(self.points, self.values, self.grid_x, self.grid_y, "IDW")
+        np.testing.assert_allclose(bounded, unbounded)
+
+
+class TestRenderEstimate(unittest.TestCase):
+    """Tests for the render memory estimate used by admission control"""
+
+    def setUp(self):
+        """Set up a small set of points"""
+        rng = np.random.default_rng(3)
+        self.data = pd.DataFrame({"lat": rng.uniform(45, 45.5, 300), "lon": rng.uniform(-75, -74.5, 300),
+                                  "value": rng.uniform(1, 10, 300)})
+
+    def test_grid_shape_matches_render(self):
+        """Test that the estimated grid shape is the shape actually rendered"""
+        rendered = generate_raster_file(self.data, BytesIO(), {"value": [1.0, "IDW"]}, ["lat", "lon"])
+        self.assertEqual(sorted(estimate_grid_shape(self.data, ["lat", "lon"])), sorted(rendered["grid"].shape))
+        # Appends cover the stored grid's extent too
+        self.assertEqual(estimate_grid_shape(self.data[:10], ["lat", "lon"], rendered["bounds"]),
+                         rendered["grid"].shape)
+
+    def test_estimate_scales(self):
+        """Test that the estimate grows with points and cells, and shrinks with memmap and float32"""
+        base = estimate_render_memory(1000, 3, (500, 500))
+        self.assertGreater(estimate_render_memory(100000, 3, (500, 500)), base)
+        self.assertGreater(estimate_render_memory(1000, 3, (1000, 1000)), base)
+        self.assertLess(estimate_render_memory(1000, 3, (500, 500), memmap=True), base)
+        self.assertLess(estimate_render_memory(1000, 3, (500, 500), precision="float32"), base)
+
+    def test_preview_is_coarse(self):
+        """Test that a preview samples the points and renders a coarser grid over the same area"""
+        full = generate_raster_file(self.data, BytesIO(), {"value": [1.0, "IDW"]}, ["lat", "lon"])
+        preview = render_preview(self.data, BytesIO(), {"value": [1.0, "IDW"]}, ["lat", "lon"], points=100)
+        self.assertEqual(preview["points"], 100)
+        self.assertEqual(preview["res"], 8 * full["res"])
+        self.assertEqual(preview["grid"].shape, tuple(-(-n // 8) for n in full["grid"].shape))
+
+
+class TestGenerateRasterFiles(unittest.TestCase):
+    """Tests for rendering several layers from one set of points"""
+
+    def setUp(self):
+        """Set up points with two value columns"""
+        rng = np.random.default_rng(5)
+        self.data = pd.DataFrame({"lat": rng.uniform(45, 45.5, 300), "lon": rng.uniform(-75, -74.5, 300),
+                                  "value": rng.uniform(1, 10, 300), "other": rng.uniform(0, 5, 300)})
+        self.col_weights = [{"value": [1.0, "IDW"]}, {"other": [2.0, "Density"]},
+                            {"value": [1.0, "Nearest"], "Count": [0.5, "IDW"]}]
+
+    def test_batch_matches_single_renders(self):
+        """Test that every layer of a batch is the layer rendered on its own"""
+        for thinning in (None, 4):
+            results = generate_raster_files(self.data, [(BytesIO(), col_weight) for col_weight in self.col_weights],
+                                            ["lat", "lon"], thinning=thinning)
+            for col_weight, batched in zip(self.col_weights, results):
+                single = generate_raster_file(self.data, BytesIO(), col_weight, ["lat", "lon"], thinning=thinning)
+                np.testing.assert_allclose(batched["grid"], single["grid"])
+                self.assertEqual(batched["points"], single["points"])
+
+    def test_failed_layer_does_not_fail_batch(self):
+        """Test that a layer weighting a missing column fails alone"""
+        results = generate_raster_files(self.data, [(BytesIO(), {"missing": [1.0, "IDW"]}),
+                                                    (BytesIO(), self.col_weights[0])], ["lat", "lon"])
+        self.assertIsInstance(results[0], Exception)
+        self.assertNotIsInstance(results[1], Exception)
+
+    def test_invalid_thinning(self):
+        """Test that thinning by a factor that isn't positive fails the batch"""
+        for thinning in (0, -2):
+            result = generate_raster_files(self.data, [(BytesIO(), self.col_weights[0])], ["lat", "lon"],
+                                           thinning=thinning)
+            self.assertIsInstance(result, ValueError)
+
+    def test_invalid_max_distance(self):
+        """Test that an influence distance that isn't positive fails the batch"""
+        for max_distance in (0, -500.0, float("nan")):
+            result = generate_raster_files(self.data, [(BytesIO(), self.col_weights[0])], ["lat", "lon"],
+                                           max_distance=max_distance)
+            self.assertIsInstance(result, ValueError)
+
+
+class TestWindowedStorage(unittest.TestCase):
+    """Tests for storing memory-mapped renders without holding their grid or pixel index in full"""
+
+    def setUp(self):
+        """Set up a directory for memory-mapped grids"""
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def peak(self, function):
+        """Helper to call a function, returning its result and the peak memory it allocated"""
+        tracemalloc.start()
+        try:
+            result = function()
+            return result, tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    def test_grid_store_windowed(self):
+        """Test that a memory-mapped grid is stored holding only a window of it besides the stored bytes"""
+        grid = np.memmap(tempfile.TemporaryFile(dir=self.directory.name), dtype="float64", mode="w+",
+                         shape=(2000, 1500))
+        rng = np.random.default_rng(6)
+        for start in range(0, 2000, 250):
+            grid[start:start + 250] = rng.random((250, 1500))
+        rendered = {"grid": grid, "bounds": (0.0, 0.0, 1.0, 1.0), "res": 1.0, "tile_size": 256,
+                    "tile_radius": np.zeros((8, 6)), "max_distance": None, "thinning": None, "points": 10}
+
+        data, peak = self.peak(lambda: dump_grid(rendered, self.directory.name))
+        self.assertLess(peak - len(data), 2 * WINDOW_BYTES)
+        self.assertLess(peak, grid.nbytes)
+        np.testing.assert_array_equal(load_grid(data)["grid"], grid)
+        self.assertEqual(load_grid(data)["tile_size"], 256)
+
+    def test_pixel_index_windowed(self):
+        """Test that the pixel index is written a window at a time, the same as the index of every pixel"""
+        width, height = 1000, 250
+        with MemoryFile() as memfile:
+            with memfile.open(driver="GTiff", width=width, height=height, count=1, dtype="float32",
+                              crs="EPSG:4326", transform=from_origin(-80.0, 44.0, 0.001, 0.001)) as dst:
+                dst.write(np.random.default_rng(8).random((1, height, width), dtype=np.float32))
+            raster = BytesIO(memfile.read())
+
+        path = os.path.join(self.directory.name, "pix.json")
+        _, peak = self.peak(lambda: write_pix_json(raster, path))
+        # The index itself is over 40 bytes a pixel, 10MB
+        self.assertLess(peak, 4 * 1024 ** 2)
+        with open(path) as file:
+            index = json.load(file)
+        self.assertEqual((index["sizex"], index["sizey"]), (width, height))
+        self.assertEqual(len(index), width * height + 6)
+
+    def test_pixel_index_matches(self):
+        """Test that the windowed pixel index is the same JSON as the index built in full, with nodata and bands"""
+        rng = np.random.default_rng(9)
+        data = pd.DataFrame({"lat": rng.uniform(43.5, 43.8, 300), "lon": rng.uniform(-80, -79, 300),
+                             "v": rng.uniform(0, 10, 300), "w": rng.uniform(0, 1, 300)})
+        out = BytesIO()
+        generate_raster_file(data, out, {"v": [1.0, "IDW"], "w": [1.0, "IDW"]}, ["lat", "lon"], bands=True,
+                             max_distance=3000)
+        text = StringIO()
+        write_pix_json(out, text)
+        self.assertEqual(text.getvalue(), json.dumps(img_to_pixel(out)))
+
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)
\ No newline at end of file
@@ -0,0 +1,38 @@
+import unittest
+from backend.data_manipulation.instrumentation import Registry, stage, STAGE_SECONDS
+
+
+class TestHistogram(unittest.TestCase):
+    """Tests for the Prometheus histograms"""
+
+    def test_exposition(self):
+        """Test that buckets are cumulative, with +Inf equal to the count"""
+        registry = Registry()
+        histogram = registry.histogram("test_seconds", "Test durations", ["stage"], buckets=(1, 5))
+        for value in (0.5, 2, 2, 10):
+            histogram.observe(value, "parse")
+        lines = registry.expose().splitlines()
+
+        self.assertIn("# TYPE test_seconds histogram", lines)
+        self.assertIn('test_seconds_bucket{stage="parse",le="1.0"} 1', lines)
+        self.assertIn('test_seconds_bucket{stage="parse",le="5.0"} 3', lines)
+        self.assertIn('test_seconds_bucket{stage="parse",le="+Inf"} 4', lines)
+        self.assertIn('test_seconds_sum{stage="parse"} 14.5', lines)
+        self.assertIn('test_seconds_count{stage="parse"} 4', lines)
+
+    def test_labels_required(self):
+        """Test that observations must give every label"""
+        histogram = Registry().histogram("test_seconds", "Test durations", ["stage"])
+        with self.assertRaises(ValueError):
+            histogram.observe(1)
+
+    def test_stage_records_on_error(self):
+        """Test that a stage is timed even if it raises"""
+        with self.assertRaises(RuntimeError):
+            with stage("test_failing_stage"):
+                raise RuntimeError
+        self.assertIn('raster_stage_seconds_count{stage="test_failing_stage"} 1', STAGE_SECONDS.expose())
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
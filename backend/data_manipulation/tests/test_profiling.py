@@ -0,0 +1,48 @@
+import unittest
+import numpy as np
+from backend.data_manipulation.instrumentation import stage
+from backend.data_manipulation.profiling import Profiler, profiled
+
+
+class TestProfiler(unittest.TestCase):
+    """Tests for the cProfile/tracemalloc profiler"""
+
+    def test_stage_peaks(self):
+        """Test that each stage reports its own peak, and the profile the largest"""
+        with profiled() as report:
+            with stage("test_small"):
+                small = np.ones(1000)
+            with stage("test_large"):
+                large = np.ones(1_000_000)
+                del large
+            del small
+
+        stages = report["stages"]
+        self.assertEqual(stages["test_small"]["calls"], 1)
+        self.assertGreaterEqual(stages["test_large"]["peakMemory"], 8_000_000)
+        self.assertLess(stages["test_small"]["peakMemory"], 8_000_000)
+        self.assertGreaterEqual(report["peakMemory"], stages["test_large"]["peakMemory"])
+        self.assertTrue(report["functions"])
+
+    def test_nested_stage_peak(self):
+        """Test that a stage's peak includes the peak of stages nested in it"""
+        with profiled() as report:
+            with stage("test_outer"):
+                with stage("test_inner"):
+                    large = np.ones(1_000_000)
+                    del large
+                small = np.ones(1000)
+                del small
+
+        self.assertGreaterEqual(report["stages"]["test_outer"]["peakMemory"],
+                                report["stages"]["test_inner"]["peakMemory"])
+
+    def test_one_profile_at_a_time(self):
+        """Test that a second profile cannot start while one is running"""
+        with profiled():
+            with self.assertRaises(RuntimeError):
+                Profiler().start()
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -2,7 +2,8 @@ import unittest
 from io import BytesIO
 import tempfile
 import os
-from backend.data_manipulation.provide_columns import provide_columns, detect_delimiter
+from backend.data_manipulation.provide_columns import provide_columns, detect_delimiter, sample_columns, \
+    validate_columns
 
 
 class TestProvideColumns(unittest.TestCase):
@@ -173,5 +174,77 @@ Jane Smith,Los Angeles,USA"""
         self.assertNotIn('Status', columns)
 
 
+class TestSampledColumns(unittest.TestCase):
+    """Tests for column discovery from a bounded sample of a large file"""
+
+    def create_large_csv(self, rows=20000, encoding='utf-8', bad_row=None):
+        """Helper to create a CSV much larger than the sample budget"""
+        lines = ["name,value,latitude,longitude"]
+        for i in range(rows):
+            value = "unknown" if i == bad_row else str(i * 0.5)
+            lines.append(f"Station {i},{value},{40 + i * 1e-5:.5f},{-74 - i * 1e-5:.5f}")
+        return BytesIO("\n".join(lines).encode(encoding))
+
+    def test_sample_matches_full_parse(self):
+        """Test that sampling finds the same numeric columns as a full parse"""
+        csv_bytes = self.create_large_csv()
+        sampled = provide_columns(csv_bytes, sample_bytes=16 * 1024)
+        full = provide_columns(csv_bytes)
+        self.assertEqual(sampled, full)
+        self.assertEqual(sampled, ['value', 'latitude', 'longitude'])
+
+    def test_sample_reads_strides(self):
+        """Test that a non-numeric value deep in the file is caught by a stride, and missed by the head alone"""
+        sample_bytes, strides = 8 * 1024, 4
+        clean = self.create_large_csv().getvalue()
+        # The row in the middle of the third window through the body
+        head_bytes = sample_bytes // 2
+        offset = (head_bytes + (len(clean) - head_bytes) * 3 // (strides + 1)
+                  + (sample_bytes - head_bytes) // strides // 2)
+        csv_bytes = self.create_large_csv(bad_row=clean[:offset].count(b"\n") - 1)
+
+        columns = sample_columns(csv_bytes, sample_bytes=sample_bytes, strides=strides)
+        self.assertEqual(columns, ['latitude', 'longitude'])
+        self.assertEqual(csv_bytes.tell(), 0)
+
+        columns = sample_columns(csv_bytes, sample_bytes=sample_bytes, strides=0)
+        self.assertIn('value', columns, "Head-only sample should not see the bad row")
+
+    def test_sample_file_path(self):
+        """Test that a file given by its path is sampled like a file object"""
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "large.csv")
+            with open(path, "wb") as f:
+                f.write(self.create_large_csv().getvalue())
+            self.assertEqual(provide_columns(path, sample_bytes=16 * 1024), ['value', 'latitude', 'longitude'])
+            self.assertEqual(provide_columns(path), ['value', 'latitude', 'longitude'])
+
+    def test_small_file_is_fully_parsed(self):
+        """Test that files within the budget skip sampling"""
+        csv_content = """name,age,latitude,longitude
+John Doe,30,40.7128,-74.0060"""
+        columns = provide_columns(BytesIO(csv_content.encode('utf-8')), sample_bytes=1024 * 1024)
+        self.assertEqual(columns, ['age', 'latitude', 'longitude'])
+
+    def test_sample_utf16(self):
+        """Test sampling a UTF-16 file, where strides must stay aligned to code units"""
+        csv_bytes = self.create_large_csv(rows=5000, encoding='utf-16')
+        columns = provide_columns(csv_bytes, sample_bytes=16 * 1024)
+        self.assertEqual(columns, ['value', 'latitude', 'longitude'])
+
+    def test_sample_latin1(self):
+        """Test sampling a Latin-1 file"""
+        lines = ["name,value"] + [f"José {i},{i}" for i in range(5000)]
+        csv_bytes = BytesIO("\n".join(lines).encode('latin-1'))
+        columns = provide_columns(csv_bytes, sample_bytes=4 * 1024)
+        self.assertEqual(columns, ['value'])
+
+    def test_validation_rejects_late_non_numeric(self):
+        """Test that the full validation pass drops a column with a non-numeric value past the sample"""
+        csv_bytes = self.create_large_csv(bad_row=15000)
+        columns = validate_columns(csv_bytes, ['value', 'latitude', 'longitude'], chunksize=1000)
+        self.assertEqual(columns, ['latitude', 'longitude'])
+
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)
\ No newline at end of file
@@ -0,0 +1,137 @@
+import tempfile
+import unittest
+from io import BytesIO
+import numpy as np
+import pandas as pd
+from backend.data_manipulation.generate_raster_file import generate_raster_file
+from backend.data_manipulation.raster_stats import RasterStats, STATS_BINS, FINE_BINS
+from backend.data_manipulation.instrumentation import stage_listeners
+
+
+class TestRasterStats(unittest.TestCase):
+    """Tests for raster statistics accumulated as grids are written"""
+
+    def setUp(self):
+        """Set up a skewed grid"""
+        self.grid = np.random.default_rng(0).gamma(2.0, 3.0, size=(120, 80))
+
+    def accumulate(self, grid, window_size=None):
+        """Helper to accumulate a grid's statistics from its normalized values, optionally window by window"""
+        maximum = grid.max()
+        stats = RasterStats(grid.min(), maximum)
+        window_size = window_size or len(grid)
+        for start in range(0, len(grid), window_size):
+            stats.add(grid[start:start + window_size] / maximum)
+        return stats.result()
+
+    def test_matches_numpy(self):
+        """Test that the statistics match numpy's, percentiles to within a fine histogram bin"""
+        stats = self.accumulate(self.grid)
+        self.assertEqual(stats["cells"], self.grid.size)
+        self.assertEqual(stats["min"], self.grid.min())
+        self.assertEqual(stats["max"], self.grid.max())
+        self.assertAlmostEqual(stats["mean"], self.grid.mean())
+        self.assertAlmostEqual(stats["std"], self.grid.std())
+
+        tolerance = (self.grid.max() - self.grid.min()) / FINE_BINS
+        for name, value in stats["percentiles"].items():
+            self.assertAlmostEqual(value, np.percentile(self.grid, int(name[1:])), delta=tolerance)
+
+        histogram = stats["histogram"]
+        self.assertEqual(len(histogram["counts"]), STATS_BINS)
+        self.assertEqual(sum(histogram["counts"]), self.grid.size)
+        self.assertAlmostEqual(histogram["edges"][0], self.grid.min())
+        self.assertAlmostEqual(histogram["edges"][-1], self.grid.max())
+
+    def test_windows_match_whole_grid(self):
+        """Test that accumulating window by window gives the same statistics as the whole grid"""
+        whole = self.accumulate(self.grid)
+        windowed = self.accumulate(self.grid, window_size=7)
+        self.assertEqual(windowed["histogram"], whole["histogram"])
+        self.assertEqual(windowed["percentiles"], whole["percentiles"])
+        self.assertAlmostEqual(windowed["mean"], whole["mean"])
+
+    def test_all_negative_grid(self):
+        """Test that a grid of only negative values, normalized by a negative maximum, is binned over its range"""
+        self.grid = -self.grid - 1.0
+        self.test_matches_numpy()
+
+    def test_empty_grid(self):
+        """Test that an all zero grid, which normalizes to NaN, has no mean or percentiles"""
+        grid = np.zeros((10, 10))
+        stats = RasterStats(0, 0)
+        with np.errstate(invalid="ignore"):
+            stats.add(grid / 0)
+        result = stats.result()
+        self.assertEqual(result["cells"], 0)
+        self.assertIsNone(result["mean"])
+        self.assertIsNone(result["percentiles"]["p50"])
+
+    def test_nodata_skipped(self):
+        """Test that nodata (NaN) cells are left out, and a grid of nodata only has no range"""
+        grid = np.array([[np.nan, 2.0], [4.0, np.nan]])
+        stats = RasterStats(2.0, 4.0)
+        stats.add(grid / 4.0)
+        result = stats.result()
+        self.assertEqual(result["cells"], 2)
+        self.assertAlmostEqual(result["mean"], 3.0)
+        self.assertEqual(sum(result["histogram"]["counts"]), 2)
+
+        stats = RasterStats(np.nan, np.nan)
+        stats.add(np.full((3, 3), np.nan))
+        result = stats.result()
+        self.assertEqual((result["cells"], result["min"], result["max"], result["mean"]), (0, None, None, None))
+
+    def test_render_stats(self):
+        """Test that renders report their grid's statistics, whether written in memory or streamed"""
+        rng = np.random.default_rng(1)
+        data = pd.DataFrame({"latitude": rng.uniform(43.5, 43.8, 2000), "longitude": rng.uniform(-80, -79, 2000),
+                             "value": rng.uniform(0, 10, 2000)})
+        col_weights = {"value": [1.0, "IDW"]}
+        rendered = generate_raster_file(data, BytesIO(), col_weights, ["latitude", "longitude"])
+        stats = rendered["stats"]
+        self.assertEqual(stats["cells"], rendered["grid"].size)
+        self.assertEqual(stats["max"], rendered["grid"].max())
+        self.assertAlmostEqual(stats["mean"], rendered["grid"].mean())
+
+        with tempfile.TemporaryDirectory() as memmap_dir:
+            streamed = generate_raster_file(data, BytesIO(), col_weights, ["latitude", "longitude"],
+                                            memmap_dir=memmap_dir)
+            streamed_stats = streamed["stats"]
+            del streamed
+        self.assertEqual(streamed_stats["histogram"], stats["histogram"])
+        self.assertAlmostEqual(streamed_stats["std"], stats["std"])
+
+    def test_stages_match_streamed(self):
+        """Test that in-memory and streamed writes each record one reproject stage with stats nested in it"""
+        rng = np.random.default_rng(2)
+        data = pd.DataFrame({"latitude": rng.uniform(43.5, 43.8, 500), "longitude": rng.uniform(-80, -79, 500),
+                             "value": rng.uniform(0, 10, 500)})
+
+        class Recorder:
+            def __init__(self):
+                self.stack, self.nested = [], []
+
+            def enter_stage(self, name):
+                self.stack.append(name)
+
+            def exit_stage(self, name, elapsed):
+                self.stack.pop()
+                if name in ("reproject", "stats"):
+                    self.nested.append((name, tuple(self.stack)))
+
+        for memmap in (False, True):
+            recorder = Recorder()
+            stage_listeners.append(recorder)
+            try:
+                with tempfile.TemporaryDirectory() as memmap_dir:
+                    generate_raster_file(data, BytesIO(), {"value": [1.0, "IDW"]}, ["latitude", "longitude"],
+                                         memmap_dir=memmap_dir if memmap else None)
+            finally:
+                stage_listeners.remove(recorder)
+            self.assertEqual([name for name, _ in recorder.nested], ["stats", "reproject"])
+            self.assertEqual(recorder.nested[0][1][-1], "reproject")
+
+
+if __name__ == '__main__':
+    unittest.main()
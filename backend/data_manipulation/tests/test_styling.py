@@ -0,0 +1,68 @@
+import unittest
+import numpy as np
+import pandas as pd
+import rasterio
+from io import BytesIO
+from PIL import Image
+from backend.data_manipulation.generate_raster_file import generate_raster_file
+from backend.data_manipulation.styling import normalize_style, lookup_table, style_hash, style_image, \
+    quantize_raster, load_quantized, quantized_from_image, QUANTIZED_LEVELS
+
+
+class TestStyling(unittest.TestCase):
+    """Tests for styling quantized layer values through lookup tables"""
+
+    def test_default_style_is_value_as_alpha(self):
+        """Test that the default style is black, with the value as opacity and no data transparent"""
+        table = lookup_table(normalize_style({}))
+        self.assertEqual(table.shape, (256, 4))
+        self.assertTrue((table[:, :3] == 0).all())
+        np.testing.assert_array_equal(table[:, 3], np.arange(256))
+
+    def test_range_and_opacity(self):
+        """Test that values below the range are transparent and values above it take the last colour"""
+        style = normalize_style({"ramp": ["#0000ff", "#ff0000"], "min": 0.5, "max": 0.75, "opacity": 0.5,
+                                 "alpha": "constant", "levels": QUANTIZED_LEVELS})
+        table = lookup_table(style)
+        self.assertEqual(len(table), QUANTIZED_LEVELS)
+        self.assertTrue((table[:QUANTIZED_LEVELS // 2 - 1, 3] == 0).all())
+        np.testing.assert_array_equal(table[-1], [255, 0, 0, 128])
+        np.testing.assert_array_equal(table[QUANTIZED_LEVELS // 2 + 1, :3], [0, 0, 255])
+
+    def test_invalid_styles(self):
+        """Test that invalid styles are rejected"""
+        for style in ({"ramp": "nope"}, {"ramp": ["red"]}, {"min": 1, "max": 0}, {"opacity": 2},
+                      {"levels": 1024}, {"colour": "#000000"}):
+            with self.assertRaises(ValueError):
+                normalize_style(style)
+
+    def test_style_hash_is_canonical(self):
+        """Test that equivalent styles share a hash and different ones don't"""
+        self.assertEqual(style_hash(normalize_style({})), style_hash(normalize_style({"ramp": "black", "min": 0})))
+        self.assertNotEqual(style_hash(normalize_style({})), style_hash(normalize_style({"opacity": 0.5})))
+
+    def test_styled_image_matches_raster(self):
+        """Test that a rendered layer quantizes and styles to an image the size of its raster"""
+        rng = np.random.default_rng(2)
+        data = pd.DataFrame({"lat": rng.uniform(45, 45.5, 300), "lon": rng.uniform(-75, -74.5, 300),
+                             "value": rng.uniform(1, 10, 300)})
+        raster = BytesIO()
+        generate_raster_file(data, raster, {"value": [1.0, "IDW"]}, ["lat", "lon"])
+        quantized = load_quantized(quantize_raster(raster))
+        with rasterio.open(BytesIO(raster.getvalue())) as dataset:
+            values = np.nan_to_num(dataset.read(1))
+        np.testing.assert_allclose(quantized / (QUANTIZED_LEVELS - 1), values, atol=1 / QUANTIZED_LEVELS)
+
+        image = Image.open(BytesIO(style_image(quantized, normalize_style({"ramp": "viridis"}))))
+        self.assertEqual(image.mode, "RGBA")
+        self.assertEqual(image.size, (values.shape[1], values.shape[0]))
+
+    def test_quantized_from_image(self):
+        """Test that layers without a quantized grid are styled from their image's opacity"""
+        image = BytesIO()
+        Image.fromarray(np.array([[[0, 0], [0, 255]]], dtype=np.uint8), "LA").save(image, format="PNG")
+        np.testing.assert_array_equal(quantized_from_image(image.getvalue()), [[0, QUANTIZED_LEVELS - 1]])
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,31 @@
+import unittest
+from backend.data_manipulation.synthetic import synthetic_points, DISTRIBUTIONS, DEFAULT_BOUNDS
+
+
+class TestSyntheticPoints(unittest.TestCase):
+    """Tests for the synthetic point generator"""
+
+    def test_deterministic(self):
+        """Test that the same arguments always give the same points"""
+        for distribution in DISTRIBUTIONS:
+            self.assertTrue(synthetic_points(1000, distribution).equals(synthetic_points(1000, distribution)))
+        self.assertFalse(synthetic_points(1000, seed=1).equals(synthetic_points(1000, seed=2)))
+
+    def test_within_bounds(self):
+        """Test that every point lies in the extent, with positive values"""
+        west, south, east, north = DEFAULT_BOUNDS
+        for distribution in DISTRIBUTIONS:
+            data = synthetic_points(5000, distribution)
+            self.assertEqual(len(data), 5000)
+            self.assertTrue(data["lon"].between(west, east).all())
+            self.assertTrue(data["lat"].between(south, north).all())
+            self.assertTrue((data["value"] >= 0).all())
+
+    def test_unknown_distribution(self):
+        """Test that an unknown distribution is rejected"""
+        with self.assertRaises(ValueError):
+            synthetic_points(10, "gaussian")
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
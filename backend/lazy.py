@@ -0,0 +1,39 @@
+import importlib
+import time
+
+# Modules imported on first use rather than at startup, since together they take seconds to load
+lazy_modules = []
+
+
+def lazy_imports(module: str, *names):
+    """
+    Stand-ins for functions of a module, importing the module on their first call.
+        Parameters:
+                module (str): module name
+                names (str): names of the functions
+        Returns:
+                One callable per name, or the callable itself for a single name
+    """
+    if module not in lazy_modules:
+        lazy_modules.append(module)
+
+    def stand_in(name):
+        def call(*args, **kwargs):
+            return getattr(importlib.import_module(module), name)(*args, **kwargs)
+        call.__name__ = call.__qualname__ = name
+        return call
+
+    stand_ins = tuple(stand_in(name) for name in names)
+    return stand_ins[0] if len(stand_ins) == 1 else stand_ins
+
+
+def prewarm() -> float:
+    """
+    Import every lazily imported module now.
+        Returns:
+                The time taken in seconds
+    """
+    start = time.perf_counter()
+    for module in lazy_modules:
+        importlib.import_module(module)
+    return time.perf_counter() - start
@@ -1,16 +1,229 @@
 import json
 import base64
 import logging
+import os
 import signal
 import sys
-from waitress import serve
-from flask import request, jsonify
+import time
+import threading
+import uuid
+from collections import OrderedDict
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from waitress import create_server
+from flask import request, jsonify, send_file, g, Response
+from werkzeug.exceptions import RequestEntityTooLarge
 from config import app, db, main_logger
 from models import RasterLayer
 from io import BytesIO, StringIO
-from data_manipulation.generate_raster_file import generate_raster_file
-from data_manipulation.getImage import write_pix_json, convert_to_alpha
-from data_manipulation.provide_columns import provide_columns
+from data_manipulation.instrumentation import REGISTRY, SIZE_BUCKETS, stage
+from data_manipulation.profiling import Profiler
+from render_scheduler import RenderScheduler, RenderRejected
+from responses import ResponseEncoder, CompressedCache, stored_items
+from spatial_index import create_spatial_index, parse_bbox, intersecting
+from lazy import lazy_imports, prewarm
+from uploads import UploadRequest
+
+# The rendering stack (pandas, geopandas, scipy, xarray, rasterio, sklearn...) is imported on first use,
+# so read-only routes are served without waiting for it
+(generate_raster_file, generate_raster_files, append_raster_file, read_csv_data, render_preview,
+ estimate_grid_shape, estimate_render_memory, estimate_parse_memory) = lazy_imports(
+    "data_manipulation.generate_raster_file", "generate_raster_file", "generate_raster_files", "append_raster_file",
+    "read_csv_data", "render_preview", "estimate_grid_shape", "estimate_render_memory", "estimate_parse_memory")
+to_columnar, append_columnar, columnar_columns, read_columnar = lazy_imports(
+    "data_manipulation.columnar", "to_columnar", "append_columnar", "columnar_columns", "read_columnar")
+dump_grid, load_grid, grid_info = lazy_imports("data_manipulation.grid_store", "dump_grid", "load_grid",
+                                               "grid_info")
+composite_grid, estimate_composite_memory, GridCache = lazy_imports("data_manipulation.composite", "composite_grid",
+                                                                  "estimate_composite_memory", "GridCache")
+write_pix_json, convert_to_alpha, raster_bounds = lazy_imports("data_manipulation.getImage", "write_pix_json",
+                                                               "convert_to_alpha", "raster_bounds")
+(quantize_raster, load_quantized, quantized_from_image, normalize_style, style_hash,
+ style_image) = lazy_imports("data_manipulation.styling", "quantize_raster", "load_quantized", "quantized_from_image",
+                             "normalize_style", "style_hash", "style_image")
+provide_columns, validate_columns = lazy_imports("data_manipulation.provide_columns", "provide_columns",
+                                                 "validate_columns")
+
+# Background full-file column validations, keyed by validation id, oldest first, shared by request threads
+validation_executor = ThreadPoolExecutor(max_workers=1)
+column_validations = OrderedDict()
+validations_lock = threading.Lock()
+
+# Admits renders against the memory budget
+render_scheduler = RenderScheduler(app.config["RENDER_MEMORY_BUDGET"], app.config["RENDER_QUEUE_LIMIT"],
+                                   app.config["RENDER_QUEUE_TIMEOUT"], app.config["RENDER_RETRY_AFTER"])
+
+# Uploaded files are spooled to disk as they stream in, hashed and size-limited
+app.request_class = UploadRequest
+
+# Serializes and compresses json responses
+responses = ResponseEncoder(app.config["COMPRESSION_THRESHOLD"], app.config["COMPRESSION_CACHE_BYTES"])
+
+# Styled layer images, keyed by render id and style hash
+styled_images = CompressedCache(app.config["STYLE_CACHE_BYTES"])
+
+# Decoded grids of the layers composited recently, keyed by render id; created on first use,
+# since it imports the rendering stack
+grid_cache = None
+
+# Full renders of previewed layers
+render_executor = ThreadPoolExecutor(max_workers=app.config["RENDER_WORKERS"])
+
+def render_options():
+    """Rendering options for generate_raster_file, from the app config"""
+    return {
+        "max_distance": app.config["MAX_INFLUENCE_DISTANCE"],
+        "thinning": app.config["THINNING"],
+        "precision": app.config["RENDER_PRECISION"],
+        "memmap_dir": app.config["MEMMAP_DIR"]
+    }
+
+
+def form_flag(value) -> bool:
+    """Whether a boolean form field is set"""
+    return str(value).lower() in ("true", "1", "yes", "on")
+
+
+def render_estimate(data, geom, res_scale=1, rows=None, layers=1, bands=0, bounds=None, stored_rows=0):
+    """
+    Estimated peak memory, in bytes, of rendering data (or rows of it) with the configured options,
+    into one or several layers, each with the given number of per-column bands. Appends add the
+    stored_rows already rendered, within the Mercator bounds of their grid
+    """
+    nx, ny = estimate_grid_shape(data, geom, bounds)
+    return estimate_render_memory((len(data) if rows is None else min(rows, len(data))) + stored_rows,
+                                  len(data.columns),
+                                  (-(-nx // res_scale), -(-ny // res_scale)),
+                                  precision=app.config["RENDER_PRECISION"],
+                                  memmap=app.config["MEMMAP_DIR"] is not None, layers=layers, bands=bands)
+
+
+def evict_render(layer):
+    """Drop the cached responses of a layer's current render, once it is replaced or deleted"""
+    responses.evict(("raster", layer.render_id), ("stats", layer.render_id))
+    styled_images.evict(lambda key: key[0] == layer.render_id)
+    if grid_cache is not None:
+        grid_cache.evict(lambda key: key == layer.render_id)
+
+
+def render_rejected(e):
+    """Response for a render refused by the scheduler, with a Retry-After header when it is worth retrying"""
+    response = jsonify({"message": str(e)})
+    response.status_code = e.status
+    if e.retry_after is not None:
+        response.headers["Retry-After"] = str(e.retry_after)
+    return response
+
+
+@app.errorhandler(RequestEntityTooLarge)
+def upload_too_large(e):
+    """Response for an upload over MAX_UPLOAD_BYTES, rejected while it was streaming in"""
+    return jsonify({"message": e.description}), 413
+
+
+# Reports of profiled requests, keyed by profile id, oldest first
+profiles = OrderedDict()
+
+# Latency and payload sizes of every request, by route
+REQUEST_SECONDS = REGISTRY.histogram("http_request_duration_seconds", "Request latency",
+                                     ["route", "method", "status"])
+REQUEST_BYTES = REGISTRY.histogram("http_request_size_bytes", "Request body size",
+                                   ["route", "method"], SIZE_BUCKETS)
+RESPONSE_BYTES = REGISTRY.histogram("http_response_size_bytes", "Response body size",
+                                    ["route", "method"], SIZE_BUCKETS)
+
+
+@app.before_request
+def start_request_timer():
+    """Marks the start of a request, for its latency"""
+    g.request_start = time.perf_counter()
+
+
+@app.before_request
+def start_profiler():
+    """Profiles the request if profiling is enabled and the request asks for it"""
+    if not app.config["PROFILING"]:
+        return
+    if request.headers.get("X-Profile", "").lower() not in ("1", "true") and \
+            request.args.get("profile", "").lower() not in ("1", "true"):
+        return
+
+    profiler = Profiler()
+    try:
+        profiler.start()
+    except RuntimeError as e:
+        main_logger.warning(f"Request not profiled: {e}")
+        return
+    g.profiler = profiler
+
+
+@app.after_request
+def store_profile(response):
+    """Stores the report of a profiled request, and returns its id in the X-Profile-Id header"""
+    profiler = g.pop("profiler", None)
+    if profiler is None:
+        return response
+
+    report = profiler.stop()
+    profile_id = uuid.uuid4().hex
+    report.update({"id": profile_id, "route": request.path, "method": request.method,
+                   "status": response.status_code})
+    profiles[profile_id] = report
+    while len(profiles) > app.config["PROFILE_HISTORY"]:
+        profiles.popitem(last=False)
+    response.headers["X-Profile-Id"] = profile_id
+    return response
+
+
+@app.teardown_request
+def stop_profiler(error):
+    """Stops the profiler of a request that failed before its report was stored"""
+    profiler = g.pop("profiler", None)
+    if profiler is not None:
+        profiler.stop()
+
+
+@app.route("/profiles/<string:profile_id>", methods=["GET"])
+def get_profile(profile_id: str):
+    """
+    Retrieve the report of a profiled request
+    Query Parameters:
+            profile_id (str): id returned in the X-Profile-Id header of the request
+    Returns:
+            JSON: The wall time and peak memory of the request, the time and peak memory of each
+            rendering stage, and the functions with the most cumulative time.
+    """
+    report = profiles.get(profile_id)
+    if report is None:
+        return jsonify({"message": "Profile not found"}), 404
+    return jsonify(report)
+
+
+@app.after_request
+def record_request_metrics(response):
+    """Records the latency and payload sizes of a request under its route pattern"""
+    route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    if "request_start" in g:
+        REQUEST_SECONDS.observe(time.perf_counter() - g.request_start, route, request.method, response.status_code)
+    REQUEST_BYTES.observe(request.content_length or 0, route, request.method)
+    size = response.content_length
+    if size is None and not response.is_streamed:
+        size = response.calculate_content_length()
+    if size is not None:
+        RESPONSE_BYTES.observe(size, route, request.method)
+    return response
+
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    """
+    Exposes rendering stage timings, request latencies and payload sizes.
+
+    Returns:
+            Every metric in the Prometheus text format.
+    """
+    return Response(REGISTRY.expose(), mimetype="text/plain; version=0.0.4")
+
 
 def handle_sigterm(signum, frame):
     """Handles a sigterm, if thrown by the interpreter"""
@@ -21,33 +234,104 @@ def handle_sigterm(signum, frame):
 @app.route("/layers", methods=["GET"])
 def get_layers():
     """
-    Retrieves all stored raster layers.
-
+    Retrieves the stored raster layers.
+    Query Parameters:
+            bbox (str): optional "west,south,east,north" in degrees; only layers intersecting it are listed
     Returns:
-            JSON: A list of all layer objects in the database.
+            JSON: A list of the layer objects in the database.
     """
-    layers = RasterLayer.query.all()
+    query = RasterLayer.query
+    if request.args.get("bbox"):
+        try:
+            query = intersecting(query, parse_bbox(request.args["bbox"]))
+        except ValueError as e:
+            return jsonify({"message": str(e)}), 400
+    layers = query.all()
     json_layers = list(map(lambda x: x.to_json(), layers))
-    return jsonify({"layers": json_layers})
+    return responses.json({"layers": json_layers})
+
+
+@app.route("/render_budget", methods=["GET"])
+def get_render_budget():
+    """
+    Reports the render memory budget and its current use.
+
+    Returns:
+            JSON: The budget and memory held in bytes, and the number of running and queued renders.
+    """
+    return jsonify(render_scheduler.usage())
 
 
 @app.route("/upload", methods=["POST"])
 def upload_file():
     """
-    Retrieves a csv file, and provides all numerical columns for that file
+    Retrieves a csv file, and provides all numerical columns for that file.
+    Large files are only sampled; a full validation pass of the sampled columns
+    can be requested with the form field validate=true
     Returns:
-            JSON: A list of all numerical columns found.
+            JSON: A list of all numerical columns found, and the id of the
+            background validation if one was requested.
     """
+    # Outside the try, so uploads over the size limit are answered as such
+    file = request.files.get('file')
+    validate = request.form.get("validate") == "true"
     try:
-        file = request.files['file']
-        columns = provide_columns(file.stream)
-        return jsonify({"columns": columns})
+        columns = provide_columns(file.stream, app.config["COLUMN_SAMPLE_BYTES"])
+        response = {"columns": columns}
+
+        if validate:
+            # The upload is closed once the request ends, so the validation reads the spooled file
+            # through a duplicate descriptor rather than a copy
+            copy = os.fdopen(os.dup(file.stream.fileno()), "rb")
+            copy.seek(0)
+            validation_id = uuid.uuid4().hex
+            future = validation_executor.submit(_validate_upload, copy, columns)
+            # Closes the copy of validations cancelled before they ran too
+            future.add_done_callback(lambda _: copy.close())
+            with validations_lock:
+                column_validations[validation_id] = future
+                # Validations never collected are dropped, oldest first, and cancelled if they haven't started
+                while len(column_validations) > app.config["VALIDATION_HISTORY"]:
+                    column_validations.popitem(last=False)[1].cancel()
+            response["validationId"] = validation_id
+
+        return jsonify(response)
 
     except Exception as e:
         main_logger.error(e)
         return jsonify({"message": str(e)}), 400
 
 
+def _validate_upload(copy, columns):
+    """Runs the full column validation of an uploaded file copy, which is closed once it is done"""
+    return validate_columns(copy, columns)
+
+
+@app.route("/upload/validation/<string:validation_id>", methods=["GET"])
+def get_column_validation(validation_id: str):
+    """
+    Retrieve the result of a background column validation
+    Query Parameters:
+            validation_id (str): id returned by /upload
+    Returns:
+            JSON: The validation status, and the confirmed numerical columns once done.
+    """
+    with validations_lock:
+        future = column_validations.get(validation_id)
+        if future is None:
+            return jsonify({"message": "Validation not found"}), 404
+
+        if not future.done():
+            return jsonify({"status": "running"})
+
+        del column_validations[validation_id]
+    try:
+        return jsonify({"status": "done", "columns": future.result()})
+    except Exception as e:
+        main_logger.error(e)
+        return jsonify({"status": "failed", "message": str(e)})
+
+
 @app.route("/get_columns/<int:layer_id>", methods=["GET"])
 def get_columns(layer_id: int):
     """
@@ -61,10 +345,34 @@ def get_columns(layer_id: int):
     if not layer:
         return jsonify({"message": "Layer not found"}), 404
 
-    columns = provide_columns(BytesIO(layer.in_csv_data))
+    if layer.composite:
+        columns = []
+    elif layer.in_columnar_data is not None:
+        columns = columnar_columns(layer.in_columnar_data)
+    else:
+        columns = provide_columns(BytesIO(layer.in_csv_data), app.config["COLUMN_SAMPLE_BYTES"])
     return jsonify({"columns": columns})
 
 
+@app.route("/get_source/<int:layer_id>", methods=["GET"])
+def get_source(layer_id: int):
+    """
+    Download the original csv file a layer was created from
+    Query Parameters:
+            layer_id (int): unique id for the database layer
+    Returns:
+            The csv file as an attachment
+    """
+    layer = db.session.get(RasterLayer, layer_id)
+    if not layer:
+        return jsonify({"message": "Layer not found"}), 404
+    if layer.composite:
+        return jsonify({"message": "Composite layers have no source file"}), 404
+
+    return send_file(BytesIO(layer.in_csv_data), mimetype="text/csv", as_attachment=True,
+                     download_name=layer.filename)
+
+
 
 @app.route("/get_raster/<int:layer_id>", methods=["GET"])
 def get_raster(layer_id):
@@ -81,18 +389,76 @@ def get_raster(layer_id):
     if not layer:
         return jsonify({"message": "Layer not found"}), 404
 
-    image = BytesIO(layer.out_img_data)
+    def body():
+        # The stored json index is passed through as is, rather than parsed and serialized again
+        image_base64 = base64.b64encode(layer.out_img_data)
+        return (b'{"layerImage":{"image":"' + image_base64 + b'","contentType":"image/tiff"},"layerJson":'
+                + layer.out_json_data.encode() + b'}')
 
-    json_index = layer.out_json_data
+    return responses.json(body=body, cache_key=("raster", layer.render_id))
 
-    image_base64 = base64.b64encode(image.getvalue()).decode('ascii')
 
-    # Construct the JSON response
-    image_response_data = {
-        "image": image_base64,
-        "contentType": 'image/tiff'  # GEOTIFF MIME TYPE
-    }
-    return jsonify({"layerImage": image_response_data, "layerJson": json.load(StringIO(json_index))})
+@app.route("/stats/<int:layer_id>", methods=["GET"])
+def get_stats(layer_id):
+    """
+    Retrieve the statistics of a layer's render, computed as it was written, without reading the raster
+    Query Parameters:
+            layer_id (int): unique id for the database layer
+    Returns:
+            JSON: The cell counts, min, max (the value the image is normalized by), mean, std, percentiles
+            and a histogram, in the units of the weighted sum
+    """
+    layer = db.session.get(RasterLayer, layer_id)
+
+    if not layer:
+        return jsonify({"message": "Layer not found"}), 404
+    if layer.stats is None:
+        return jsonify({"message": "Layer has no statistics, update it to compute them"}), 404
+
+    return responses.json(body=layer.stats.encode(), cache_key=("stats", layer.render_id))
+
+
+@app.route("/get_styled/<int:layer_id>", methods=["GET"])
+def get_styled(layer_id):
+    """
+    Retrieve a layer's image in a style, from the styled image cache, or with a single lookup table
+    gather over the layer's quantized values. The layer is never re-rendered.
+    Query Parameters:
+            layer_id (int): unique id for the database layer
+            ramp (str): colour ramp name, or comma separated #rrggbb colour stops
+            min, max (float): normalized value range the ramp spans
+            opacity (float): opacity, from 0 to 1
+            alpha (str): "value" to fade in with the value, or "constant"
+            levels (int): lookup table entries, 256 or 65536
+    Returns:
+            The styled PNG
+    """
+    style = request.args.to_dict()
+    if "ramp" in style and "," in style["ramp"]:
+        style["ramp"] = style["ramp"].split(",")
+    try:
+        style = normalize_style(style)
+    except ValueError as e:
+        return jsonify({"message": str(e)}), 400
+
+    layer = db.session.get(RasterLayer, layer_id)
+    if not layer:
+        return jsonify({"message": "Layer not found"}), 404
+
+    # Unique per render, so neither the cache nor a client revalidating its ETag can mix up layers reusing an id
+    key = (layer.render_id, style_hash(style))
+    image = styled_images.get(key)
+    if image is None:
+        if layer.out_quantized_data is not None:
+            quantized = load_quantized(layer.out_quantized_data)
+        else:
+            quantized = quantized_from_image(layer.out_img_data)
+        image = style_image(quantized, style)
+        styled_images.put(key, image)
+
+    response = Response(image, mimetype="image/png")
+    response.set_etag("-".join(str(part) for part in key))
+    return response.make_conditional(request)
 
 
 @app.route("/get_json/<int:layer_id>/<string:coord>", methods=["GET"])
@@ -111,20 +477,17 @@ def get_json(layer_id, coord):
     if not layer:
         return jsonify({"message": "Layer not found"}), 404
 
-    json_index = StringIO(layer.out_json_data)
     if coord == "None":
         find_these_items = ["tbound", "bbound", "lbound", "rbound", "sizex", "sizey"]
     else:
         find_these_items = [coord]
 
-    json_index = json.loads(json_index.getvalue())
-
-    new_json = {}
-    for item in find_these_items:
-        new_json[item] = json_index[item]
-
-    del json_index, find_these_items
-    return jsonify({"jsonFile": new_json})
+    # Only the requested items are decoded from the stored index
+    try:
+        new_json = stored_items(layer.out_json_data, find_these_items)
+    except KeyError as e:
+        return jsonify({"message": f"No item {e} in the layer's index"}), 404
+    return responses.json({"jsonFile": new_json})
 
 
 @app.route("/create_layer", methods=["POST"])
@@ -145,6 +508,8 @@ def create_layer():
     col_weights = col_weights.replace("'", "\"")
     col_weights = json.loads(col_weights)
     main_logger.info("Successfully grabbed Column Weights")
+    bands = form_flag(request.form.get("bands"))
+    band_count = len(col_weights) if bands else 0
 
     geom = request.form.get("geom")
     for i, string in enumerate(geom):
@@ -156,7 +521,8 @@ def create_layer():
     main_logger.info("Successfully grabbed geometry columns")
     main_logger.info((filename, col_weights, title, geom_y, geom_x))
 
-    instream = BytesIO(file.read())
+    # Spooled to disk as it was uploaded (see uploads); parsed from the file, and only read whole to be stored
+    instream = file.stream
 
     outstream_1 = BytesIO()
 
@@ -166,21 +532,62 @@ def create_layer():
 
     main_logger.info("Successfully Initialized Buffer streams")
 
+    columnar_data = None
+    grid_data = None
+    quantized_data = None
+    stats = None
+    bounds = None
+    status = "ready"
     try:
-        generate_raster_file(instream, outstream_1, col_weights, [geom_y, geom_x])
-        # Get values and release memory
-        outstream_1_value = outstream_1.getvalue()
-
-        write_pix_json(BytesIO(outstream_1_value), outstream_2)
-
-        convert_to_alpha(BytesIO(outstream_1_value), out_fp=outstream_3)
-        outstream_1 = None  # Help garbage collector
-
+        # The upload is parsed within the budget, which then grows to the render's once it can be estimated
+        with render_scheduler.admit(estimate_parse_memory(instream.size)) as admission:
+            data = read_csv_data(instream)
+            columnar_data = to_columnar(data, keep=[geom_y, geom_x])
+            main_logger.info("Successfully stored columnar copy")
+
+            # Large layers are stored with a coarse preview, and fully rendered in the background
+            progressive = 0 < app.config["PREVIEW_POINTS"] < len(data)
+            if progressive:
+                # The full render is accepted now, so once the preview is shown it can only wait for memory
+                render_scheduler.check(render_estimate(data, [geom_y, geom_x], bands=band_count))
+                admission.grow(render_estimate(data, [geom_y, geom_x], app.config["PREVIEW_SCALE"],
+                                               app.config["PREVIEW_POINTS"], bands=band_count))
+            else:
+                admission.grow(render_estimate(data, [geom_y, geom_x], bands=band_count))
+
+            if progressive:
+                rendered = render_preview(data, outstream_1, col_weights, [geom_y, geom_x],
+                                          app.config["PREVIEW_POINTS"], app.config["PREVIEW_SCALE"],
+                                          bands=bands, **render_options())
+            else:
+                rendered = generate_raster_file(data, outstream_1, col_weights, [geom_y, geom_x],
+                                                bands=bands, **render_options())
+            if isinstance(rendered, Exception):
+                raise rendered
+            main_logger.info(f"Interpolated {rendered['points']} of {rendered['points_in']} points "
+                             f"({rendered['points_in'] / rendered['points']:.1f}x reduction)")
+            if progressive:
+                status = "preview"
+            else:
+                grid_data = dump_grid(rendered, app.config["MEMMAP_DIR"])
+            # Get values and release memory
+            outstream_1_value = outstream_1.getvalue()
+
+            write_pix_json(BytesIO(outstream_1_value), outstream_2)
+
+            convert_to_alpha(BytesIO(outstream_1_value), out_fp=outstream_3)
+            quantized_data = quantize_raster(BytesIO(outstream_1_value))
+            stats = rendered["stats"]
+            bounds = raster_bounds(BytesIO(outstream_1_value))
+            outstream_1 = None  # Help garbage collector
+
+    except RenderRejected as e:
+        main_logger.warning(e)
+        return render_rejected(e)
     except Exception as e:
-        main_logger.info(e)
-
-
-
+        # Nothing is stored for a failed render, which would have no image or index to serve
+        main_logger.error(e)
+        return jsonify({"message": str(e)}), 400
 
     if not title or not filename or not col_weights or not geom:
         return (
@@ -196,20 +603,255 @@ def create_layer():
         geom_x,
         instream.getvalue(),
         outstream_3.getvalue(),
-        outstream_2.getvalue())
-
-    instream.close()  # Release memory
+        outstream_2.getvalue(),
+        columnar_data,
+        grid_data,
+        status,
+        bands,
+        quantized_data,
+        stats,
+        bounds,
+        instream.digest)
+
+    instream.close()  # Release the spooled file
     print("TEST", new_layer, "END TEST")
 
     try:
         db.session.add(new_layer)
-        db.session.commit()
+        with stage("db_write"):
+            db.session.commit()
     except Exception as e:
         print("ERROR:", e, "END ERROR")
         return jsonify({"message": str(e)}), 400
 
-    return jsonify({"message": "Layer Created!"}), 201
+    if status == "preview":
+        render_executor.submit(_refine_layer, new_layer.id, data, col_weights, [geom_y, geom_x], bands)
+
+    return jsonify({"message": "Layer Created!", "id": new_layer.id, "status": status}), 201
+
+
+def _refine_layer(layer_id, data, col_weights, geom, bands=False):
+    """Fully renders a previewed layer, then swaps the full render in with a single commit"""
+    with app.app_context():
+        outstream_1 = BytesIO()
+        outstream_2 = StringIO()
+        outstream_3 = BytesIO()
+        try:
+            band_count = len(col_weights) if bands else 0
+            with render_scheduler.admit(render_estimate(data, geom, bands=band_count), wait=True):
+                rendered = generate_raster_file(data, outstream_1, col_weights, geom, bands=bands,
+                                                **render_options())
+                if isinstance(rendered, Exception):
+                    raise rendered
+                write_pix_json(outstream_1, outstream_2)
+                convert_to_alpha(outstream_1, out_fp=outstream_3)
+                quantized_data = quantize_raster(outstream_1)
+                bounds = raster_bounds(outstream_1)
+            grid_data = dump_grid(rendered, app.config["MEMMAP_DIR"])
+            status = "ready"
+        except Exception as e:
+            main_logger.error(e)
+            status = "failed"
+
+        layer = db.session.get(RasterLayer, layer_id)
+        if layer is None or layer.status != "preview":
+            # Deleted, or re-rendered by an update, in the meantime
+            return
+
+        layer.status = status
+        if status == "ready":
+            layer.grid_data = grid_data
+            layer.out_img_data = outstream_3.getvalue()
+            layer.out_json_data = outstream_2.getvalue()
+            layer.out_quantized_data = quantized_data
+            layer.stats = json.dumps(rendered["stats"])
+            layer.set_bounds(bounds)
+            evict_render(layer)
+            layer.new_render()
+        with stage("db_write"):
+            db.session.commit()
+        main_logger.info(f"Layer {layer_id} full render {status}")
+
+
+
+@app.route("/create_layers", methods=["POST"])
+def create_layers():
+    """
+    Create several layers from one file, each with its own title and column weights, and store them
+    in one transaction. The points are parsed, projected and indexed once for every layer.
+
+    Form fields: the file, the shared geom and bands flag, and layers, a JSON list of {"title", "colWeights"}
+
+    Returns:
+            JSON: A success message and the ids of the layers, in the order given
+    """
+    main_logger.info("Creating Layers")
+    file = request.files.get("file")
+    geom = request.form.get("geom")
+    try:
+        specs = json.loads(request.form.get("layers", "").replace("'", "\""))
+    except ValueError:
+        specs = None
+    if not file or not file.filename or not geom or "," not in geom or not isinstance(specs, list) or not specs \
+            or not all(isinstance(spec, dict) and spec.get("title") and spec.get("colWeights") for spec in specs):
+        return (
+            jsonify({"message": "You must include a file, geom and a list of layers, each with a title and "
+                                "col_weights"}),
+            400,
+        )
+    geom_x, _, geom_y = geom.rpartition(",")
+    bands = form_flag(request.form.get("bands"))
+    band_count = max(len(spec["colWeights"]) for spec in specs) if bands else 0
+    main_logger.info((file.filename, [spec["title"] for spec in specs], geom_y, geom_x))
+
+    instream = file.stream
+    try:
+        outstreams = [BytesIO() for _ in specs]
+        with render_scheduler.admit(estimate_parse_memory(instream.size)) as admission:
+            data = read_csv_data(instream)
+            columnar_data = to_columnar(data, keep=[geom_y, geom_x])
+            admission.grow(render_estimate(data, [geom_y, geom_x], layers=len(specs), bands=band_count))
+
+            results = generate_raster_files(data, [(outstream, spec["colWeights"])
+                                                   for outstream, spec in zip(outstreams, specs)],
+                                            [geom_y, geom_x], bands=bands, **render_options())
+            if isinstance(results, Exception):
+                raise results
+
+            # Every layer stores the upload; it is read from disk once for all of them
+            source = instream.getvalue()
+            new_layers = []
+            for spec, outstream, rendered in zip(specs, outstreams, results):
+                if isinstance(rendered, Exception):
+                    raise ValueError(f"{spec['title']}: {rendered}")
+                json_out = StringIO()
+                img_out = BytesIO()
+                write_pix_json(BytesIO(outstream.getvalue()), json_out)
+                convert_to_alpha(BytesIO(outstream.getvalue()), out_fp=img_out)
+                new_layers.append(RasterLayer(
+                    file.filename,
+                    spec["colWeights"],
+                    spec["title"],
+                    geom_y,
+                    geom_x,
+                    source,
+                    img_out.getvalue(),
+                    json_out.getvalue(),
+                    columnar_data,
+                    dump_grid(rendered, app.config["MEMMAP_DIR"]),
+                    bands=bands,
+                    out_quantized_data=quantize_raster(BytesIO(outstream.getvalue())),
+                    stats=rendered["stats"],
+                    bounds=raster_bounds(outstream),
+                    source_hash=instream.digest))
+    except RenderRejected as e:
+        main_logger.warning(e)
+        return render_rejected(e)
+    except Exception as e:
+        main_logger.info(e)
+        return jsonify({"message": str(e)}), 400
+
+    try:
+        db.session.add_all(new_layers)
+        with stage("db_write"):
+            db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({"message": str(e)}), 400
+
+    return jsonify({"message": "Layers Created!", "ids": [layer.id for layer in new_layers]}), 201
+
+
+def cached_grid(render_id, grid_data):
+    """The decoded grid of a layer's render, from the grid cache when possible"""
+    global grid_cache
+    if grid_cache is None:
+        grid_cache = GridCache(app.config["GRID_CACHE_BYTES"])
+    rendered = grid_cache.get(render_id)
+    if rendered is None:
+        rendered = load_grid(grid_data, points=False)
+        grid_cache.put(render_id, rendered)
+    return rendered
+
+
+@app.route("/composite_layer", methods=["POST"])
+def composite_layer():
+    """
+    Create a layer from a weighted sum of stored layers, each normalized as displayed and resampled
+    onto their common grid. Only the layers' stored grids are read, never their source files.
+
+    JSON body: {"title": str, "weights": {"<layer id>": weight, ...}}
+
+    Returns:
+            JSON: A success message and the id of the layer
+    """
+    body = request.get_json(silent=True) or {}
+    title = body.get("title")
+    weights = body.get("weights")
+    if not title or not isinstance(weights, dict) or not weights:
+        return jsonify({"message": "You must include a title and weights of at least one layer"}), 400
+    try:
+        weights = {int(layer_id): float(weight) for layer_id, weight in weights.items()}
+    except (TypeError, ValueError):
+        return jsonify({"message": "Weights must map layer ids to numbers"}), 400
+
+    stored = []
+    for layer_id in weights:
+        layer = db.session.get(RasterLayer, layer_id)
+        if not layer:
+            return jsonify({"message": f"Layer {layer_id} not found"}), 404
+        if layer.grid_data is None:
+            return jsonify({"message": f"Layer {layer_id} has no full render to composite yet"}), 409
+        stored.append((layer.render_id, layer.grid_data))
+    # End the read transaction, so no connection or lock is held while rendering
+    db.session.commit()
+
+    outstream_1 = BytesIO()
+    outstream_2 = StringIO()
+    outstream_3 = BytesIO()
+    try:
+        # Estimated from the stored grids' headers, so no source is decoded before admission
+        estimate = estimate_composite_memory([grid_info(grid_data) for _, grid_data in stored],
+                                             memmap=app.config["MEMMAP_DIR"] is not None)
+        with render_scheduler.admit(estimate):
+            sources = [cached_grid(render_id, grid_data) for render_id, grid_data in stored]
+            rendered = composite_grid(sources, list(weights.values()), outstream_1,
+                                      memmap_dir=app.config["MEMMAP_DIR"])
+            write_pix_json(outstream_1, outstream_2)
+            convert_to_alpha(outstream_1, out_fp=outstream_3)
+            quantized_data = quantize_raster(outstream_1)
+            bounds = raster_bounds(outstream_1)
+            grid_data = dump_grid(rendered, app.config["MEMMAP_DIR"])
+    except RenderRejected as e:
+        main_logger.warning(e)
+        return render_rejected(e)
+    except Exception as e:
+        main_logger.error(e)
+        return jsonify({"message": str(e)}), 400
+
+    # The weights stand in for column weights, keyed by source layer id
+    new_layer = RasterLayer(
+        "composite",
+        {str(layer_id): [weight, "Composite"] for layer_id, weight in weights.items()},
+        title,
+        None,
+        None,
+        None,
+        outstream_3.getvalue(),
+        outstream_2.getvalue(),
+        grid_data=grid_data,
+        out_quantized_data=quantized_data,
+        stats=rendered["stats"],
+        bounds=bounds)
+    try:
+        db.session.add(new_layer)
+        with stage("db_write"):
+            db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({"message": str(e)}), 400
 
+    return jsonify({"message": "Layer Created!", "id": new_layer.id}), 201
 
 
 @app.route("/update_layer/<int:layer_id>", methods=["PATCH"])
@@ -226,6 +868,15 @@ def update_layer(layer_id):
     if not layer:
         return jsonify({"message": "Layer not found"}), 404
 
+    if layer.composite:
+        # Composites have no source file to re-render from; only their title can change
+        if request.files.get("file"):
+            return jsonify({"message": "Composite layers cannot be re-rendered, create a new composite"}), 409
+        layer.title = request.form.get("title") or layer.title
+        with stage("db_write"):
+            db.session.commit()
+        return jsonify({"message": "Layer updated!"}), 200
+
     file = request.files.get("file")
     data = request.form
     title = data.get("title")
@@ -245,14 +896,34 @@ def update_layer(layer_id):
             prime_index = i
     geom_x = geom[:prime_index]
     geom_y = geom[prime_index + 1:]
-
-    if (layer.filename != filename):
-        instream = BytesIO(file.read())
-    else:
-        instream = BytesIO(layer.in_csv_data)
-
-    if ((layer.filename != filename) or (json.loads(layer.col_weights) != col_weights)
-            or (layer.geom_x != geom_x) or (layer.geom_y != geom_y)):
+    bands = form_flag(data["bands"]) if "bands" in data else bool(layer.bands)
+    # An uploaded file replaces the source only if its contents differ, whatever it is named
+    source_changed = bool(file) and file.stream.digest != layer.source_hash
+
+    if (source_changed or (json.loads(layer.col_weights) != col_weights)
+            or (layer.geom_x != geom_x) or (layer.geom_y != geom_y) or (bool(layer.bands) != bands)):
+
+        # Source blobs are only written back when they change
+        instream = None
+        columnar_data = None
+        if source_changed:
+            instream = file.stream
+            data = read_csv_data(instream)
+            columnar_data = to_columnar(data, keep=[geom_y, geom_x])
+        elif layer.in_columnar_data is not None:
+            # Only the weighted and geometry columns are needed for the re-render
+            needed = list(dict.fromkeys([col for col in col_weights if col != "Count"] + [geom_y, geom_x]))
+            stored = set(columnar_columns(layer.in_columnar_data))
+            missing = [col for col in needed if col not in stored]
+            if missing:
+                return jsonify({"message": f"Columns not found or not numerical: {', '.join(missing)}"}), 400
+            data = read_columnar(layer.in_columnar_data, needed)
+        else:
+            data = read_csv_data(BytesIO(layer.in_csv_data))
+            columnar_data = to_columnar(data, keep=[geom_y, geom_x])
+
+        # End the read transaction, so no connection or lock is held while rendering
+        db.session.commit()
 
         outstream_1 = BytesIO()
 
@@ -260,28 +931,155 @@ def update_layer(layer_id):
 
         outstream_3 = BytesIO()
 
-        generate_raster_file(instream, outstream_1, col_weights, [geom_y, geom_x])
-        main_logger.info("Raster File Generated")
-        write_pix_json(outstream_1, outstream_2)
-        main_logger.info("Json File Generated")
-        convert_to_alpha(outstream_1, out_fp=outstream_3)
-        main_logger.info("Successfully Converted Image to LA")
+        try:
+            with render_scheduler.admit(render_estimate(data, [geom_y, geom_x],
+                                                        bands=len(col_weights) if bands else 0)):
+                rendered = generate_raster_file(data, outstream_1, col_weights, [geom_y, geom_x],
+                                                bands=bands, **render_options())
+                if isinstance(rendered, Exception):
+                    main_logger.error(rendered)
+                    return jsonify({"message": str(rendered)}), 400
+                main_logger.info(f"Raster File Generated from {rendered['points']} of {rendered['points_in']} "
+                                 f"points ({rendered['points_in'] / rendered['points']:.1f}x reduction)")
+                write_pix_json(outstream_1, outstream_2)
+                main_logger.info("Json File Generated")
+                convert_to_alpha(outstream_1, out_fp=outstream_3)
+                main_logger.info("Successfully Converted Image to LA")
+                quantized_data = quantize_raster(outstream_1)
+                bounds = raster_bounds(outstream_1)
+        except RenderRejected as e:
+            main_logger.warning(e)
+            return render_rejected(e)
+
+        layer = db.session.get(RasterLayer, layer_id)
+        if not layer:
+            return jsonify({"message": "Layer not found"}), 404
 
-        layer.filename = filename
         layer.col_weights = str(col_weights).replace("'", "\"")
         layer.geom_x = geom_x
         layer.geom_y = geom_y
-        layer.in_csv_data = instream.getvalue()
+        layer.bands = bands
+        if instream is not None:
+            layer.in_csv_data = instream.getvalue()
+            layer.source_hash = instream.digest
+        if columnar_data is not None:
+            layer.in_columnar_data = columnar_data
+        layer.grid_data = dump_grid(rendered, app.config["MEMMAP_DIR"])
         layer.out_img_data = outstream_3.getvalue()
         layer.out_json_data = outstream_2.getvalue()
+        layer.out_quantized_data = quantized_data
+        layer.stats = json.dumps(rendered["stats"])
+        layer.set_bounds(bounds)
+        layer.status = "ready"
+        evict_render(layer)
+        layer.new_render()
 
     layer.title = title
+    layer.filename = filename
 
-    db.session.commit()
+    with stage("db_write"):
+        db.session.commit()
 
     return jsonify({"message": "Layer updated!"}), 200
 
 
+@app.route("/append_layer/<int:layer_id>", methods=["POST"])
+def append_layer(layer_id):
+    """
+    Appends new rows to a layer, re-rendering only the tiles of the raster they can affect.
+    The rows are merged into the layer's columnar data; the original csv is left as uploaded
+    Query Parameters:
+            layer_id (int): unique id for the database layer
+    Returns:
+            JSON: A success message, with the number of re-rendered and total tiles
+    """
+    layer = db.session.get(RasterLayer, layer_id)
+
+    if not layer:
+        return jsonify({"message": "Layer not found"}), 404
+
+    if layer.in_columnar_data is None or layer.grid_data is None:
+        return jsonify({"message": "Layer must be updated with a full render before appending"}), 409
+
+    file = request.files.get("file")
+    if not file:
+        return jsonify({"message": "You must include a file"}), 400
+
+    col_weights = json.loads(layer.col_weights)
+    geom = [layer.geom_y, layer.geom_x]
+    needed = list(dict.fromkeys([col for col in col_weights if col != "Count"] + geom))
+
+    columnar_data = layer.in_columnar_data
+    grid_data = layer.grid_data
+    version = layer.version
+    band_count = len(col_weights) if layer.bands else 0
+    # End the read transaction, so no connection or lock is held while rendering
+    db.session.commit()
+
+    try:
+        new_rows = read_csv_data(file.stream)
+        new_data = new_rows[needed]
+        rendered = load_grid(grid_data)
+        if rendered["coords"] is None:
+            # Grids stored without their points are appended to by a full render of the columnar copy
+            data = read_columnar(columnar_data, needed)
+            rows = len(data)
+        else:
+            # Only read if the append falls back to a full render
+            data = partial(read_columnar, columnar_data, needed)
+            rows = rendered["points_in"]
+
+        outstream_1 = BytesIO()
+        outstream_2 = StringIO()
+        outstream_3 = BytesIO()
+
+        # Appends may fall back to a full render, so they are admitted at full render cost
+        with render_scheduler.admit(render_estimate(new_data, geom, bands=band_count, bounds=rendered["bounds"],
+                                                    stored_rows=rows)):
+            rendered = append_raster_file(data, new_data, outstream_1, col_weights, geom, rendered,
+                                          memmap_dir=app.config["MEMMAP_DIR"])
+            if isinstance(rendered, Exception):
+                raise rendered
+            main_logger.info(f"Re-rendered {rendered['dirty_tiles']} of {rendered['tile_radius'].size} tiles")
+
+            write_pix_json(outstream_1, outstream_2)
+            convert_to_alpha(outstream_1, out_fp=outstream_3)
+            quantized_data = quantize_raster(outstream_1)
+            bounds = raster_bounds(outstream_1)
+    except RenderRejected as e:
+        main_logger.warning(e)
+        return render_rejected(e)
+    except Exception as e:
+        main_logger.error(e)
+        return jsonify({"message": str(e)}), 400
+
+    columnar_data = append_columnar(columnar_data, new_rows, keep=geom)
+    grid_data = dump_grid(rendered, app.config["MEMMAP_DIR"])
+
+    layer = db.session.get(RasterLayer, layer_id)
+    if not layer:
+        return jsonify({"message": "Layer not found"}), 404
+    if layer.version != version:
+        # Another render replaced the layer meanwhile; appending onto it again would lose one of the two
+        return jsonify({"message": "Layer changed while appending, retry"}), 409
+
+    layer.in_columnar_data = columnar_data
+    layer.grid_data = grid_data
+    layer.out_img_data = outstream_3.getvalue()
+    layer.out_json_data = outstream_2.getvalue()
+    layer.out_quantized_data = quantized_data
+    layer.stats = json.dumps(rendered["stats"])
+    layer.set_bounds(bounds)
+    evict_render(layer)
+    layer.new_render()
+
+    with stage("db_write"):
+        db.session.commit()
+
+    return jsonify({"message": "Layer appended!", "dirtyTiles": rendered["dirty_tiles"],
+                    "tiles": int(rendered["tile_radius"].size)}), 200
+
+
 @app.route("/delete_layer/<int:layer_id>", methods=["DELETE"])
 def delete_layer(layer_id):
     """
@@ -296,8 +1094,10 @@ def delete_layer(layer_id):
     if not layer:
         return jsonify({"message": "Layer not found"}), 404
 
+    evict_render(layer)
     db.session.delete(layer)
-    db.session.commit()
+    with stage("db_write"):
+        db.session.commit()
 
     return jsonify({"message": "Layer deleted!"}), 200
 
@@ -307,8 +1107,15 @@ if __name__ == "__main__":
     with app.app_context():
         db.drop_all()
         db.create_all()
+        create_spatial_index()
 
     logger = logging.getLogger('waitress')
     logger.setLevel(logging.INFO)
 
-    serve(app, host="0.0.0.0", port=8080)
+    # The socket is listening once the server is created, so pre-warming does not delay the first requests
+    server = create_server(app, host="0.0.0.0", port=8080)
+    if app.config["PREWARM"]:
+        def run_prewarm():
+            main_logger.info(f"Pre-warmed the rendering stack in {prewarm():.2f}s")
+        threading.Thread(target=run_prewarm, daemon=True).start()
+    server.run()
@@ -1,31 +1,78 @@
 from config import db
+from sqlalchemy.orm import deferred
 import json
+import uuid
 
 class RasterLayer(db.Model):
     id = db.Column(db.Integer, primary_key = True)
     title = db.Column(db.String(50), unique = True)
     filename = db.Column(db.String(100))
-    col_weights = db.Column(db.String(100))
-    geom_x = db.Column(db.String(100))
+    source_hash = db.Column(db.String(64))  # SHA-256 of the uploaded csv, None for composites
+    col_weights = db.Column(db.Text)  # Column weights, or for composites the weight of each source layer
+    geom_x = db.Column(db.String(100))  # Geometry columns, None for composites, which have no points
     geom_y = db.Column(db.String(100))
-    in_csv_data = db.Column(db.LargeBinary)
-    out_img_data = db.Column(db.LargeBinary)  # Layer Image file data
-    out_json_data = db.Column(db.Text)  # Layer Image json index
-    def __init__(self, filename, col_weights, title, geom_y, geom_x, in_csv_data, out_img_data, out_json_data):
+    # Large columns are deferred, only loaded when accessed, so listing or updating layers doesn't read them
+    in_csv_data = deferred(db.Column(db.LargeBinary))  # Original uploaded csv, kept for download
+    in_columnar_data = deferred(db.Column(db.LargeBinary))  # Numerical columns of the csv, in compressed Feather
+    out_img_data = deferred(db.Column(db.LargeBinary), group="output")  # Layer Image file data
+    out_json_data = deferred(db.Column(db.Text), group="output")  # Layer Image json index
+    grid_data = deferred(db.Column(db.LargeBinary))  # Interpolated Mercator grid, before normalization
+    out_quantized_data = deferred(db.Column(db.LargeBinary))  # Layer Image values, quantized to 16 bits for styling
+    stats = deferred(db.Column(db.Text))  # Json statistics and histogram of the render, computed as it was written
+    status = db.Column(db.String(20))  # "preview" while the full render runs, then "ready" (or "failed")
+    version = db.Column(db.Integer)  # Incremented whenever the rendered image and index change
+    # Unique to each render. Ids of deleted layers are reused, so cached renders are keyed by this instead
+    render_id = db.Column(db.String(32))
+    bands = db.Column(db.Boolean)  # Whether each column is also rendered as its own band
+    # Extent of the rendered raster in EPSG:4326 degrees, for filtering layers by viewport (see spatial_index)
+    west = db.Column(db.Float, index=True)
+    south = db.Column(db.Float, index=True)
+    east = db.Column(db.Float, index=True)
+    north = db.Column(db.Float, index=True)
+    def __init__(self, filename, col_weights, title, geom_y, geom_x, in_csv_data, out_img_data, out_json_data,
+                 in_columnar_data=None, grid_data=None, status="ready", bands=False, out_quantized_data=None,
+                 stats=None, bounds=None, source_hash=None):
         self.title = title
         self.filename = filename
+        self.source_hash = source_hash
         self.col_weights = json.dumps(col_weights)
         self.geom_y = geom_y
         self.geom_x = geom_x
         self.in_csv_data = in_csv_data
+        self.in_columnar_data = in_columnar_data
+        self.grid_data = grid_data
         self.out_img_data = out_img_data
         self.out_json_data = out_json_data
+        self.out_quantized_data = out_quantized_data
+        self.stats = None if stats is None else json.dumps(stats)
+        self.status = status
+        self.version = 1
+        self.render_id = uuid.uuid4().hex
+        self.bands = bands
+        self.set_bounds(bounds)
+    def set_bounds(self, bounds):
+        """Store the raster's extent (west, south, east, north), or None"""
+        self.west, self.south, self.east, self.north = (None,) * 4 if bounds is None else bounds
+    def new_render(self):
+        """Mark the rendered image and index as replaced"""
+        self.version += 1
+        self.render_id = uuid.uuid4().hex
+    @property
+    def composite(self):
+        """Whether the layer was composited from other layers' grids, rather than rendered from a file"""
+        return self.geom_x is None
     def to_json(self):
         return {
             "id": self.id,
             "title": self.title,
             "filename": self.filename,
+            "sourceHash": self.source_hash,
             "colWeights": self.col_weights,
             "geomX": self.geom_x,
-            "geomY": self.geom_y
+            "geomY": self.geom_y,
+            "status": self.status,
+            "version": self.version,
+            "bands": bool(self.bands),
+            "composite": self.composite,
+            "bounds": None if self.west is None else [self.west, self.south, self.east, self.north]
         }
\ No newline at end of file
@@ -0,0 +1,153 @@
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+
+class RenderRejected(Exception):
+    """Raised when a render cannot be admitted within the memory budget"""
+
+    def __init__(self, message, status, retry_after=None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+class RenderScheduler:
+    """
+    Admits renders against a memory budget, so concurrent renders cannot together exceed it.
+
+    Each render declares its estimated peak memory. Renders that fit in the remaining budget start
+    immediately, others wait for running renders to finish, up to a queue length and timeout. Waiting
+    renders are admitted in arrival order, so a large render is not starved by smaller ones behind it.
+    """
+
+    def __init__(self, budget: int, queue_limit: int, queue_timeout: float, retry_after: int):
+        """
+        Parameters:
+                budget (int): total memory, in bytes, concurrent renders may use
+                queue_limit (int): number of renders allowed to wait for memory at once
+                queue_timeout (float): seconds a render waits for memory before being rejected
+                retry_after (int): seconds clients are told to wait after a rejection
+        """
+        self.budget = budget
+        self.queue_limit = queue_limit
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self._used = 0
+        self._running = 0
+        self._waiters = deque()
+        self._growing = 0  # Waiters growing an admission, at the head of the line
+        self._condition = threading.Condition()
+
+    def check(self, estimate: int):
+        """
+        Rejects a render that could never fit the budget, even with no other render running.
+            Parameters:
+                    estimate (int): estimated peak memory of the render in bytes
+            Raises:
+                    RenderRejected: 503 if the render is larger than the budget
+        """
+        if estimate > self.budget:
+            raise RenderRejected(f"Render needs an estimated {estimate} bytes, more than the "
+                                 f"{self.budget} byte render budget", 503)
+
+    def _acquire(self, estimate: int, wait: bool, growing: bool = False):
+        """Takes estimate bytes of the budget once every render that arrived first has, waiting if needed.
+        Renders growing an admission only wait behind each other: they already hold memory the renders
+        queued behind them may be waiting for. Called holding the condition"""
+        ahead = self._growing if growing else len(self._waiters)
+        if ahead or self._used + estimate > self.budget:
+            if not wait and not growing and len(self._waiters) >= self.queue_limit:
+                raise RenderRejected("Too many renders waiting for memory", 429, self.retry_after)
+
+            ticket = object()
+            if growing:
+                self._waiters.insert(self._growing, ticket)
+                self._growing += 1
+            else:
+                self._waiters.append(ticket)
+            try:
+                admitted = self._condition.wait_for(
+                    lambda: self._waiters[0] is ticket and self._used + estimate <= self.budget,
+                    None if wait else self.queue_timeout)
+            finally:
+                self._waiters.remove(ticket)
+                if growing:
+                    self._growing -= 1
+                # The next render in line may fit now
+                self._condition.notify_all()
+            if not admitted:
+                raise RenderRejected("Timed out waiting for render memory", 429, self.retry_after)
+
+        self._used += estimate
+
+    @contextmanager
+    def admit(self, estimate: int, wait: bool = False):
+        """
+        Holds estimate bytes of the budget for the duration of a render.
+            Parameters:
+                    estimate (int): estimated peak memory of the render in bytes
+                    wait (bool): wait for memory however long it takes, outside the queue limit,
+                    for renders that were already accepted
+            Returns:
+                    An Admission, to grow the memory held once the render is better known
+            Raises:
+                    RenderRejected: 503 if the render can never fit the budget, 429 if the queue
+                    is full or no memory was freed in time
+        """
+        self.check(estimate)
+
+        with self._condition:
+            self._acquire(estimate, wait)
+            self._running += 1
+        admission = Admission(self, estimate)
+
+        try:
+            yield admission
+        finally:
+            with self._condition:
+                self._used -= admission.estimate
+                self._running -= 1
+                self._condition.notify_all()
+
+    def usage(self):
+        """
+        Current use of the budget.
+            Returns:
+                    A dictionary of the budget, the memory held by running renders, and the
+                    number of running and waiting renders
+        """
+        with self._condition:
+            return {
+                "budget": self.budget,
+                "used": self._used,
+                "running": self._running,
+                "queued": len(self._waiters)
+            }
+
+
+class Admission:
+    """Memory held by an admitted render, see RenderScheduler.admit"""
+
+    def __init__(self, scheduler: RenderScheduler, estimate: int):
+        self.scheduler = scheduler
+        self.estimate = estimate
+
+    def grow(self, estimate: int, wait: bool = False):
+        """
+        Raises the memory held to estimate bytes, waiting for the difference ahead of renders not yet
+        admitted, outside the queue limit. Used to admit the parse of an upload, then its render once the
+        parsed data can be estimated.
+            Parameters:
+                    estimate (int): estimated peak memory of the render in bytes
+                    wait (bool): see RenderScheduler.admit
+            Raises:
+                    RenderRejected: as RenderScheduler.admit; the memory already held is kept until
+                    the admission ends
+        """
+        self.scheduler.check(estimate)
+        if estimate <= self.estimate:
+            return
+        with self.scheduler._condition:
+            self.scheduler._acquire(estimate - self.estimate, wait, growing=True)
+            self.estimate = estimate
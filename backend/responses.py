@@ -0,0 +1,207 @@
+import gzip
+import json
+import re
+import threading
+from collections import OrderedDict
+from flask import Response, request
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+def dumps(obj) -> bytes:
+    """Serialize to json bytes, with orjson when it is installed"""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(",", ":")).encode()
+
+
+# Strings of json text, removed to count the brackets outside of them; the first only for text without escapes
+PLAIN_STRINGS = re.compile(r'"[^"]*"')
+JSON_STRINGS = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"')
+
+
+def stored_items(text: str, keys) -> dict:
+    """
+    Read some top-level items of a json object stored as text (such as a layer's pixel index),
+    without parsing the rest of it. Matches of a key are only taken at the top level, not in
+    nested objects or inside strings, by counting the brackets outside of strings before them.
+        Parameters:
+                text (str): the json object, as written by json.dump
+                keys (list): keys to read
+        Returns:
+                A dictionary of the keys and their decoded values
+        Raises:
+                KeyError: if a key is not in the object
+    """
+    decoder = json.JSONDecoder()
+    strings = JSON_STRINGS if "\\" in text else PLAIN_STRINGS
+    items = {}
+    for key in keys:
+        marker = json.dumps(key) + ": "
+        # Nesting depth at position, the last match outside of a string
+        depth = 0
+        position = 0
+        start = text.find(marker)
+        while start != -1:
+            span = strings.sub("", text[position:start])
+            # A quote left over opens a string the match is inside of
+            if '"' not in span:
+                depth += span.count("{") + span.count("[") - span.count("}") - span.count("]")
+                position = start
+                if depth == 1:
+                    items[key], _ = decoder.raw_decode(text, start + len(marker))
+                    break
+            start = text.find(marker, start + 1)
+        else:
+            raise KeyError(key)
+    return items
+
+
+def _compress_gzip(body):
+    return gzip.compress(body, compresslevel=6)
+
+
+def _compress_brotli(body):
+    return brotli.compress(body, quality=5)
+
+
+def _compress_zstd(body):
+    return zstandard.ZstdCompressor(level=3).compress(body)
+
+
+# Available encodings, in order of preference
+ENCODERS = OrderedDict()
+if zstandard is not None:
+    ENCODERS["zstd"] = _compress_zstd
+if brotli is not None:
+    ENCODERS["br"] = _compress_brotli
+ENCODERS["gzip"] = _compress_gzip
+
+
+def negotiate_encoding(accept_encoding: str):
+    """
+    Choose the content encoding of a response from an Accept-Encoding header.
+        Returns:
+                The preferred available encoding the client accepts, or None for identity
+    """
+    accepted = {}
+    for item in accept_encoding.split(","):
+        name, _, params = item.strip().partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip().lower()] = quality
+
+    best, best_quality = None, 0.0
+    for encoding in ENCODERS:
+        quality = accepted.get(encoding, accepted.get("*", 0.0))
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+class CompressedCache:
+    """Least recently used cache of compressed response bodies, bounded by their total size"""
+
+    def __init__(self, max_bytes: int):
+        """
+        Parameters:
+                max_bytes (int): total size of the cached bodies
+        """
+        self.max_bytes = max_bytes
+        self._size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """The cached body under key, or None"""
+        with self._lock:
+            body = self._entries.get(key)
+            if body is not None:
+                self._entries.move_to_end(key)
+            return body
+
+    def put(self, key, body: bytes):
+        """Cache a body under key, evicting the least recently used bodies over the size bound"""
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._size -= len(self._entries.pop(key))
+            self._entries[key] = body
+            self._size += len(body)
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+    def evict(self, match):
+        """Drop the cached bodies whose key matches, a predicate of the key"""
+        with self._lock:
+            for key in [key for key in self._entries if match(key)]:
+                self._size -= len(self._entries.pop(key))
+
+
+class ResponseEncoder:
+    """Builds json responses, compressed for clients that accept it when they are large enough"""
+
+    def __init__(self, threshold: int, cache_bytes: int):
+        """
+        Parameters:
+                threshold (int): smallest body, in bytes, that is compressed
+                cache_bytes (int): total size of the cache of compressed immutable bodies
+        """
+        self.threshold = threshold
+        self.cache = CompressedCache(cache_bytes)
+
+    def evict(self, *cache_keys):
+        """Drop every compressed variant of the bodies cached under cache_keys"""
+        self.cache.evict(lambda key: key[0] in cache_keys)
+
+    def json(self, obj=None, body: bytes = None, status: int = 200, cache_key=None) -> Response:
+        """
+        Build a json response.
+            Parameters:
+                    obj: object to serialize, if body is not given
+                    body (bytes): already serialized json
+                    status (int): status code
+                    cache_key: key identifying an immutable body (such as a layer id and version), whose
+                    compressed variants are cached; body or obj are then only needed on a cache miss,
+                    and may be callables producing them
+            Returns:
+                    The response
+        """
+        encoding = negotiate_encoding(request.headers.get("Accept-Encoding", ""))
+        compressed = None
+        if encoding is not None and cache_key is not None:
+            compressed = self.cache.get((cache_key, encoding))
+
+        if compressed is None:
+            if callable(body):
+                body = body()
+            if body is None:
+                body = dumps(obj() if callable(obj) else obj)
+            if encoding is not None and len(body) >= self.threshold:
+                compressed = ENCODERS[encoding](body)
+                if cache_key is not None:
+                    self.cache.put((cache_key, encoding), compressed)
+
+        response = Response(compressed if compressed is not None else body, status=status,
+                            mimetype="application/json")
+        if compressed is not None:
+            response.headers["Content-Encoding"] = encoding
+        response.vary.add("Accept-Encoding")
+        return response
@@ -0,0 +1,116 @@
+"""
+Viewport filtering of layers by their stored bounds.
+
+Bounds are plain indexed columns of RasterLayer, so any database can filter on them. Where the database has a
+spatial index, it narrows the candidates first: an R-tree virtual table kept in step by triggers on SQLite,
+and a GiST index over the bounds' box on Postgres.
+"""
+from sqlalchemy import column, func, select, table
+from sqlalchemy.exc import OperationalError
+from config import app, db, main_logger
+from models import RasterLayer
+
+RTREE_TABLE = "raster_layer_rtree"
+GIST_INDEX = "raster_layer_bounds_gist"
+
+rtree = table(RTREE_TABLE, column("id"), column("west"), column("east"), column("south"), column("north"))
+
+# Keep the R-tree in step with the layers' bounds; layers without bounds are left out of it
+SQLITE_TRIGGERS = [
+    f"""CREATE TRIGGER IF NOT EXISTS raster_layer_rtree_insert AFTER INSERT ON raster_layer
+    WHEN NEW.west IS NOT NULL BEGIN
+        INSERT INTO {RTREE_TABLE} VALUES (NEW.id, NEW.west, NEW.east, NEW.south, NEW.north);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS raster_layer_rtree_update AFTER UPDATE OF west, south, east, north
+    ON raster_layer BEGIN
+        DELETE FROM {RTREE_TABLE} WHERE id = OLD.id;
+        INSERT INTO {RTREE_TABLE} SELECT NEW.id, NEW.west, NEW.east, NEW.south, NEW.north
+        WHERE NEW.west IS NOT NULL;
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS raster_layer_rtree_delete AFTER DELETE ON raster_layer BEGIN
+        DELETE FROM {RTREE_TABLE} WHERE id = OLD.id;
+    END""",
+]
+
+
+def create_spatial_index():
+    """
+    Create, or rebuild from the stored bounds, the database's spatial index over layer bounds, and record which
+    kind it is in app.config["SPATIAL_INDEX"]. Call after the tables are created.
+
+    Returns:
+            str: "rtree", "gist", or None when the database has no spatial index (bounds are then filtered
+            through their column indexes)
+    """
+    dialect = db.engine.dialect.name
+    kind = None
+    try:
+        with db.engine.begin() as connection:
+            if dialect == "sqlite":
+                connection.exec_driver_sql(f"DROP TABLE IF EXISTS {RTREE_TABLE}")
+                connection.exec_driver_sql(f"CREATE VIRTUAL TABLE {RTREE_TABLE} USING rtree(id, west, east, south, north)")
+                connection.exec_driver_sql(f"INSERT INTO {RTREE_TABLE} SELECT id, west, east, south, north "
+                                           f"FROM raster_layer WHERE west IS NOT NULL")
+                for trigger in SQLITE_TRIGGERS:
+                    connection.exec_driver_sql(trigger)
+                kind = "rtree"
+            elif dialect == "postgresql":
+                connection.exec_driver_sql(f"CREATE INDEX IF NOT EXISTS {GIST_INDEX} ON raster_layer "
+                                           f"USING gist (box(point(west, south), point(east, north)))")
+                kind = "gist"
+    except OperationalError as e:
+        # SQLite builds without the R-tree module
+        main_logger.warning(f"No spatial index, filtering layer bounds without one: {e}")
+        kind = None
+    app.config["SPATIAL_INDEX"] = kind
+    return kind
+
+
+def parse_bbox(value: str) -> tuple[float, float, float, float]:
+    """
+    Parse a bbox query parameter.
+
+    Args:
+        value: "west,south,east,north" in EPSG:4326 degrees
+
+    Returns:
+        The bbox as floats
+
+    Raises:
+        ValueError: if the bbox is malformed, or crosses the antimeridian (west > east)
+    """
+    parts = value.split(",")
+    if len(parts) != 4:
+        raise ValueError("bbox must be west,south,east,north")
+    west, south, east, north = (float(part) for part in parts)
+    if not (west <= east and south <= north):
+        raise ValueError("bbox must have west <= east and south <= north; split bboxes crossing the antimeridian")
+    return west, south, east, north
+
+
+def intersecting(query, bbox):
+    """
+    Filter a RasterLayer query to the layers whose bounds intersect a bbox, through the spatial index
+    if the database has one. Layers without bounds never intersect.
+
+    Args:
+        query: Query of RasterLayer
+        bbox: (west, south, east, north) in EPSG:4326 degrees
+
+    Returns:
+        The filtered query
+    """
+    west, south, east, north = bbox
+    kind = app.config.get("SPATIAL_INDEX")
+    if kind == "rtree":
+        # R-tree coordinates are rounded outwards to 32 bits, so its matches are refined by the exact test below
+        query = query.filter(RasterLayer.id.in_(
+            select(rtree.c.id).where(rtree.c.west <= east, rtree.c.east >= west,
+                                     rtree.c.south <= north, rtree.c.north >= south)))
+    elif kind == "gist":
+        # Matches the indexed expression, so the planner can use the index
+        query = query.filter(
+            func.box(func.point(RasterLayer.west, RasterLayer.south), func.point(RasterLayer.east, RasterLayer.north))
+            .op("&&")(func.box(func.point(west, south), func.point(east, north))))
+    return query.filter(RasterLayer.west <= east, RasterLayer.east >= west,
+                        RasterLayer.south <= north, RasterLayer.north >= south)
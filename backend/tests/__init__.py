@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The app's modules import each other as top level modules, as when run from the backend directory, and are
+# tested against an in-memory database unless DATABASE_URL is set
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DATABASE_URL", "sqlite://")
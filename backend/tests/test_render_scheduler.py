@@ -0,0 +1,154 @@
+import threading
+import time
+import unittest
+from render_scheduler import RenderScheduler, RenderRejected
+
+
+class TestRenderScheduler(unittest.TestCase):
+    """Tests for admitting renders against a memory budget"""
+
+    def setUp(self):
+        """Set up a scheduler of a 100 byte budget, and a list of the renders admitted in order"""
+        self.scheduler = RenderScheduler(100, queue_limit=2, queue_timeout=5, retry_after=60)
+        self.admitted = []
+        self.threads = []
+
+    def tearDown(self):
+        for thread, release in self.threads:
+            release.set()
+            thread.join(5)
+
+    def hold(self, name, estimate, wait=False):
+        """Helper to admit a render in a thread, holding its memory until the returned event is set"""
+        release = threading.Event()
+
+        def render():
+            try:
+                with self.scheduler.admit(estimate, wait):
+                    self.admitted.append(name)
+                    release.wait(5)
+            except RenderRejected as e:
+                self.admitted.append((name, e.status))
+
+        thread = threading.Thread(target=render)
+        thread.start()
+        self.threads.append((thread, release))
+        return release
+
+    def wait_until(self, condition):
+        """Helper to wait for the scheduler's threads to reach a state"""
+        deadline = time.monotonic() + 5
+        while not condition():
+            self.assertLess(time.monotonic(), deadline, "Timed out")
+            time.sleep(0.005)
+
+    def test_admit_within_budget(self):
+        """Test that renders fitting the budget are admitted at once, and release their memory when done"""
+        with self.scheduler.admit(60):
+            with self.scheduler.admit(40):
+                self.assertEqual(self.scheduler.usage(), {"budget": 100, "used": 100, "running": 2, "queued": 0})
+        self.assertEqual(self.scheduler.usage(), {"budget": 100, "used": 0, "running": 0, "queued": 0})
+
+        # Memory is released by failed renders too
+        with self.assertRaises(ValueError):
+            with self.scheduler.admit(60):
+                raise ValueError("Render failed")
+        self.assertEqual(self.scheduler.usage()["used"], 0)
+
+    def test_larger_than_budget(self):
+        """Test that a render that could never fit is rejected with 503, not queued"""
+        with self.assertRaises(RenderRejected) as raised:
+            with self.scheduler.admit(101):
+                pass
+        self.assertEqual(raised.exception.status, 503)
+        self.assertIsNone(raised.exception.retry_after)
+        with self.assertRaises(RenderRejected):
+            self.scheduler.check(101)
+
+    def test_queue_limit(self):
+        """Test that renders past the queue limit are rejected with 429 at once, unless already accepted"""
+        release = self.hold("running", 100)
+        self.wait_until(lambda: self.admitted == ["running"])
+        self.hold("first", 50)
+        self.hold("second", 50)
+        self.wait_until(lambda: self.scheduler.usage()["queued"] == 2)
+
+        with self.assertRaises(RenderRejected) as raised:
+            with self.scheduler.admit(50):
+                pass
+        self.assertEqual(raised.exception.status, 429)
+        self.assertEqual(raised.exception.retry_after, 60)
+
+        # Accepted renders wait outside the queue limit
+        self.hold("accepted", 50, wait=True)
+        self.wait_until(lambda: self.scheduler.usage()["queued"] == 3)
+        release.set()
+        self.wait_until(lambda: len(self.admitted) == 3)
+        self.assertEqual(self.admitted, ["running", "first", "second"])
+
+    def test_timeout(self):
+        """Test that a render waiting longer than the queue timeout is rejected with 429"""
+        self.scheduler.queue_timeout = 0.05
+        self.hold("running", 80)
+        self.wait_until(lambda: self.admitted == ["running"])
+        with self.assertRaises(RenderRejected) as raised:
+            with self.scheduler.admit(50):
+                pass
+        self.assertEqual(raised.exception.status, 429)
+        self.assertEqual(raised.exception.retry_after, 60)
+        self.assertEqual(self.scheduler.usage(), {"budget": 100, "used": 80, "running": 1, "queued": 0})
+
+    def test_first_in_first_out(self):
+        """Test that waiting renders are admitted in arrival order, so small renders don't starve a large one"""
+        first = self.hold("running", 60)
+        self.wait_until(lambda: self.admitted == ["running"])
+        large = self.hold("large", 80, wait=True)
+        self.wait_until(lambda: self.scheduler.usage()["queued"] == 1)
+        # Fits beside the running render, but waits behind the large one
+        self.hold("small", 30)
+        self.wait_until(lambda: self.scheduler.usage()["queued"] == 2)
+        time.sleep(0.05)
+        self.assertEqual(self.admitted, ["running"])
+
+        first.set()
+        self.wait_until(lambda: self.admitted == ["running", "large"])
+        time.sleep(0.05)
+        self.assertEqual(self.scheduler.usage()["queued"], 1)
+        large.set()
+        self.wait_until(lambda: self.admitted == ["running", "large", "small"])
+
+    def test_grow(self):
+        """Test that an admission grows to a larger estimate, and keeps what it held if it can't"""
+        with self.scheduler.admit(30) as admission:
+            admission.grow(20)
+            self.assertEqual(self.scheduler.usage()["used"], 30)
+            admission.grow(70)
+            self.assertEqual(self.scheduler.usage()["used"], 70)
+            with self.assertRaises(RenderRejected) as raised:
+                admission.grow(101)
+            self.assertEqual(raised.exception.status, 503)
+
+            self.scheduler.queue_timeout = 0.05
+            self.hold("running", 30)
+            self.wait_until(lambda: self.admitted == ["running"])
+            with self.assertRaises(RenderRejected) as raised:
+                admission.grow(80)
+            self.assertEqual(raised.exception.status, 429)
+            self.assertEqual(self.scheduler.usage()["used"], 100)
+        self.assertEqual(self.scheduler.usage()["used"], 30)
+
+    def test_grow_ahead_of_queue(self):
+        """Test that an upload growing to its render's estimate isn't queued behind an upload waiting for the
+        memory its parse holds"""
+        with self.scheduler.admit(40) as first:
+            # The second upload's parse waits for the first upload
+            self.hold("second", 70)
+            self.wait_until(lambda: self.scheduler.usage()["queued"] == 1)
+            self.scheduler.queue_timeout = 0.05
+            first.grow(90)
+            self.assertEqual(self.scheduler.usage(), {"budget": 100, "used": 90, "running": 1, "queued": 1})
+        self.wait_until(lambda: self.admitted == ["second"])
+
+
+if __name__ == '__main__':
+    unittest.main()
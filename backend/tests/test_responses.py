@@ -0,0 +1,34 @@
+import json
+import unittest
+from responses import stored_items
+
+
+class TestStoredItems(unittest.TestCase):
+    """Tests for reading top-level items of a stored pixel index without parsing it"""
+
+    def setUp(self):
+        """Set up an index whose nested band names and values repeat its top-level keys"""
+        self.index = {"lbound": -80.0, "sizex": 2, "sizey": 1,
+                      "0,0": {"name": 1.5, "bands": {"sizex": 9.0, 'tricky "}sizey": {"': 4.0}},
+                      "1,0": {"name": 2.5, "bands": {"sizex": 8.0, 'tricky "}sizey": {"': 3.0}}}
+        self.text = json.dumps(self.index)
+
+    def test_top_level_items(self):
+        """Test that the requested items are those of the top level, wherever their keys also appear nested"""
+        self.assertEqual(stored_items(self.text, ["lbound", "sizex", "sizey", "1,0"]),
+                         {key: self.index[key] for key in ("lbound", "sizex", "sizey", "1,0")})
+
+    def test_nested_keys_not_found(self):
+        """Test that keys only found in nested objects or inside strings are missing"""
+        for key in ("name", "bands", 'tricky "}sizey": {"', "2,0"):
+            with self.assertRaises(KeyError):
+                stored_items(self.text, [key])
+
+    def test_key_after_nested_match(self):
+        """Test that a top-level key stored after its nested matches is found"""
+        index = {"0,0": {"name": 1.0, "bands": {"sizex": 9.0}}, "sizex": 1}
+        self.assertEqual(stored_items(json.dumps(index), ["sizex"]), {"sizex": 1})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+import unittest
+from unittest.mock import patch
+from sqlalchemy import select, text
+from sqlalchemy.exc import OperationalError
+from config import app, db
+from models import RasterLayer
+from spatial_index import create_spatial_index, intersecting, parse_bbox, rtree
+
+
+class TestSpatialIndex(unittest.TestCase):
+    """Tests for filtering layers by viewport through the spatial index"""
+
+    def setUp(self):
+        """Set up empty tables and their spatial index"""
+        self.context = app.app_context()
+        self.context.push()
+        db.create_all()
+        self.kind = create_spatial_index()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.context.pop()
+
+    def add(self, title, bounds):
+        """Helper to store a layer with bounds (west, south, east, north), or None"""
+        layer = RasterLayer(f"{title}.csv", {"value": [1, "IDW"]}, title, "latitude", "longitude", b"", b"", "{}",
+                            bounds=bounds)
+        db.session.add(layer)
+        db.session.commit()
+        return layer
+
+    def search(self, bbox):
+        """Helper to list the titles of the layers intersecting a bbox"""
+        return sorted(layer.title for layer in intersecting(RasterLayer.query, bbox))
+
+    def indexed(self):
+        """Helper to list the R-tree's rows"""
+        return db.session.execute(text("SELECT id, west, east, south, north FROM raster_layer_rtree "
+                                       "ORDER BY id")).all()
+
+    def test_sqlite_has_rtree(self):
+        """Test that SQLite gets an R-tree, and filters layers by their bounds through it"""
+        self.assertEqual(self.kind, "rtree")
+        self.assertEqual(app.config["SPATIAL_INDEX"], "rtree")
+        self.add("toronto", (-80.0, 43.5, -79.0, 43.8))
+        self.add("ottawa", (-76.0, 45.2, -75.5, 45.5))
+        self.add("unrendered", None)
+        self.assertEqual(self.search((-81.0, 43.0, -78.0, 44.0)), ["toronto"])
+        self.assertEqual(self.search((-81.0, 43.0, -75.0, 46.0)), ["ottawa", "toronto"])
+        self.assertEqual(self.search((0.0, 0.0, 1.0, 1.0)), [])
+        # Touching edges intersect
+        self.assertEqual(self.search((-79.0, 43.8, -78.0, 44.0)), ["toronto"])
+
+    def test_triggers(self):
+        """Test that inserting, updating and deleting layers keeps the R-tree in step with their bounds"""
+        toronto = self.add("toronto", (-80.0, 43.5, -79.0, 43.8))
+        unrendered = self.add("unrendered", None)
+        self.assertEqual([row.id for row in self.indexed()], [toronto.id])
+
+        toronto.set_bounds((-76.0, 45.25, -75.5, 45.5))
+        db.session.commit()
+        self.assertEqual(self.indexed(), [(toronto.id, -76.0, -75.5, 45.25, 45.5)])
+        self.assertEqual(self.search((-81.0, 43.0, -78.0, 44.0)), [])
+
+        unrendered.set_bounds((-80.0, 43.5, -79.0, 43.8))
+        db.session.commit()
+        self.assertEqual([row.id for row in self.indexed()], sorted([toronto.id, unrendered.id]))
+
+        # Clearing a layer's bounds drops it from the R-tree
+        toronto.set_bounds(None)
+        db.session.commit()
+        self.assertEqual([row.id for row in self.indexed()], [unrendered.id])
+
+        db.session.delete(unrendered)
+        db.session.commit()
+        self.assertEqual(self.indexed(), [])
+
+    def test_rebuilt_from_bounds(self):
+        """Test that recreating the spatial index indexes the layers already stored"""
+        toronto = self.add("toronto", (-80.0, 43.5, -79.0, 43.8))
+        self.add("unrendered", None)
+        create_spatial_index()
+        self.assertEqual([row.id for row in self.indexed()], [toronto.id])
+
+    def test_exact_refine(self):
+        """Test that R-tree matches of bounds rounded outwards to 32 bits are refined by the exact bounds"""
+        self.add("edge", (10.0000001, 0.0, 11.0, 1.0))
+        bbox = (9.0, 0.0, 10.00000005, 1.0)
+        # The R-tree's west edge is rounded down to 10.0, past the bbox's east edge
+        candidates = db.session.execute(select(rtree.c.id).where(rtree.c.west <= bbox[2])).scalars().all()
+        self.assertEqual(len(candidates), 1)
+        self.assertEqual(self.search(bbox), [])
+        self.assertEqual(self.search((9.0, 0.0, 10.0000001, 1.0)), ["edge"])
+
+    def test_fallback_without_rtree(self):
+        """Test that without the R-tree module there is no spatial index, and bounds are filtered without one"""
+        self.add("toronto", (-80.0, 43.5, -79.0, 43.8))
+        self.add("edge", (10.0000001, 0.0, 11.0, 1.0))
+        missing = OperationalError("CREATE VIRTUAL TABLE", {}, Exception("no such module: rtree"))
+        with patch.object(db.engine, "begin", side_effect=missing):
+            self.assertIsNone(create_spatial_index())
+        self.assertIsNone(app.config["SPATIAL_INDEX"])
+        self.assertEqual(self.search((-81.0, 43.0, -78.0, 44.0)), ["toronto"])
+        self.assertEqual(self.search((9.0, 0.0, 10.00000005, 1.0)), [])
+
+    def test_parse_bbox(self):
+        """Test that bboxes are parsed, and malformed or antimeridian crossing ones rejected"""
+        self.assertEqual(parse_bbox("-80,43.5,-79,43.8"), (-80.0, 43.5, -79.0, 43.8))
+        self.assertEqual(parse_bbox("10,0,10,0"), (10.0, 0.0, 10.0, 0.0))
+        for value in ("-80,43.5,-79", "-80,43.5,-79,43.8,1", "west,43.5,-79,43.8", "", "170,0,-170,10",
+                      "0,10,1,5"):
+            with self.assertRaises(ValueError):
+                parse_bbox(value)
+
+
+if __name__ == '__main__':
+    unittest.main()
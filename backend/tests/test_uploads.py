@@ -0,0 +1,105 @@
+import hashlib
+import io
+import os
+import tempfile
+import unittest
+from flask import Flask, jsonify, request
+from werkzeug.exceptions import RequestEntityTooLarge
+from uploads import SpooledUpload, UploadRequest
+
+
+class TestUploads(unittest.TestCase):
+    """Tests for uploads spooled to disk as they stream in"""
+
+    def setUp(self):
+        """Set up an app spooling its uploads, with a route reporting them and keeping a duplicate of each"""
+        self.directory = tempfile.TemporaryDirectory()
+        self.copies = []
+        self.app = Flask(__name__)
+        self.app.request_class = UploadRequest
+        self.app.config["MAX_UPLOAD_BYTES"] = 1024 ** 2
+        self.app.config["UPLOAD_DIR"] = self.directory.name
+
+        @self.app.route("/upload", methods=["POST"])
+        def upload():
+            file = request.files["file"]
+            self.uploaded = file.stream
+            copy = os.fdopen(os.dup(file.stream.fileno()), "rb")
+            copy.seek(0)
+            self.copies.append(copy)
+            return jsonify({"size": file.stream.size, "digest": file.stream.digest,
+                            "isSpooled": isinstance(file.stream, SpooledUpload)})
+
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        for copy in self.copies:
+            copy.close()
+        self.directory.cleanup()
+
+    def post(self, data):
+        """Helper to upload bytes as a file"""
+        return self.client.post("/upload", data={"file": (io.BytesIO(data), "points.csv")},
+                                content_type="multipart/form-data")
+
+    def test_digest_and_size(self):
+        """Test that a spooled upload's digest and size are those of everything written to it"""
+        data = os.urandom(200000)
+        upload = SpooledUpload()
+        for start in range(0, len(data), 65536):
+            upload.write(data[start:start + 65536])
+        self.assertEqual(upload.size, len(data))
+        self.assertEqual(upload.digest, hashlib.sha256(data).hexdigest())
+        upload.seek(0)
+        self.assertEqual(upload.read(), data)
+        upload.close()
+
+    def test_size_limit(self):
+        """Test that writing past the size limit is rejected as it happens"""
+        upload = SpooledUpload(max_bytes=10)
+        upload.write(b"a" * 6)
+        with self.assertRaises(RequestEntityTooLarge):
+            upload.write(b"a" * 6)
+        upload.close()
+
+        # Uploads at the limit are accepted
+        upload = SpooledUpload(max_bytes=10)
+        upload.write(b"a" * 10)
+        self.assertEqual(upload.size, 10)
+        upload.close()
+
+    def test_getvalue_keeps_position(self):
+        """Test that reading back a whole upload leaves its position where it was"""
+        upload = SpooledUpload()
+        upload.write(b"latitude,longitude\n43.6,-79.4\n")
+        upload.seek(9)
+        self.assertEqual(upload.getvalue(), b"latitude,longitude\n43.6,-79.4\n")
+        self.assertEqual(upload.tell(), 9)
+        self.assertEqual(upload.read(9), b"longitude")
+        upload.close()
+
+    def test_requests_spool_uploads(self):
+        """Test that uploaded files are spooled, hashed and sized as the request is parsed"""
+        data = b"latitude,longitude,value\n" + b"43.6,-79.4,1\n" * 20000
+        response = self.post(data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json, {"size": len(data), "digest": hashlib.sha256(data).hexdigest(),
+                                         "isSpooled": True})
+
+    def test_request_over_limit(self):
+        """Test that uploads over the app's MAX_UPLOAD_BYTES are answered with 413"""
+        self.app.config["MAX_UPLOAD_BYTES"] = 1000
+        self.assertEqual(self.post(b"a" * 1001).status_code, 413)
+        self.assertEqual(self.post(b"a" * 1000).status_code, 200)
+
+    def test_duplicate_outlives_request(self):
+        """Test that a duplicate descriptor, as background validations read, outlives the upload closed with its
+        request"""
+        data = b"latitude,longitude,value\n" + b"43.6,-79.4,1\n" * 1000
+        self.assertEqual(self.post(data).status_code, 200)
+        self.assertTrue(self.uploaded.closed)
+        self.assertEqual(self.copies[0].read(), data)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+"""
+Uploads spooled to disk as they stream in.
+
+Werkzeug parses multipart requests in fixed 64 KiB chunks, writing each uploaded file to the stream its request
+class makes. UploadRequest makes that a SpooledUpload: a temporary file that hashes the chunks and enforces the
+upload size limit as they arrive, so an upload is never held in memory whole, and an oversized one is rejected
+before it has all been received. Parsers read the file itself.
+"""
+import hashlib
+import io
+import tempfile
+from flask import Request, current_app
+from werkzeug.exceptions import RequestEntityTooLarge
+
+
+class SpooledUpload(io.BufferedRandom):
+    """An uploaded file in an anonymous temporary file, with its size and SHA-256 digest"""
+
+    def __init__(self, max_bytes: int = None, directory: str = None):
+        """
+        Args:
+            max_bytes: Largest upload accepted, or None for no limit
+            directory: Directory of the temporary file (the system's temporary directory if None)
+        """
+        super().__init__(tempfile.TemporaryFile(dir=directory, buffering=0))
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._hash = hashlib.sha256()
+
+    def write(self, data) -> int:
+        """Append a chunk of the upload, hashing it"""
+        self.size += len(data)
+        if self.max_bytes is not None and self.size > self.max_bytes:
+            raise RequestEntityTooLarge(f"Uploaded files are limited to {self.max_bytes} bytes")
+        self._hash.update(data)
+        return super().write(data)
+
+    @property
+    def digest(self) -> str:
+        """Hex SHA-256 of the upload, identifying its contents"""
+        return self._hash.hexdigest()
+
+    def getvalue(self) -> bytes:
+        """The whole upload as bytes, read back from disk only when it is stored"""
+        position = self.tell()
+        self.seek(0)
+        try:
+            return self.read()
+        finally:
+            self.seek(position)
+
+
+class UploadRequest(Request):
+    """Request spooling its uploaded files to SpooledUploads, limited to the app's MAX_UPLOAD_BYTES"""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return SpooledUpload(current_app.config["MAX_UPLOAD_BYTES"], current_app.config["UPLOAD_DIR"])
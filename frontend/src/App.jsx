@@ -6,9 +6,46 @@ import 'https://unpkg.com/leaflet@1.9.4/dist/leaflet.js'
 import './App.css'
 
 export let allOverlays = {}
+let previewTitles = new Set() // layers shown from a coarse preview, until their full render is ready
+let previewTimer = null
+let fetchingTitles = new Set() // layers whose rasters are being fetched as they come into view
 export const apiEndpoint = import.meta.env.VITE_API_ENDPOINT // endpoint in environment -- should be localhost when testing locally
 console.log(apiEndpoint);
 
+// The map's viewport as bbox query parameters (west,south,east,north). Longitudes are wrapped onto -180..180,
+// since the map can be panned onto copies of the world, and a viewport crossing the antimeridian is split in two
+export function viewportBboxes(map) {
+    const bounds = map.getBounds()
+    const south = Math.max(bounds.getSouth(), -90)
+    const north = Math.min(bounds.getNorth(), 90)
+    if (bounds.getEast() - bounds.getWest() >= 360) {
+        return [`-180,${south},180,${north}`]
+    }
+    const wrap = (lng) => ((lng + 180) % 360 + 360) % 360 - 180
+    const west = wrap(bounds.getWest())
+    const east = wrap(bounds.getEast())
+    if (west <= east) {
+        return [`${west},${south},${east},${north}`]
+    }
+    return [`${west},${south},180,${north}`, `-180,${south},${east},${north}`]
+}
+
+// The layers intersecting the map's viewport, or null if they couldn't be listed
+async function fetchLayersInView(map) {
+    const layersInView = new Map()
+    for (let bbox of viewportBboxes(map)) {
+        const response = await fetch(`${apiEndpoint}/layers?bbox=${bbox}`)
+        if (!response.ok) {
+            console.error("Listing the layers in view failed", response.status)
+            return null
+        }
+        for (let layer of (await response.json()).layers) {
+            layersInView.set(layer.id, layer)
+        }
+    }
+    return [...layersInView.values()]
+}
+
 function removeValue(value, index, arr, valToRemove) {
     if (value !== valToRemove) {
         arr.splice(index, 1)
@@ -28,18 +65,29 @@ function App() {
     useEffect(() => {
         console.log("Running useEffect")
         fetchLayers()
+        // Layers the map is moved onto are fetched as they come into view
+        currentMap.on('moveend', fetchVisibleLayers)
+        return () => currentMap.off('moveend', fetchVisibleLayers)
     }, [])
 
     const fetchLayers = async () => {
         const response = await fetch(`${apiEndpoint}/layers`)
+        if (!response.ok) {
+            console.error("Listing layers failed", response.status)
+            return
+        }
         const data = await response.json()
         setLayers(data.layers)
         let imageLayers = { ...allOverlays };
         let layerTitles = [];
         let leftoverLayers = [...layersInMap];
+        // Only the rasters of layers intersecting the viewport are fetched, or every raster if those can't be listed
+        const layersInView = await fetchLayersInView(currentMap)
+        const visibleIds = layersInView === null ? null : new Set(layersInView.map((layer) => layer.id))
         for (let layer of data.layers) {
             let layerId = layer.id;
             console.log(layer);
+            if (visibleIds !== null && !visibleIds.has(layerId) && !(layer.title in allOverlays)) continue
 
             let indivResponse = await fetch(`${apiEndpoint}/get_raster/${layerId}`);
             let indivData = await indivResponse.json();
@@ -53,6 +101,9 @@ function App() {
             console.log("IMAGE SRC", image.src)
             if (!(layersInMap.includes(layer.title))) {
                 imageLayers[layer.title] = createLayer(image, imageJson, currentMap, layer.title)
+                if (layer.status === "preview") {
+                    previewTitles.add(layer.title)
+                }
             } else {
                 leftoverLayers.filter(function(value, index, arr) {
                     removeValue(value, index, arr, layer)
@@ -66,10 +117,64 @@ function App() {
         }
         allOverlays = {...imageLayers};
         setLayersInMap(layerTitles);
+        schedulePreviewRefresh();
 
 
     }
 
+    // Fetch the rasters of layers in the viewport that aren't on the map yet
+    const fetchVisibleLayers = async () => {
+        const layersInView = await fetchLayersInView(currentMap)
+        if (layersInView === null) return
+        for (let layer of layersInView) {
+            // moveend can fire again while a raster is being fetched, so it is claimed before the fetch
+            if (layer.title in allOverlays || fetchingTitles.has(layer.title)) continue
+            fetchingTitles.add(layer.title)
+            try {
+                let indivResponse = await fetch(`${apiEndpoint}/get_raster/${layer.id}`);
+                if (!indivResponse.ok) continue
+                let indivData = await indivResponse.json();
+                const image = new Image();
+                image.src = `data:${indivData.layerImage.contentType};base64, ${indivData.layerImage.image}`;
+                allOverlays[layer.title] = createLayer(image, indivData.layerJson, currentMap, layer.title)
+                if (layer.status === "preview") {
+                    previewTitles.add(layer.title)
+                }
+                setLayersInMap((titles) => [...titles, layer.title])
+            } finally {
+                fetchingTitles.delete(layer.title)
+            }
+        }
+        schedulePreviewRefresh()
+    }
+
+    const schedulePreviewRefresh = () => {
+        if (previewTitles.size > 0 && previewTimer === null) {
+            previewTimer = setTimeout(refreshPreviews, 2000)
+        }
+    }
+
+    // Swap the preview overlays of layers whose full render has finished
+    const refreshPreviews = async () => {
+        previewTimer = null
+        const response = await fetch(`${apiEndpoint}/layers`)
+        const data = await response.json()
+        for (let layer of data.layers) {
+            if (!previewTitles.has(layer.title) || layer.status === "preview") continue
+            previewTitles.delete(layer.title)
+            if (layer.status !== "ready" || !(layer.title in allOverlays)) continue
+
+            let indivResponse = await fetch(`${apiEndpoint}/get_raster/${layer.id}`);
+            let indivData = await indivResponse.json();
+            const image = new Image();
+            image.src = `data:${indivData.layerImage.contentType};base64, ${indivData.layerImage.image}`;
+            deleteLayer(currentMap, allOverlays[layer.title]);
+            allOverlays[layer.title] = createLayer(image, indivData.layerJson, currentMap, layer.title)
+        }
+        setLayers(data.layers)
+        schedulePreviewRefresh()
+    }
+
     const closeModal = () => {
         setIsModalOpen(false)
         setCurrentLayer({})
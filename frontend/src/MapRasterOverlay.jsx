@@ -35,7 +35,10 @@ L.marker([49.2827, -123.1207]).addTo(map)
 // On mouse click, do something -- THIS SHOULD BE MOVED TO MAIN SCRIPT AND ITERATED THROUGH ALL PRESENT LAYERS
 map.on('click', async function (e) {
 
-    const response = await fetch(`${apiEndpoint}/layers`);
+    // Only layers covering the clicked point are searched
+    const point = e.latlng.wrap();
+    const response = await fetch(`${apiEndpoint}/layers?bbox=${point.lng},${point.lat},${point.lng},${point.lat}`);
+    if (!response.ok) return;
     const data = await response.json();
 
     const allLayers = [...data.layers]
@@ -76,6 +79,11 @@ function findIndex(layer, coordinate) {
 
     if (coordinate !== undefined) {
 
+        // Cells with no point within the layer's influence distance have no value
+        if (layer[coordinate]["name"] === null) {
+            return "no data"
+        }
+
         // Calculate nearest pixel coordinate
         const pixelVal = Math.round(1000
             * layer[coordinate]["name"]) / 1000